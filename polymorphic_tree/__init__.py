@@ -1,2 +1,8 @@
+import django
+
 # following PEP 440
 __version__ = "2.1"
+
+if django.VERSION < (3, 2):
+    # Newer Django versions detect the app config automatically.
+    default_app_config = "polymorphic_tree.apps.PolymorphicTreeConfig"
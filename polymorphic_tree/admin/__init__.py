@@ -1,9 +1,10 @@
 from polymorphic_tree.admin.childadmin import PolymorphicMPTTChildModelAdmin, PolymorpicMPTTAdminForm
-from polymorphic_tree.admin.parentadmin import NodeTypeChoiceForm, PolymorphicMPTTParentModelAdmin
+from polymorphic_tree.admin.parentadmin import MoveNodesForm, NodeTypeChoiceForm, PolymorphicMPTTParentModelAdmin
 
 __all__ = (
     "PolymorphicMPTTChildModelAdmin",
     "PolymorpicMPTTAdminForm",
     "PolymorphicMPTTParentModelAdmin",
     "NodeTypeChoiceForm",
+    "MoveNodesForm",
 )
@@ -0,0 +1,120 @@
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+#: The query parameter of the subtree that jqTree loads on demand.
+NODE_VAR = "node"
+
+#: The query parameters that don't filter the changelist, ``_`` is the cache buster of jQuery.
+IGNORED_PARAMS = ("_",)
+
+
+def get_open_nodes_cookie(model):
+    """
+    Return the name of the cookie that stores the nodes that are open in the browser.
+    """
+    return "polymorphic_tree_open_{}_{}".format(model._meta.app_label, model._meta.model_name)
+
+
+class PolymorphicMPTTChangeList(ChangeList):
+    """
+    The changelist of the tree admin.
+
+    Without any filters or search query, only the top levels of the trees are listed,
+    together with the children of the nodes that were left open in the browser.
+    The other subtrees are loaded by jqTree when they are opened.
+    When the ``node`` parameter is given, only the children of that node are listed,
+    which the table without JavaScript links to as well.
+    """
+
+    def __init__(self, request, model, *args, **kwargs):
+        # These are needed by get_queryset(), which is called by the base class.
+        self.parent_node_id = request.GET.get(NODE_VAR) or None
+        self.load_on_demand = False
+        self.open_nodes_cookie = get_open_nodes_cookie(model)
+        super().__init__(request, model, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(NODE_VAR, None)
+        for ignored in IGNORED_PARAMS:
+            lookup_params.pop(ignored, None)
+        return lookup_params
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        opts = self.model._mptt_meta
+        if self.parent_node_id is not None:
+            self.load_on_demand = True
+            return qs.filter(**{opts.parent_attr: self.parent_node_id})
+
+        depth = self.model_admin.get_tree_initial_depth(request)
+        if depth is None or self.query or self.get_filters_params():
+            # Show all matches, the tree is interrupted anyway.
+            return qs
+
+        self.load_on_demand = True
+        expanded_ids = self.get_expanded_node_ids(request, depth)
+        return qs.filter(Q(**{opts.level_attr + "__lt": depth}) | Q(**{opts.parent_attr + "__in": expanded_ids}))
+
+    def get_results(self, request):
+        super().get_results(request)
+        self.set_preview_urls(self.result_list)
+        self.set_children_urls(self.result_list)
+
+    def set_preview_urls(self, nodes):
+        """
+        Resolve the preview URLs of the actions column at once, see the ``get_preview_urls()`` of the admin.
+        """
+        if "actions_column" not in self.list_display:
+            return
+        preview_urls = self.model_admin.get_preview_urls(nodes)
+        for node in nodes:
+            node._preview_url = preview_urls.get(node.pk)
+
+    def set_children_urls(self, nodes):
+        """
+        Link the nodes of which the children are not listed to the list of their children.
+        """
+        if not self.load_on_demand:
+            return
+        opts = self.model._mptt_meta
+        listed_parent_ids = {opts.get_raw_field_value(node, opts.parent_attr) for node in nodes}
+        for node in nodes:
+            if node.pk not in listed_parent_ids and not node.is_leaf_node():
+                node._children_url = self.get_query_string({NODE_VAR: node.pk})
+
+    def get_open_node_ids(self, request):
+        """
+        Return the primary keys of the nodes that are open in the browser, which are stored in a cookie.
+        """
+        value = request.COOKIES.get(self.open_nodes_cookie)
+        if not value:
+            return []
+        return [pk for pk in value.split(",") if pk]
+
+    def get_expanded_node_ids(self, request, depth):
+        """
+        Return the open nodes below the initial levels, of which all ancestors are open too.
+        Their children are listed as well.
+        """
+        open_ids = self.get_open_node_ids(request)
+        if not open_ids:
+            return []
+
+        opts = self.model._mptt_meta
+        level_attr = opts.level_attr
+        try:
+            rows = (
+                self.root_queryset.non_polymorphic()
+                .filter(pk__in=open_ids, **{level_attr + "__gte": depth - 1})
+                .order_by(level_attr)
+                .values_list("pk", opts.parent_attr + "_id", level_attr)
+            )
+            expanded_ids = set()
+            for pk, parent_id, level in rows:
+                if level == depth - 1 or parent_id in expanded_ids:
+                    expanded_ids.add(pk)
+        except (ValueError, TypeError, ValidationError):
+            return []  # Invalid cookie values
+        return list(expanded_ids)
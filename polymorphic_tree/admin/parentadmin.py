@@ -1,25 +1,66 @@
+import hashlib
 import json
+import time
 
+from django import forms
 from django.conf import settings
-from django.contrib.admin import SimpleListFilter
+from django.contrib import messages
+from django.contrib.admin import SimpleListFilter, helpers
+from django.contrib.admin.widgets import ForeignKeyRawIdWidget
 from django.contrib.auth import get_permission_codename
-from django.core.exceptions import ValidationError
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import transaction
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseRedirect
+from django.db.models import Q, Subquery
+from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.template.response import TemplateResponse
 from django.urls import path, re_path, reverse
-from django.utils.translation import gettext
+from django.utils.cache import (
+    add_never_cache_headers,
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
+from django.utils.http import quote_etag
+from django.utils.translation import get_language, gettext
 from django.utils.translation import gettext_lazy as _
+from django.utils.translation import ngettext
 from mptt.admin import MPTTModelAdmin
 from mptt.exceptions import InvalidMove
+from mptt.signals import node_moved
 from polymorphic.admin import PolymorphicModelChoiceForm, PolymorphicParentModelAdmin
 
+from polymorphic_tree.admin.changelist import IGNORED_PARAMS, PolymorphicMPTTChangeList, get_open_nodes_cookie
+from polymorphic_tree.cache import _get_cache, get_cache_timeout, get_changes, get_version, is_shared_cache
 from polymorphic_tree.models import PolymorphicMPTTModel
+from polymorphic_tree.paginator import TreePaginator
+from polymorphic_tree.paths import _update_node_path, _update_subtree_paths, get_path_field
+from polymorphic_tree.skeleton import NodePosition
+from polymorphic_tree.templatetags.polymorphic_tree_admin_tags import get_jqtree_data
 
 
 class NodeTypeChoiceForm(PolymorphicModelChoiceForm):
     type_label = _("Node type")
 
 
+class MoveNodesForm(forms.Form):
+    """
+    The form of the "move selected nodes" action, to choose the new parent.
+    The parent is entered with a raw id widget, so large trees are not rendered as a list of options.
+    """
+
+    def __init__(self, model, admin_site, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        parent_field = model._meta.get_field(model._mptt_meta.parent_attr)
+        self.fields["target"] = forms.ModelChoiceField(
+            queryset=model.objects.non_polymorphic(),
+            label=_("New parent"),
+            required=False,
+            widget=ForeignKeyRawIdWidget(parent_field.remote_field, admin_site),
+            help_text=_("Leave empty to move the nodes to the top level."),
+        )
+
+
 class NodeTypeListFilter(SimpleListFilter):
     parameter_name = "ct_id"
     title = _("node type")
@@ -48,10 +89,41 @@ class PolymorphicMPTTParentModelAdmin(PolymorphicParentModelAdmin, MPTTModelAdmi
     # Config list page:
     list_filter = (NodeTypeListFilter,)
 
-    # TODO: disable the pagination in the admin, because it doesn't work with the current template code.
-    # This is a workaround for https://github.com/edoburu/django-polymorphic-tree/issues/2 until
-    # proper pagination code (or a different JavaScript frontend) is included to deal with the interrupted tree levels.
-    list_per_page = 10000
+    # The pages contain complete trees, or complete subtrees of the largest trees,
+    # so the tree levels are not interrupted. See https://github.com/edoburu/django-polymorphic-tree/issues/2
+    paginator = TreePaginator
+    list_per_page = 2000
+
+    #: The number of tree levels that are listed at once, the deeper levels are loaded when they are opened.
+    #: The nodes that were left open are listed too. Use ``None`` to list all nodes at once.
+    tree_initial_depth = 2
+
+    #: A template to render the label of every node in the tree, instead of the built-in markup.
+    #: It receives the same variables as the ``adminlist_recursetree`` tag. This is slower for large trees.
+    tree_node_label_template = None
+
+    #: Whether to call ``save()`` on the moved node after a drag-and-drop move, e.g. to update URL caches.
+    #: This writes all fields of the node. Alternatively, listen to the ``node_moved`` signal of django-mptt.
+    save_moved_nodes = False
+
+    #: Whether the tree data has an ETag, and is cached on the server until the trees change.
+    #: This needs a ``POLYMORPHIC_TREE_CACHE`` that is shared by all server processes,
+    #: so it's never used with a local-memory cache. See :mod:`polymorphic_tree.cache`.
+    tree_data_caching = False
+
+    #: The number of moves that are applied one by one, like ``move_to()`` does. Larger batches read the
+    #: structure of the affected trees once, which is faster for many moves but slower for a few moves in large trees.
+    sequential_moves_limit = 10
+
+    #: How long the change stream waits for changes, in seconds, so open changelists follow the changes of other
+    #: editors. Every open changelist keeps a server thread busy, and the ``POLYMORPHIC_TREE_CACHE`` has to be shared
+    #: by all server processes. Use ``None`` to disable the change stream.
+    tree_changes_timeout = None
+
+    #: How often the change stream checks the version of the trees, in seconds.
+    tree_changes_interval = 0.5
+
+    actions = ("move_selected_nodes",)
 
     EMPTY_ACTION_ICON = '<span><img src="{STATIC_URL}polymorphic_tree/icons/blank.gif" width="16" height="16" alt="" class="{css_class}"/></span>'
 
@@ -67,6 +139,15 @@ class PolymorphicMPTTParentModelAdmin(PolymorphicParentModelAdmin, MPTTModelAdmi
     # When making changes to the list, test both the JavaScript and non-JavaScript variant.
     # The jqTree variant still uses the server-side rendering for the columns.
 
+    def get_changelist(self, request, **kwargs):
+        return PolymorphicMPTTChangeList
+
+    def get_tree_initial_depth(self, request):
+        """
+        Return the number of tree levels that are listed at once, see :attr:`tree_initial_depth`.
+        """
+        return self.tree_initial_depth
+
     def actions_column(self, node):
         """
         An extra column to display action icons.
@@ -95,11 +176,12 @@ class PolymorphicMPTTParentModelAdmin(PolymorphicParentModelAdmin, MPTTModelAdmi
         else:
             actions.append(self.EMPTY_ACTION_ICON.format(STATIC_URL=settings.STATIC_URL, css_class="add-child-object"))
 
-        if self.can_preview_object(node):
+        preview_url = self.get_preview_url(node)
+        if preview_url:
             actions.append(
                 '<a href="{url}" title="{title}" target="_blank">'
                 '<img src="{static}polymorphic_tree/icons/world.gif" width="16" height="16" alt="{title}" /></a>'.format(
-                    url=node.get_absolute_url(), title=_("View on site"), static=settings.STATIC_URL
+                    url=preview_url, title=_("View on site"), static=settings.STATIC_URL
                 )
             )
 
@@ -115,6 +197,31 @@ class PolymorphicMPTTParentModelAdmin(PolymorphicParentModelAdmin, MPTTModelAdmi
         """
         return hasattr(node, "get_absolute_url")
 
+    def get_preview_urls(self, nodes):
+        """
+        Return the preview URLs of the nodes, by primary key.
+
+        The changelist calls this once for all listed nodes. When the model has a ``get_absolute_urls(nodes)``
+        classmethod, that resolves all URLs at once, e.g. with a single pass over the ancestors.
+        Otherwise, ``get_absolute_url()`` is called for every node.
+        """
+        nodes = [node for node in nodes if self.can_preview_object(node)]
+        if not nodes:
+            return {}
+        get_absolute_urls = getattr(self.model, "get_absolute_urls", None)
+        if get_absolute_urls is not None:
+            return get_absolute_urls(nodes)
+        return {node.pk: node.get_absolute_url() for node in nodes}
+
+    def get_preview_url(self, node):
+        """
+        Return the preview URL of a node, which is resolved by :func:`get_preview_urls` for the listed nodes.
+        """
+        try:
+            return node._preview_url
+        except AttributeError:
+            return self.get_preview_urls([node]).get(node.pk)
+
     # ---- Custom views ----
 
     def get_urls(self):
@@ -129,6 +236,26 @@ class PolymorphicMPTTParentModelAdmin(PolymorphicParentModelAdmin, MPTTModelAdmi
                 self.admin_site.admin_view(self.api_node_moved_view),
                 name="{}_{}_moved".format(*info),
             ),
+            path(
+                "api/nodes-moved/",
+                self.admin_site.admin_view(self.api_nodes_moved_view),
+                name="{}_{}_nodes_moved".format(*info),
+            ),
+            path(
+                "api/children-reordered/",
+                self.admin_site.admin_view(self.api_children_reordered_view),
+                name="{}_{}_children_reordered".format(*info),
+            ),
+            path(
+                "api/tree-changes/",
+                self.admin_site.admin_view(self.api_tree_changes_view),
+                name="{}_{}_tree_changes".format(*info),
+            ),
+            path(
+                "api/tree-data/",
+                self.admin_site.admin_view(self.api_tree_data_view),
+                name="{}_{}_tree_data".format(*info),
+            ),
             re_path(r"^(\d+)/move_up/$", self.admin_site.admin_view(self.move_up_view)),
             re_path(r"^(\d+)/move_down/$", self.admin_site.admin_view(self.move_down_view)),
         ]
@@ -140,95 +267,360 @@ class PolymorphicMPTTParentModelAdmin(PolymorphicParentModelAdmin, MPTTModelAdmi
         info = _get_opt(self.model)
         return reverse("admin:{}_{}_moved".format(*info), current_app=self.admin_site.name)
 
+    @property
+    def api_tree_data_view_url(self):
+        # Provided for result list template
+        info = _get_opt(self.model)
+        return reverse("admin:{}_{}_tree_data".format(*info), current_app=self.admin_site.name)
+
+    def api_tree_data_view(self, request):
+        """
+        Return the nodes of the changelist in the jqTree data format.
+        With the ``node`` parameter, the children of that node are returned, when a collapsed node is opened.
+
+        With :attr:`tree_data_caching`, the response has an ETag, so browsers can revalidate it,
+        and it's stored in the cache until the tree changes. See :func:`get_tree_data_etag`.
+        """
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+
+        etag = self.get_tree_data_etag(request)
+        content = None
+        if etag is not None:
+            response = get_conditional_response(request, etag=etag)
+            if response is not None:
+                response["ETag"] = etag
+                return response  # Not Modified
+
+            cache = _get_cache()
+            cache_key = "polymorphic_tree:admin:tree_data:{}".format(etag.strip('"'))
+            content = cache.get(cache_key)
+
+        if content is None:
+            version = get_version(self.model)  # Read before the nodes, so no change is missed.
+            cl = self.get_changelist_instance(request)
+            # All children are returned, not just the first page.
+            nodes = None
+            if cl.parent_node_id is not None:
+                nodes = list(cl.queryset)
+                cl.set_preview_urls(nodes)
+            data = get_jqtree_data(cl, nodes, label_template=self.tree_node_label_template)
+            data["version"] = version
+            content = json.dumps(data, cls=DjangoJSONEncoder)
+            if etag is not None:
+                cache.set(cache_key, content, get_cache_timeout())
+
+        response = HttpResponse(content, content_type="application/json")
+        if etag is not None:
+            response["ETag"] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ("Cookie",))
+        return response
+
+    @property
+    def api_tree_changes_view_url(self):
+        # Provided for result list template, the client doesn't poll without it.
+        if not self._has_tree_changes():
+            return None
+        info = _get_opt(self.model)
+        return reverse("admin:{}_{}_tree_changes".format(*info), current_app=self.admin_site.name)
+
+    def api_tree_changes_view(self, request):
+        """
+        A long-poll stream of the tree changes, so the open changelists follow the changes of other editors.
+
+        The ``since`` parameter is the tree version of the client, which the tree data includes.
+        The response waits until the trees change, up to :attr:`tree_changes_timeout` seconds.
+        It has the new ``version``, and the ``changes`` with the ``action``, ``pk``, ``parent_id``, ``tree_id``,
+        ``lft``, ``rght`` and ``level`` of every added, changed, moved or deleted node.
+        When the changes are no longer available, ``reset`` tells the client to load the tree data again.
+        """
+        if not self._has_tree_changes():
+            raise Http404("The change stream is disabled.")
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+
+        try:
+            since = int(request.GET["since"])
+        except (KeyError, ValueError) as e:
+            return _get_json_response({"error": str(e)}, status=400)
+
+        deadline = time.monotonic() + self.tree_changes_timeout
+        version = get_version(self.model)
+        while version == since and time.monotonic() < deadline:
+            time.sleep(self.tree_changes_interval)
+            version = get_version(self.model)
+
+        if version is None or version == since:
+            data = {"version": version, "changes": []}
+        else:
+            version, changes = get_changes(self.model, since)
+            if changes is None:
+                data = {"version": version, "reset": True}
+            else:
+                data = {"version": version, "changes": [change._asdict() for change in changes]}
+
+        response = _get_json_response(data)
+        add_never_cache_headers(response)
+        return response
+
+    def _has_tree_changes(self):
+        return self.tree_changes_timeout is not None and is_shared_cache()
+
+    def get_tree_data_etag(self, request):
+        """
+        Return the ETag of the tree data, or ``None`` to disable the caching.
+
+        The ETag combines the version of the trees with the user, language, query parameters and open nodes.
+        The version changes when nodes are saved, moved or deleted, see :mod:`polymorphic_tree.cache`.
+        Override this when the columns show data that is not stored in the nodes.
+        """
+        if not self.tree_data_caching or not is_shared_cache():
+            return None
+
+        version = get_version(self.model)
+        if version is None:
+            return None
+
+        params = sorted((key, value) for key, value in request.GET.lists() if key not in IGNORED_PARAMS)
+        key = repr(
+            (
+                self.model._meta.label_lower,
+                version,
+                request.user.pk,
+                get_language(),
+                params,
+                request.COOKIES.get(get_open_nodes_cookie(self.model)),
+            )
+        )
+        return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
     @transaction.atomic
     def api_node_moved_view(self, request):
         """
         Update the position of a node, from a API request.
+
+        The nodes are only downcasted when their model has dynamic tree rules or custom move validation,
+        otherwise the permissions and tree rules are checked using the content types.
+        The response lists the ``[pk, parent_id, lft, rght, level]`` of all nodes that changed,
+        so the client can update its tree. See :attr:`save_moved_nodes` to save the moved node afterwards.
         """
         try:
-            moved_id = _get_pk_value(request.POST["moved_id"])
-            target_id = _get_pk_value(request.POST["target_id"])
-            position = request.POST["position"]
+            move = _parse_move(request.POST, check_parent=True)
+        except (ValueError, KeyError) as e:
+            return _get_json_response({"action": "foundbug", "error": str(e)}, status=400)
 
-            if request.POST.get("previous_parent_id"):
-                previous_parent_id = _get_pk_value(request.POST["previous_parent_id"])
-            else:
-                previous_parent_id = None
+        return self._get_moved_response(request, [move], single=True)
 
-            # Not using .non_polymorphic() so all models are downcasted to the derived model.
-            # This causes the signal below to be emitted from the proper class as well.
-            moved = self.model.objects.get(pk=moved_id)
-            target = self.model.objects.get(pk=target_id)
-        except (ValueError, KeyError) as e:
-            return HttpResponseBadRequest(
-                json.dumps({"action": "foundbug", "error": str(e[0])}), content_type="application/json"
-            )
-        except self.model.DoesNotExist as e:
-            return HttpResponseNotFound(
-                json.dumps({"action": "reload", "error": str(e[0])}), content_type="application/json"
-            )
+    @transaction.atomic
+    def api_nodes_moved_view(self, request):
+        """
+        Move many nodes at once, from a API request.
 
-        if not request.user.has_perm(
-            "{}.{}".format(moved._meta.app_label, get_permission_codename("change", moved._meta))
-        ):
-            return HttpResponse(
-                json.dumps(
+        The ``moves`` parameter is a JSON list of ``{"moved_id", "target_id", "position"}`` objects,
+        which are applied in the given order. The ``previous_parent_id`` can be included to detect
+        that the client is out-of-sync. All moves are validated together, and applied in one transaction
+        with a single update per tree. The response is the same as :func:`api_node_moved_view`.
+        """
+        try:
+            moves = json.loads(request.POST["moves"])
+            if not isinstance(moves, list):
+                raise ValueError("The moves should be a list")
+            moves = [_parse_move(move, check_parent="previous_parent_id" in move) for move in moves]
+        except (ValueError, KeyError, TypeError) as e:
+            return _get_json_response({"action": "foundbug", "error": str(e)}, status=400)
+
+        return self._get_moved_response(request, moves)
+
+    def _get_moved_response(self, request, moves, single=False):
+        moved_ids = [move[0] for move in moves]
+        try:
+            nodes = {
+                str(node.pk): node
+                for node in self.model.objects.non_polymorphic().filter(pk__in=moved_ids + [move[1] for move in moves])
+            }
+        except (ValueError, ValidationError) as e:
+            return _get_json_response({"action": "foundbug", "error": str(e)}, status=400)
+
+        node_moves = []
+        for moved_id, target_id, position, previous_parent_id in moves:
+            try:
+                moved = nodes[str(moved_id)]
+                target = nodes[str(target_id)]
+            except KeyError:
+                return _get_json_response(
+                    {"action": "reload", "error": gettext("The node has been deleted in the meantime.")}, status=404
+                )
+
+            # Compare on strings to support UUID fields.
+            parent_attr_id = f"{moved._mptt_meta.parent_attr}_id"
+            if previous_parent_id is not _ANY_PARENT and str(getattr(moved, parent_attr_id)) != str(previous_parent_id):
+                return _get_json_response(
                     {
-                        "action": "reject",
-                        "moved_id": moved_id,
-                        "error": gettext("You do not have permission to move this node."),
-                    }
-                ),
-                content_type="application/json",
-                status=409,
-            )
+                        "action": "reload",
+                        "error": "Client seems to be out-of-sync, please reload!",
+                        "positions": [_get_position_data(moved)],
+                    },
+                    status=409,
+                )
+            node_moves.append((moved, target, position))
 
-        # Compare on strings to support UUID fields.
-        parent_attr_id = f"{moved._mptt_meta.parent_attr}_id"
-        if str(getattr(moved, parent_attr_id)) != str(previous_parent_id):
-            return HttpResponse(
-                json.dumps({"action": "reload", "error": "Client seems to be out-of-sync, please reload!"}),
-                content_type="application/json",
-                status=409,
+        reject = {"action": "reject", "moved_id": moved_ids[0]} if single else {"action": "reject"}
+        try:
+            changed = self.move_nodes(request, node_moves)
+        except PermissionDenied:
+            reject["error"] = gettext("You do not have permission to move this node.")
+            return _get_json_response(reject, status=409)
+        except (ValidationError, InvalidMove) as e:
+            reject["error"] = _get_move_error(e, node_moves)
+            return _get_json_response(reject, status=409)  # Conflict
+
+        # Report back to client.
+        data = {
+            "action": "success",
+            "error": None,
+            "moved_ids": moved_ids,
+            "positions": [
+                [position.pk, position.parent_id, position.lft, position.rght, position.level] for position in changed
+            ],
+        }
+        if single:
+            data["moved_id"] = moved_ids[0]
+            data["action_column"] = None
+            if "actions_column" in self.get_list_display(request):
+                data["action_column"] = self.actions_column(node_moves[0][0].get_real_instance())
+        return _get_json_response(data)
+
+    @transaction.atomic
+    def api_children_reordered_view(self, request):
+        """
+        Change the order of all children of a node, from a API request.
+
+        The ``ordered_ids`` parameter is a JSON list with the primary keys of all children of ``parent_id``,
+        in the new order. The children are reordered with a single update, see
+        :func:`~polymorphic_tree.managers.PolymorphicMPTTModelManager.reorder_children`.
+        The response lists the new positions of the children that changed.
+        """
+        try:
+            parent_id = _get_pk_value(request.POST["parent_id"])
+            ordered_ids = [_get_pk_value(str(pk)) for pk in json.loads(request.POST["ordered_ids"])]
+            parent = self.model.objects.non_polymorphic().filter(pk=parent_id).first()
+        except (ValueError, KeyError, TypeError, ValidationError) as e:
+            return _get_json_response({"action": "foundbug", "error": str(e)}, status=400)
+
+        if parent is None:
+            return _get_json_response(
+                {"action": "reload", "error": gettext("The node has been deleted in the meantime.")}, status=404
+            )
+        if not _has_change_permission(request, parent):
+            return _get_json_response(
+                {"action": "reject", "error": gettext("You do not have permission to move this node.")}, status=409
             )
 
-        mptt_position = {
-            "inside": "first-child",
-            "before": "left",
-            "after": "right",
-        }[position]
         try:
-            moved.move_to(target, mptt_position)
-        except ValidationError as e:
-            return HttpResponse(
-                json.dumps({"action": "reject", "moved_id": moved_id, "error": "\n".join(e.messages)}),
-                content_type="application/json",
-                status=409,
-            )  # Conflict
-        except InvalidMove as e:
-            return HttpResponse(
-                json.dumps({"action": "reject", "moved_id": moved_id, "error": str(e)}),
-                content_type="application/json",
-                status=409,
+            changed = self.model.objects.reorder_children(parent, ordered_ids)
+        except (ValueError, InvalidMove):
+            return _get_json_response(
+                {"action": "reload", "error": "Client seems to be out-of-sync, please reload!"}, status=409
             )
 
-        # Some packages depend on calling .save() or post_save signal after updating a model.
-        # This is required by django-fluent-pages for example to update the URL caches.
-        moved.save()
+        return _get_json_response(
+            {
+                "action": "success",
+                "error": None,
+                "positions": [
+                    [position.pk, position.parent_id, position.lft, position.rght, position.level]
+                    for position in changed
+                ],
+            }
+        )
 
-        # Report back to client.
-        return HttpResponse(
-            json.dumps(
-                {
-                    "action": "success",
-                    "error": None,
-                    "moved_id": moved_id,
-                    "action_column": self.actions_column(moved),
-                }
-            ),
-            content_type="application/json",
+    def move_nodes(self, request, moves):
+        """
+        Apply the ``(node, target, position)`` moves in a single transaction.
+        Up to :attr:`sequential_moves_limit` moves are applied one by one with ``move_to()``,
+        larger batches with a single update per tree.
+
+        The nodes don't have to be downcasted. The change permission of every moved node type is checked,
+        and all moves are rejected when the tree rules don't allow one of them.
+        The position can be ``'first-child'``, ``'last-child'``, ``'left'`` or ``'right'``,
+        and a ``target`` of ``None`` moves the node to a new tree.
+
+        :returns: The :class:`~polymorphic_tree.skeleton.NodePosition` of all nodes that changed.
+        """
+        for node, target, position in moves:
+            if not _has_change_permission(request, node):
+                raise PermissionDenied
+
+        # Dynamic rules and custom validation need the real model.
+        moves = [
+            (_get_move_instance(node), _get_move_instance(target) if target is not None else None, position)
+            for node, target, position in moves
+        ]
+        with transaction.atomic():
+            if len(moves) == 1:
+                # A single move only shifts the nodes between the old and new position, like move_to() does.
+                changed = _move_node(*moves[0])
+            elif len(moves) <= self.sequential_moves_limit:
+                changed = _move_nodes_sequentially(moves)
+            else:
+                changed = self.model.objects.move_nodes(moves)
+            if self.save_moved_nodes:
+                # Some packages depend on calling .save() or post_save signal after updating a model.
+                # This is required by django-fluent-pages for example to update the URL caches.
+                for node, target, position in moves:
+                    node.get_real_instance().save()
+        return changed
+
+    def move_selected_nodes(self, request, queryset):
+        """
+        Admin action to move the selected nodes below another node, which is chosen in an intermediate page.
+
+        The nodes keep their order, and are placed after the existing children of the new parent.
+        Nodes below another selected node stay in that subtree.
+        """
+        form = MoveNodesForm(self.model, self.admin_site, request.POST if "apply" in request.POST else None)
+        if form.is_valid():
+            target = form.cleaned_data["target"]
+            nodes = _get_topmost_nodes(queryset)
+            try:
+                self.move_nodes(request, [(node, target, "last-child") for node in nodes])
+            except PermissionDenied:
+                self.message_user(request, gettext("You do not have permission to move this node."), messages.ERROR)
+            except (ValidationError, InvalidMove) as e:
+                self.message_user(request, _get_move_error(e, ()), messages.ERROR)
+            else:
+                self.message_user(
+                    request,
+                    ngettext("Moved %(count)d node.", "Moved %(count)d nodes.", len(nodes)) % {"count": len(nodes)},
+                    messages.SUCCESS,
+                )
+            return None  # Back to the changelist
+
+        opts = self.model._meta
+        context = {
+            **self.admin_site.each_context(request),
+            "title": gettext("Move selected nodes"),
+            "opts": opts,
+            "form": form,
+            "queryset": queryset,
+            "action_checkbox_name": helpers.ACTION_CHECKBOX_NAME,
+            "media": self.media + form.media,
+        }
+        request.current_app = self.admin_site.name
+        return TemplateResponse(
+            request,
+            [
+                "admin/{}/{}/move_selected_nodes.html".format(opts.app_label, opts.model_name),
+                "admin/{}/move_selected_nodes.html".format(opts.app_label),
+                "admin/polymorphic_tree/move_selected_nodes.html",
+            ],
+            context,
         )
 
+    move_selected_nodes.allowed_permissions = ("change",)
+    move_selected_nodes.short_description = _("Move selected %(verbose_name_plural)s under\u2026")
+
     def move_up_view(self, request, object_id):
         node = self.model.objects.get(pk=object_id)
 
@@ -257,6 +649,200 @@ def _get_opt(model):
         return model._meta.app_label, model._meta.module_name
 
 
+#: The positions of the drag-and-drop API, as position of django-mptt.
+_MOVE_POSITIONS = {
+    "inside": "first-child",
+    "before": "left",
+    "after": "right",
+}
+
+# The previous parent is not checked.
+_ANY_PARENT = object()
+
+
+def _parse_move(data, check_parent):
+    # Read the (moved_id, target_id, position, previous_parent_id) of a move in the API.
+    if data.get("previous_parent_id"):
+        previous_parent_id = _get_pk_value(data["previous_parent_id"])
+    else:
+        previous_parent_id = None
+
+    return (
+        _get_pk_value(data["moved_id"]),
+        _get_pk_value(data["target_id"]),
+        _MOVE_POSITIONS[data["position"]],
+        previous_parent_id if check_parent else _ANY_PARENT,
+    )
+
+
+def _get_json_response(data, status=200):
+    return HttpResponse(json.dumps(data, cls=DjangoJSONEncoder), content_type="application/json", status=status)
+
+
+def _has_change_permission(request, node):
+    # The permission of the node type, using the content type of the node.
+    model = node.get_node_type().model
+    return request.user.has_perm("{}.{}".format(model._meta.app_label, get_permission_codename("change", model._meta)))
+
+
+def _get_topmost_nodes(queryset):
+    # The nodes which are not a descendant of another node in the queryset, in tree order.
+    opts = queryset.model._mptt_meta
+    nodes = []
+    for node in queryset.order_by(opts.tree_id_attr, opts.left_attr):
+        if (
+            nodes
+            and getattr(node, opts.tree_id_attr) == getattr(nodes[-1], opts.tree_id_attr)
+            and getattr(node, opts.right_attr) < getattr(nodes[-1], opts.right_attr)
+        ):
+            continue
+        nodes.append(node)
+    return nodes
+
+
+def _get_move_instance(node):
+    # The static tree rules only need the content type of the node.
+    node_type = node.get_node_type()
+    if node_type.model is node.__class__ or not (
+        node_type.dynamic or node_type.model.validate_move_to is not PolymorphicMPTTModel.validate_move_to
+    ):
+        return node
+    return node.get_real_instance()
+
+
+def _move_node(node, target, position):
+    """
+    Move a single node with the range updates of ``move_to()``, without saving the node.
+    The changed positions are read from the ranges that shifted, instead of comparing the whole tree.
+    """
+    opts = node._mptt_meta
+    tree_manager = node._tree_manager
+    tree_model = tree_manager.tree_model
+    old_parent_id = getattr(node, opts.parent_attr + "_id")
+    old_tree_id = getattr(node, opts.tree_id_attr)
+    old_left = getattr(node, opts.left_attr)
+    old_right = getattr(node, opts.right_attr)
+
+    node.validate_move(target, position)
+    tree_manager._move_node(node, target, position=position)
+
+    # The range updates leave the parent and path of the node itself to save().
+    parent_attname = opts.parent_attr + "_id"
+    values = {parent_attname: getattr(node, parent_attname)}
+    old_path = _update_node_path(node)
+    if old_path is not None:
+        path_attname = get_path_field(tree_model).attname
+        values[path_attname] = getattr(node, path_attname)
+    tree_model._base_manager.db_manager(node._state.db).filter(pk=node.pk).update(**values)
+    if old_path is not None:
+        _update_subtree_paths(node, old_path, using=node._state.db)
+    opts.update_mptt_cached_fields(node)
+
+    # Tell the cache invalidation in which tree the node was.
+    node._tree_previous_tree_id = old_tree_id
+    try:
+        node_moved.send(sender=node.__class__, instance=node, target=target, position=position)
+    finally:
+        del node._tree_previous_tree_id
+
+    parent_id = getattr(node, opts.parent_attr + "_id")
+    tree_id = getattr(node, opts.tree_id_attr)
+    left = getattr(node, opts.left_attr)
+    right = getattr(node, opts.right_attr)
+    if old_parent_id is None and parent_id is None:
+        # Roots are only reordered by their tree_id.
+        shifted = Q(pk=node.pk)
+    elif old_parent_id is not None and parent_id is not None and old_tree_id == tree_id:
+        # Everything between the old and new position shifted.
+        start = min(old_left, left)
+        end = max(old_right, right)
+        shifted = Q(**{opts.tree_id_attr: tree_id}) & (
+            Q(**{opts.left_attr + "__range": (start, end)}) | Q(**{opts.right_attr + "__range": (start, end)})
+        )
+    else:
+        # The nodes after the new position shifted, and in the old tree, the nodes after the old position.
+        shifted = Q(**{opts.tree_id_attr: tree_id, opts.right_attr + "__gte": left})
+        if old_parent_id is not None:
+            old_tree = tree_model._base_manager.filter(pk=old_parent_id).values(opts.tree_id_attr)
+            shifted |= Q(**{opts.tree_id_attr: Subquery(old_tree), opts.right_attr + "__gte": old_left})
+
+    return [
+        NodePosition(*row)
+        for row in tree_model._base_manager.non_polymorphic()
+        .filter(shifted)
+        .order_by(opts.tree_id_attr, opts.left_attr)
+        .values_list(
+            "pk", opts.parent_attr + "_id", opts.tree_id_attr, opts.left_attr, opts.right_attr, opts.level_attr
+        )
+    ]
+
+
+def _move_nodes_sequentially(moves):
+    """
+    Apply a few moves with :func:`_move_node`.
+    The nodes are refreshed before each move, as the previous moves shift their positions.
+    """
+    changed_pks = set()
+    for node, target, position in moves:
+        for instance in (node, target):
+            if instance is not None:
+                instance.refresh_from_db(fields=_get_tree_fields(instance))
+        changed_pks.update(position.pk for position in _move_node(node, target, position))
+
+    opts = moves[0][0]._mptt_meta
+    return [
+        NodePosition(*row)
+        for row in moves[0][0]
+        ._tree_manager.tree_model._base_manager.non_polymorphic()
+        .filter(pk__in=changed_pks)
+        .order_by(opts.tree_id_attr, opts.left_attr)
+        .values_list(
+            "pk", opts.parent_attr + "_id", opts.tree_id_attr, opts.left_attr, opts.right_attr, opts.level_attr
+        )
+    ]
+
+
+def _get_tree_fields(node):
+    opts = node._mptt_meta
+    fields = [opts.parent_attr, opts.tree_id_attr, opts.left_attr, opts.right_attr, opts.level_attr]
+    path_field = get_path_field(node._tree_manager.tree_model)
+    if path_field is not None:
+        fields.append(path_field.name)
+    return fields
+
+
+def _get_move_error(error, moves):
+    """
+    The message of a rejected move. When a single move was rejected for nodes that were not downcasted,
+    the validation is repeated with the real models, so the message mentions the actual node types.
+    """
+    if len(moves) == 1:
+        moved, target, position = moves[0]
+        if (
+            moved.get_real_instance_class() is not moved.__class__
+            or target.get_real_instance_class() is not target.__class__
+        ):
+            try:
+                moved.get_real_instance().validate_move(target.get_real_instance(), position)
+            except (ValidationError, InvalidMove) as e:
+                error = e
+
+    if isinstance(error, ValidationError):
+        return "\n".join(error.messages)
+    return str(error)
+
+
+def _get_position_data(node):
+    opts = node._mptt_meta
+    return [
+        node.pk,
+        getattr(node, opts.parent_attr + "_id"),
+        getattr(node, opts.left_attr),
+        getattr(node, opts.right_attr),
+        getattr(node, opts.level_attr),
+    ]
+
+
 def _get_pk_value(text):
     try:
         return int(text)
@@ -0,0 +1,23 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+class PolymorphicTreeConfig(AppConfig):
+    name = "polymorphic_tree"
+    verbose_name = "Polymorphic tree"
+
+    def ready(self):
+        from polymorphic_tree.cache import connect_signals
+        from polymorphic_tree.registry import node_type_registry
+
+        node_type_registry.populate()
+        connect_signals()
+
+        # The content types could be recreated (e.g. by flushing the database in tests).
+        post_migrate.connect(_reset_node_types, sender=self, dispatch_uid="polymorphic_tree.reset_node_types")
+
+
+def _reset_node_types(sender, **kwargs):
+    from polymorphic_tree.registry import node_type_registry
+
+    node_type_registry.reset()
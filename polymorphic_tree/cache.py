@@ -0,0 +1,467 @@
+"""
+A versioned cache of the tree structure, for menus and breadcrumbs.
+
+The structure of every tree is cached as a compact list of rows, in Django's cache framework.
+Each tree has a version number that is increased when a node is saved, deleted or moved,
+so outdated entries are never read again. The changes of every version are kept as well,
+so open admin pages can follow the changes with :func:`get_changes`. The cache is configured with these settings:
+
+* ``POLYMORPHIC_TREE_CACHE``: the cache alias to use, defaults to ``"default"``.
+  Use ``None`` to disable the version updates entirely.
+  The versions are only seen by other server processes when the cache is shared, e.g. memcached, Redis or
+  the database cache. The admin doesn't rely on the versions when this is a local-memory cache.
+* ``POLYMORPHIC_TREE_CACHE_TIMEOUT``: the timeout of the cached trees, defaults to one hour.
+"""
+import hashlib
+import time
+from collections import defaultdict, namedtuple
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import router, transaction
+from django.db.models.signals import post_delete, post_save
+from mptt.signals import node_moved
+
+__all__ = (
+    "CachedNode",
+    "CachedTree",
+    "TreeCache",
+    "get_version",
+    "get_tree_version",
+    "bump_version",
+    "get_changes",
+    "get_cache_timeout",
+    "is_shared_cache",
+    "TreeChange",
+)
+
+#: A node in the cached tree structure.
+CachedNode = namedtuple("CachedNode", ("pk", "parent_id", "ctype_id", "tree_id", "lft", "rght", "level", "fields"))
+
+#: A node that was added, changed, moved or deleted, in the change log of the trees.
+TreeChange = namedtuple("TreeChange", ("action", "pk", "parent_id", "tree_id", "lft", "rght", "level"))
+
+#: The maximum number of versions that :func:`get_changes` replays.
+MAX_CHANGES = 1000
+
+
+def _get_cache():
+    alias = getattr(settings, "POLYMORPHIC_TREE_CACHE", "default")
+    return caches[alias] if alias else None
+
+
+def is_shared_cache():
+    """
+    Tell whether the versions are shared by all server processes, which is not the case for a local-memory cache.
+    """
+    cache = _get_cache()
+    return cache is not None and not isinstance(cache, LocMemCache)
+
+
+def get_cache_timeout():
+    """
+    Return the timeout of cached trees, from the ``POLYMORPHIC_TREE_CACHE_TIMEOUT`` setting.
+    """
+    return getattr(settings, "POLYMORPHIC_TREE_CACHE_TIMEOUT", 3600)
+
+
+def _get_version_key(model, name):
+    return "polymorphic_tree:{}:{}".format(model._tree_manager.tree_model._meta.label_lower, name)
+
+
+def _read_versions(cache, keys):
+    """
+    Read version counters, and initialize the missing ones.
+    The counters start at the current time in milliseconds, so they keep increasing when an entry was evicted.
+    """
+    versions = cache.get_many(keys)
+    for key in keys:
+        if versions.get(key) is None:
+            cache.add(key, int(time.time() * 1000), None)
+            versions[key] = cache.get(key)
+    return versions
+
+
+def get_version(model):
+    """
+    Return the version of all trees of the model, which increases on every change.
+    """
+    cache = _get_cache()
+    if cache is None:
+        return None
+    key = _get_version_key(model, "version")
+    return _read_versions(cache, [key])[key]
+
+
+def get_tree_version(model, tree_id):
+    """
+    Return the version of a single tree. This changes when the tree is changed,
+    or when the ``tree_id`` of the trees may have shifted.
+    """
+    cache = _get_cache()
+    if cache is None:
+        return None
+    keys = [_get_version_key(model, "epoch"), _get_version_key(model, "tree:{}".format(tree_id))]
+    versions = _read_versions(cache, keys)
+    if versions[keys[0]] is None or versions[keys[1]] is None:
+        return None  # The cache doesn't store values, e.g. the DummyCache.
+    return "{}.{}".format(versions[keys[0]], versions[keys[1]])
+
+
+def bump_version(model, tree_ids=None, changes=None):
+    """
+    Mark the cached trees as outdated. Without ``tree_ids``, all trees of the model are marked as outdated.
+    This is needed after updating the tree fields without ``save()``, e.g. after a ``queryset.update()``.
+
+    The ``changes`` are the :class:`TreeChange` objects of the new version. Without them,
+    :func:`get_changes` tells the readers to load the trees again.
+    The versions are increased when the current transaction is committed,
+    so other processes never cache the old rows under the new version.
+    Consecutive updates within a transaction are combined into a single version.
+    """
+    if _get_cache() is None:
+        return
+
+    tree_ids = list(tree_ids) if tree_ids is not None else None
+    changes = list(changes) if changes is not None else None
+    using = router.db_for_write(model._tree_manager.tree_model)
+
+    # Merge with the previous update of the transaction, e.g. for all nodes that are deleted by a cascade.
+    connection = transaction.get_connection(using)
+    if connection.in_atomic_block and connection.run_on_commit:
+        pending = connection.run_on_commit[-1][1]
+        if isinstance(pending, _PendingBump) and pending.merge(model, tree_ids, changes):
+            return
+
+    transaction.on_commit(_PendingBump(model, tree_ids, changes), using=using)
+
+
+class _PendingBump:
+    """
+    The version updates that run when the transaction is committed.
+    """
+
+    def __init__(self, model, tree_ids, changes):
+        self.model = model
+        self.tree_ids = tree_ids
+        self.changes = changes
+
+    def merge(self, model, tree_ids, changes):
+        if model._tree_manager.tree_model is not self.model._tree_manager.tree_model:
+            return False
+        self.tree_ids = None if self.tree_ids is None or tree_ids is None else self.tree_ids + tree_ids
+        self.changes = None if self.changes is None or changes is None else self.changes + changes
+        return True
+
+    def __call__(self):
+        _bump_version(self.model, self.tree_ids, self.changes)
+
+
+def _bump_version(model, tree_ids, changes):
+    cache = _get_cache()
+    names = ["version"]
+    if tree_ids is None:
+        names.append("epoch")
+    else:
+        names.extend("tree:{}".format(tree_id) for tree_id in set(tree_ids) if tree_id is not None)
+
+    for name in names:
+        key = _get_version_key(model, name)
+        try:
+            version = cache.incr(key)
+        except ValueError:
+            _read_versions(cache, [key])
+            try:
+                version = cache.incr(key)
+            except ValueError:
+                return  # The cache doesn't store values, e.g. the DummyCache.
+
+        if name == "version" and changes is not None:
+            cache.set(_get_changes_key(model, version), changes, get_cache_timeout())
+
+
+def get_changes(model, since):
+    """
+    Return the current version, and the :class:`TreeChange` objects of all versions after ``since``.
+    The changes are ``None`` when they are no longer available, or when the trees were changed in bulk.
+    """
+    cache = _get_cache()
+    if cache is None:
+        return None, None
+
+    version = get_version(model)
+    if version is None:
+        return None, None
+    if since > version or version - since > MAX_CHANGES:
+        return version, None
+
+    keys = [_get_changes_key(model, number) for number in range(since + 1, version + 1)]
+    entries = cache.get_many(keys)
+    if len(entries) < len(keys):
+        return version, None
+    return version, [change for key in keys for change in entries[key]]
+
+
+def _get_changes_key(model, version):
+    return _get_version_key(model, "changes:{}".format(version))
+
+
+def _get_change(action, node):
+    opts = node._mptt_meta
+    return TreeChange(
+        action,
+        node.pk,
+        getattr(node, opts.parent_attr + "_id"),
+        getattr(node, opts.tree_id_attr),
+        getattr(node, opts.left_attr),
+        getattr(node, opts.right_attr),
+        getattr(node, opts.level_attr),
+    )
+
+
+class CachedTree:
+    """
+    The cached structure of a single tree, which answers the tree lookups in memory.
+    Nodes can be given as primary key or as model instance.
+    """
+
+    def __init__(self, tree_id, nodes):
+        self.tree_id = tree_id
+        self.nodes = nodes  # in tree order
+        self._by_pk = {node.pk: node for node in nodes}
+        self._index = {node.pk: index for index, node in enumerate(nodes)}
+        self._children = defaultdict(list)
+        for node in nodes:
+            if node.parent_id is not None:
+                self._children[node.parent_id].append(node)
+
+    def __contains__(self, node):
+        return _get_pk(node) in self._by_pk
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def root(self):
+        return self.nodes[0] if self.nodes else None
+
+    def get(self, node):
+        """
+        Return the :class:`CachedNode` of a node.
+        """
+        return self._by_pk[_get_pk(node)]
+
+    def children(self, node):
+        """
+        Return the children of a node, in tree order.
+        """
+        return list(self._children.get(_get_pk(node), ()))
+
+    def ancestors(self, node, include_self=False, ascending=False):
+        """
+        Return the ancestors of a node, starting at the root, or at the parent with ``ascending=True``.
+        """
+        cached = self.get(node)
+        ancestors = [cached] if include_self else []
+        while cached.parent_id is not None:
+            cached = self._by_pk[cached.parent_id]
+            ancestors.append(cached)
+        return ancestors if ascending else ancestors[::-1]
+
+    def descendants(self, node, include_self=False):
+        """
+        Return the descendants of a node, in tree order.
+        """
+        cached = self.get(node)
+        start = self._index[cached.pk]
+        end = start + (cached.rght - cached.lft - 1) // 2 + 1
+        return self.nodes[start if include_self else start + 1 : end]
+
+
+class TreeCache:
+    """
+    The cached tree structure of a model, with the primary key, parent, content type and tree fields
+    of every node, and a few optional fields of the base model::
+
+        menu_cache = TreeCache(Page, fields=("title", "slug"))
+        menu_cache.children(page)
+        menu_cache.ancestors(page)
+
+    When a tree is not cached yet, only one process builds it while the others wait for the result.
+    The trees are also kept in memory per process, until their version changes.
+    """
+
+    #: How long other processes wait for the tree that is being built.
+    lock_timeout = 10
+
+    #: The interval to check whether the tree is built.
+    lock_wait = 0.05
+
+    def __init__(self, model, fields=(), timeout=None, max_local_trees=100):
+        self.model = model._tree_manager.tree_model
+        self.fields = tuple(fields)
+        self.timeout = timeout
+        self.max_local_trees = max_local_trees
+        self._local = {}
+        self._key_prefix = "polymorphic_tree:{}:skeleton:{}".format(
+            self.model._meta.label_lower, hashlib.md5(",".join(self.fields).encode()).hexdigest()[:8]
+        )
+
+    def get_tree(self, tree_id):
+        """
+        Return the :class:`CachedTree` with the given ``tree_id``.
+        """
+        cache = _get_cache()
+        if cache is None:
+            return self._build_tree(tree_id)
+
+        version = get_tree_version(self.model, tree_id)
+        if version is None:
+            return self._build_tree(tree_id)
+
+        key = "{}:{}:{}".format(self._key_prefix, tree_id, version)
+        tree = self._local.get(key)
+        if tree is not None:
+            return tree
+
+        rows = cache.get(key)
+        if rows is None:
+            rows = self._fetch_rows(cache, key, tree_id)
+
+        tree = self._make_tree(tree_id, rows)
+        if len(self._local) >= self.max_local_trees:
+            self._local.clear()
+        self._local[key] = tree
+        return tree
+
+    def get_tree_for(self, node):
+        """
+        Return the :class:`CachedTree` that contains the node.
+        """
+        return self.get_tree(getattr(node, self.model._mptt_meta.tree_id_attr))
+
+    def children(self, node):
+        return self.get_tree_for(node).children(node)
+
+    def ancestors(self, node, include_self=False, ascending=False):
+        return self.get_tree_for(node).ancestors(node, include_self=include_self, ascending=ascending)
+
+    def descendants(self, node, include_self=False):
+        return self.get_tree_for(node).descendants(node, include_self=include_self)
+
+    def _fetch_rows(self, cache, key, tree_id):
+        # Stampede protection, only one process builds the tree.
+        lock_key = key + ":lock"
+        if cache.add(lock_key, 1, self.lock_timeout):
+            try:
+                rows = self._query_rows(tree_id)
+                cache.set(key, rows, self.get_timeout())
+                return rows
+            finally:
+                cache.delete(lock_key)
+
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.lock_wait)
+            rows = cache.get(key)
+            if rows is not None:
+                return rows
+            if cache.get(lock_key) is None:
+                break
+        return self._query_rows(tree_id)
+
+    def get_timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        return get_cache_timeout()
+
+    def _query_rows(self, tree_id):
+        opts = self.model._mptt_meta
+        return list(
+            self.model._default_manager.non_polymorphic()
+            .filter(**{opts.tree_id_attr: tree_id})
+            .order_by(opts.left_attr)
+            .values_list(
+                "pk",
+                opts.parent_attr + "_id",
+                "polymorphic_ctype_id",
+                opts.left_attr,
+                opts.right_attr,
+                opts.level_attr,
+                *self.fields
+            )
+        )
+
+    def _build_tree(self, tree_id):
+        return self._make_tree(tree_id, self._query_rows(tree_id))
+
+    def _make_tree(self, tree_id, rows):
+        field_names = self.fields
+        return CachedTree(
+            tree_id,
+            [
+                CachedNode(pk, parent_id, ctype_id, tree_id, lft, rght, level, dict(zip(field_names, values)))
+                for pk, parent_id, ctype_id, lft, rght, level, *values in rows
+            ],
+        )
+
+
+def _get_pk(node):
+    return node if not hasattr(node, "_meta") else node.pk
+
+
+def _is_tree_node(sender):
+    from polymorphic_tree.models import PolymorphicMPTTModel
+
+    return issubclass(sender, PolymorphicMPTTModel)
+
+
+def _node_saved(sender, instance, created, raw=False, **kwargs):
+    if raw or not _is_tree_node(sender):
+        return
+    tree_id = getattr(instance, instance._mptt_meta.tree_id_attr)
+    previous_tree_id = getattr(instance, "_tree_previous_tree_id", None)
+    changes = [_get_change("add" if created else "change", instance)]
+    if (created and getattr(instance, instance._mptt_meta.parent_attr + "_id") is None) or (
+        previous_tree_id is not None and previous_tree_id != tree_id
+    ):
+        # A new tree, or a node that moved to another tree, which could shift the other tree ids.
+        bump_version(sender, changes=changes)
+    else:
+        bump_version(sender, [tree_id], changes=changes)
+
+
+def _node_deleted(sender, instance, **kwargs):
+    if _is_tree_node(sender):
+        bump_version(
+            sender, [getattr(instance, instance._mptt_meta.tree_id_attr)], changes=[_get_change("delete", instance)]
+        )
+
+
+def _node_moved(sender, instance, **kwargs):
+    if not _is_tree_node(sender):
+        return
+    tree_id = getattr(instance, instance._mptt_meta.tree_id_attr)
+    changes = [_get_change("move", instance)]
+    if getattr(instance, "_tree_previous_tree_id", None) == tree_id:
+        bump_version(sender, [tree_id], changes=changes)
+    else:
+        # Moving to another tree can shift the other tree ids.
+        bump_version(sender, changes=changes)
+
+
+def connect_signals():
+    """
+    Connect the signals that mark the cached trees as outdated. This is done when the app is ready.
+    The save and delete signals are connected per tree model, as a ``post_delete`` receiver for all models
+    would prevent the fast deletes of every other model in the project.
+    """
+    for model in apps.get_models():
+        if not _is_tree_node(model):
+            continue
+        dispatch_uid = "polymorphic_tree.cache.{}".format(model._meta.label_lower)
+        post_save.connect(_node_saved, sender=model, dispatch_uid=dispatch_uid + ".node_saved")
+        post_delete.connect(_node_deleted, sender=model, dispatch_uid=dispatch_uid + ".node_deleted")
+    node_moved.connect(_node_moved, dispatch_uid="polymorphic_tree.cache.node_moved")
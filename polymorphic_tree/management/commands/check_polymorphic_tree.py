@@ -0,0 +1,75 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from polymorphic_tree.models import PolymorphicMPTTModel
+
+
+class Command(BaseCommand):
+    """
+    Check whether all existing nodes still follow the tree rules.
+    """
+
+    help = (
+        "Check whether all parent/child pairs follow the child_types, can_have_children and can_be_root rules. "
+        "This streams the table, so it can be used on large tables."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "models",
+            nargs="*",
+            metavar="app_label.ModelName",
+            help="The base models of the trees to check, by default all trees are checked.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=2000,
+            help="The number of rows to fetch at once.",
+        )
+
+    def handle(self, *args, **options):
+        tree_models = self._get_tree_models(options["models"])
+        total = 0
+        for model in tree_models:
+            count = 0
+            for violation in model._default_manager.check_tree_rules(chunk_size=options["chunk_size"]):
+                count += 1
+                self.stdout.write(
+                    "{}.{} #{}: {} (parent={}, ctype={})".format(
+                        model._meta.app_label,
+                        model._meta.object_name,
+                        violation.pk,
+                        violation.message,
+                        violation.parent_id,
+                        violation.ctype_id,
+                    )
+                )
+
+            if options["verbosity"] >= 1:
+                self.stderr.write(
+                    "{}.{}: {} invalid nodes found.".format(model._meta.app_label, model._meta.object_name, count)
+                )
+            total += count
+
+        if total:
+            raise CommandError("{} nodes do not follow the tree rules.".format(total))
+
+    def _get_tree_models(self, labels):
+        if labels:
+            try:
+                models = [apps.get_model(label) for label in labels]
+            except (LookupError, ValueError) as e:
+                raise CommandError(str(e))
+
+            for model in models:
+                if not issubclass(model, PolymorphicMPTTModel):
+                    raise CommandError("{} is not a polymorphic tree model.".format(model._meta.label))
+            return sorted({model._tree_manager.tree_model for model in models}, key=lambda model: model._meta.label)
+
+        # Only check the base models, that hold the tree fields.
+        return [
+            model
+            for model in apps.get_models()
+            if issubclass(model, PolymorphicMPTTModel) and model._tree_manager.tree_model is model
+        ]
@@ -1,23 +1,169 @@
 """
 The manager class for the CMS models
 """
+import threading
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, models, transaction
+from django.utils.translation import gettext_lazy as _
+from mptt.exceptions import InvalidMove
 from mptt.managers import TreeManager
 from mptt.querysets import TreeQuerySet
+from mptt.signals import node_moved
 from polymorphic.managers import PolymorphicManager
 from polymorphic.query import PolymorphicQuerySet
 
+from polymorphic_tree.cache import TreeChange, bump_version
+from polymorphic_tree.paths import (
+    PATH_SEPARATOR,
+    _check_path_length,
+    _set_inserted_paths,
+    get_child_path,
+    get_path_field,
+)
+from polymorphic_tree.registry import node_type_registry
+from polymorphic_tree.skeleton import NodePosition, TreeSkeleton
+
+#: A node that doesn't follow the tree rules, as reported by :func:`PolymorphicMPTTModelManager.check_tree_rules`.
+TreeRuleViolation = namedtuple("TreeRuleViolation", ("pk", "parent_id", "ctype_id", "code", "message"))
+
+TREE_RULE_MESSAGES = {
+    "required": _("This node type should have a parent."),
+    "no_children_allowed": _("The parent cannot have child nodes."),
+    "child_not_allowed": _("The parent cannot have this node type as a child."),
+    "invalid_parent": _("The parent does not match the tree structure."),
+}
+
+# The tree models that are inside a delay_tree_updates() block, per thread.
+_deferred_updates = threading.local()
+
 
 class PolymorphicMPTTQuerySet(TreeQuerySet, PolymorphicQuerySet):
     """
     Base class for querysets
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tree_prefetch_lookups = []
+
+    def _clone(self, *args, **kwargs):
+        # Django's _clone only copies its own variables, so we need to copy ours here
+        new = super()._clone(*args, **kwargs)
+        new._tree_prefetch_lookups = self._tree_prefetch_lookups[:]
+        return new
+
+    def _fetch_all(self):
+        is_new = self._result_cache is None
+        super()._fetch_all()
+        if is_new and self._tree_prefetch_lookups and self._result_cache:
+            if isinstance(self._result_cache[0], models.Model):
+                for lookup in self._tree_prefetch_lookups:
+                    lookup(self._result_cache)
+
     def toplevel(self):
         """
         Return all nodes which have no parent.
         """
         return self.filter(parent__isnull=True)
 
+    def ancestors_map(self, include_self=False, ascending=False):
+        """
+        Return a dictionary of all ancestors for each node in the queryset, keyed by primary key.
+        This performs a single query per ``tree_id``, instead of calling ``get_ancestors()`` for every node.
+        """
+        nodes = list(self)
+        return {
+            node.pk: ancestors
+            for node, ancestors in _get_ancestors(nodes, include_self=include_self, ascending=ascending)
+        }
+
+    def with_closest_ancestor_of_type(self, model, include_self=False, to_attr=None):
+        """
+        Attach the closest ancestor of a given type to every node once the queryset is fetched.
+        This is the bulk version of ``get_closest_ancestor_of_type()``, that performs a single query per ``tree_id``.
+
+        :param to_attr: The attribute to store the ancestor in, defaults to ``closest_<model_name>``.
+        """
+        to_attr = to_attr or "closest_{}".format(model._meta.model_name)
+
+        def _attach(nodes):
+            for node, ancestors in _get_ancestors(nodes, model=model, include_self=include_self, ascending=True):
+                if include_self and isinstance(node, model):
+                    setattr(node, to_attr, node)
+                else:
+                    setattr(node, to_attr, ancestors[0] if ancestors else None)
+
+        new = self._clone()
+        new._tree_prefetch_lookups.append(_attach)
+        return new
+
+    def with_descendant_counts(self, *models, to_attr="descendant_counts"):
+        """
+        Attach the number of descendants per node type to every node once the queryset is fetched.
+        The counts are a dictionary keyed by content type id, e.g. ``node.descendant_counts[ctype.id]``.
+        They are calculated with a single grouped query that joins the table with itself on the ``lft`` range.
+
+        :param models: Only count these node types.
+        :param to_attr: The attribute to store the counts in.
+        """
+        ctype_ids = None
+        if models:
+            ctype_ids = [node_type_registry.get_for_model(model).ctype_id for model in models]
+
+        def _attach(nodes):
+            counts = _get_descendant_counts(self.model._tree_manager.tree_model, nodes, ctype_ids, using=self.db)
+            for node in nodes:
+                setattr(node, to_attr, counts.get(node.pk, {}))
+
+        new = self._clone()
+        new._tree_prefetch_lookups.append(_attach)
+        return new
+
+    def get_cached_polymorphic_trees(self):
+        """
+        Return the top-level nodes of the queryset, with the children and parent of every node cached,
+        like mptt's ``get_cached_trees()`` does.
+
+        The nodes are fetched once in tree order, and converted to the real models with a single query per node type.
+        After that, the trees can be walked with ``get_children()``, ``parent`` and ``get_ancestors()``
+        without any further queries.
+        """
+        opts = self.model._mptt_meta
+        return cache_tree_nodes(list(self.order_by(opts.tree_id_attr, opts.left_attr)))
+
+    def ancestors_by_path(self, node, include_self=False):
+        """
+        Return the ancestors of a node, with a primary key lookup on the materialized path of the node.
+        This requires a :class:`~polymorphic_tree.paths.TreePathField` on the model.
+        """
+        pks = node.get_ancestor_pks()
+        if include_self:
+            pks.append(node.pk)
+        return self.filter(pk__in=pks).order_by(self.model._mptt_meta.level_attr)
+
+    def descendants_by_path(self, node, include_self=False, max_depth=None):
+        """
+        Return the descendants of a node, with an indexed prefix lookup on the materialized path.
+        This requires a :class:`~polymorphic_tree.paths.TreePathField` on the model.
+
+        :param max_depth: The number of levels below the node to include, e.g. ``1`` for the children only.
+        """
+        path_field = _get_required_path_field(self.model)
+        path = get_child_path(getattr(node, path_field.attname), node.pk)
+        condition = models.Q(**{path_field.attname + "__startswith": path})
+        if include_self:
+            condition |= models.Q(pk=node.pk)
+
+        queryset = self.filter(condition)
+        if max_depth is not None:
+            level_attr = self.model._mptt_meta.level_attr
+            queryset = queryset.filter(**{level_attr + "__lte": getattr(node, level_attr) + max_depth})
+        return queryset
+
     def as_manager(cls):
         # Make sure this way of creating managers works.
         manager = PolymorphicMPTTModelManager.from_queryset(cls)()
@@ -43,6 +189,95 @@ class PolymorphicMPTTModelManager(TreeManager, PolymorphicManager):
         # Calling .all() is equivalent to .get_queryset()
         return self.all().toplevel()
 
+    def with_descendant_counts(self, *models, to_attr="descendant_counts"):
+        """
+        Attach the number of descendants per node type to every node once the queryset is fetched.
+        """
+        return self.all().with_descendant_counts(*models, to_attr=to_attr)
+
+    def get_cached_polymorphic_trees(self):
+        """
+        Return the top-level nodes, with the children and parent of every node cached.
+        """
+        return self.all().get_cached_polymorphic_trees()
+
+    def ancestors_map(self, include_self=False, ascending=False):
+        """
+        Return a dictionary of all ancestors for each node, keyed by primary key.
+        """
+        return self.all().ancestors_map(include_self=include_self, ascending=ascending)
+
+    def with_closest_ancestor_of_type(self, model, include_self=False, to_attr=None):
+        """
+        Attach the closest ancestor of a given type to every node once the queryset is fetched.
+        """
+        return self.all().with_closest_ancestor_of_type(model, include_self=include_self, to_attr=to_attr)
+
+    def ancestors_by_path(self, node, include_self=False):
+        """
+        Return the ancestors of a node, using the materialized path.
+        """
+        return self.all().ancestors_by_path(node, include_self=include_self)
+
+    def descendants_by_path(self, node, include_self=False, max_depth=None):
+        """
+        Return the descendants of a node, using the materialized path.
+        """
+        return self.all().descendants_by_path(node, include_self=include_self, max_depth=max_depth)
+
+    def rebuild_paths(self, batch_size=1000, **filters):
+        """
+        Recalculate the materialized path of all nodes, e.g. after adding the
+        :class:`~polymorphic_tree.paths.TreePathField` to an existing table, or after a ``rebuild()``.
+        The table is streamed in ``(tree_id, lft)`` order, and only the changed paths are written.
+
+        :returns: The number of updated nodes.
+        """
+        path_field = _get_required_path_field(self.model)
+        opts = self.model._mptt_meta
+        queryset = (
+            self.tree_model._default_manager.db_manager(self.db)
+            .non_polymorphic()
+            .filter(**filters)
+            .order_by(opts.tree_id_attr, opts.left_attr)
+            .values_list("pk", opts.parent_attr + "_id", path_field.attname)
+        )
+
+        stack = []  # The (pk, children path) of the ancestors of the current node
+        changed = []
+        count = 0
+        with transaction.atomic(using=self.db):
+            for pk, parent_id, old_path in queryset.iterator(chunk_size=batch_size):
+                while stack and stack[-1][0] != parent_id:
+                    stack.pop()
+
+                path = stack[-1][1] if stack else PATH_SEPARATOR
+                if parent_id is not None and not stack:
+                    # With filters, the parent might not be part of the selection.
+                    path = get_child_path(
+                        self.tree_model._default_manager.db_manager(self.db)
+                        .non_polymorphic()
+                        .values_list(path_field.attname, flat=True)
+                        .get(pk=parent_id),
+                        parent_id,
+                    )
+                _check_path_length(path_field, len(path))
+                if path != old_path:
+                    changed.append(self.tree_model(**{self.tree_model._meta.pk.attname: pk, path_field.attname: path}))
+                stack.append((pk, get_child_path(path, pk)))
+
+                if len(changed) >= batch_size:
+                    self.tree_model._base_manager.db_manager(self.db).bulk_update(changed, [path_field.name])
+                    count += len(changed)
+                    changed = []
+
+            if changed:
+                self.tree_model._base_manager.db_manager(self.db).bulk_update(changed, [path_field.name])
+                count += len(changed)
+        return count
+
+    rebuild_paths.alters_data = True
+
     def _mptt_filter(self, qs=None, **filters):
         if self._base_manager and qs is not None:
             # This is a little hack to fix get_previous_sibling() / get_next_sibling().
@@ -56,10 +291,815 @@ class PolymorphicMPTTModelManager(TreeManager, PolymorphicManager):
 
         return super()._mptt_filter(qs, **filters)
 
+    def check_tree_rules(self, chunk_size=2000, **filters):
+        """
+        Check all nodes against the ``child_types``, ``can_have_children`` and ``can_be_root`` rules.
+        This yields a :class:`TreeRuleViolation` for every node that doesn't follow the rules.
+
+        The table is streamed in ``(tree_id, lft)`` order with a server-side cursor where the database supports it,
+        and the rules are checked in memory. Only the ancestors of the current node are kept in memory.
+        Node types that define their rules as properties can't be checked this way, and are skipped.
+        """
+        opts = self.model._mptt_meta
+        queryset = (
+            self.tree_model._default_manager.db_manager(self.db)
+            .non_polymorphic()
+            .filter(**filters)
+            .order_by(opts.tree_id_attr, opts.left_attr)
+            .values_list(
+                "pk",
+                opts.parent_attr + "_id",
+                "polymorphic_ctype_id",
+                opts.tree_id_attr,
+                opts.left_attr,
+                opts.right_attr,
+            )
+        )
+
+        stack = []  # The ancestors of the current node, as (pk, ctype_id, tree_id, rght)
+        for pk, parent_id, ctype_id, tree_id, left, right in queryset.iterator(chunk_size=chunk_size):
+            while stack and (stack[-1][2] != tree_id or stack[-1][3] < left):
+                stack.pop()
+
+            code = None
+            if parent_id is None:
+                if stack:
+                    code = "invalid_parent"
+                elif _get_node_type_rule(ctype_id, "can_be_root") is False:
+                    code = "required"
+            elif not stack or stack[-1][0] != parent_id:
+                # With filters, the parent might not be part of the selection.
+                if stack or not filters:
+                    code = "invalid_parent"
+            else:
+                parent_type = node_type_registry.get_for_ctype_id(stack[-1][1])
+                if not parent_type.dynamic:
+                    if not parent_type.can_have_children:
+                        code = "no_children_allowed"
+                    elif not parent_type.is_child_allowed(ctype_id):
+                        code = "child_not_allowed"
+
+            if code is not None:
+                yield TreeRuleViolation(pk, parent_id, ctype_id, code, str(TREE_RULE_MESSAGES[code]))
+
+            stack.append((pk, ctype_id, tree_id, right))
+
+    def bulk_load(self, data, target=None, position="last-child", batch_size=1000):
+        """
+        Create a complete tree of nodes from nested data, with a few bulk inserts.
+
+        Each node is a dictionary with the field values, and the optional keys ``"model"``
+        (a model class or ``"app_label.ModelName"`` string, defaults to the manager model)
+        and ``"children"`` (a list of nodes). The ``data`` can be a single node or a list of nodes::
+
+            Node.objects.bulk_load({
+                'model': CategoryNode,
+                'title': 'Products',
+                'children': [
+                    {'model': TextNode, 'title': 'About', 'extra_text': '...'},
+                ]
+            })
+
+        The tree fields are calculated in memory, and the data is validated against the child type rules
+        before anything is written. The nodes are inserted in batches per table,
+        parent tables before child tables, inside a single transaction.
+        Like ``bulk_create()``, this doesn't call ``save()`` or send the ``pre_save`` / ``post_save`` signals.
+
+        :param target: The node to insert the data at, or ``None`` to create new trees.
+        :param position: The position relative to the ``target``. This can be ``'first-child'``,
+                         ``'last-child'``, ``'left'`` or ``'right'``.
+        :returns: The created nodes, in tree order.
+        """
+        if isinstance(data, dict):
+            data = [data]
+
+        opts = self.model._mptt_meta
+        tree_manager = self.tree_model._tree_manager
+        using = self.db
+
+        with transaction.atomic(using=using):
+            new_parent, tree_id, cursor, level = _prepare_insert(tree_manager, target, position, len(data))
+            nodes = _build_tree_nodes(self.model, data, new_parent, tree_id, cursor, level, using=using)
+
+            for node in nodes:
+                parent = getattr(node, opts.parent_attr)
+                node._validate_new_parent(parent.pk if parent is not None else None, parent)
+
+            if cursor is not None:
+                tree_manager._create_space(2 * len(nodes), cursor - 1, tree_id)
+            _bulk_insert_nodes(self.tree_model, nodes, using=using, batch_size=batch_size)
+
+        bump_version(self.tree_model)
+        if target is not None:
+            target._mptt_refresh()
+        return nodes
+
+    bulk_load.alters_data = True
+
+    def clone_subtree(self, node, target=None, position="last-child", copy_related=None, batch_size=1000):
+        """
+        Copy a node and all its descendants to a new location, with a few bulk inserts per table.
+
+        The subtree is read with a single query per node type, and the copies are inserted in batches per table,
+        parent tables before child tables. Only a single gap is opened in the target tree.
+        Like ``bulk_create()``, this doesn't call ``save()`` or send the ``pre_save`` / ``post_save`` signals.
+        Many-to-many fields and other related objects are not copied, use the ``copy_related`` hook for that.
+
+        :param node: The root of the subtree to copy.
+        :param target: The node to insert the copy at, or ``None`` to create a new tree.
+        :param position: The position relative to the ``target``. This can be ``'first-child'``,
+                         ``'last-child'``, ``'left'`` or ``'right'``.
+        :param copy_related: A function that receives the list of ``(original, copy)`` pairs
+                             after the nodes are inserted, to copy the related objects in bulk.
+        :returns: The copy of the node.
+        """
+        opts = self.model._mptt_meta
+        tree_manager = self.tree_model._tree_manager
+        using = self.db
+
+        with transaction.atomic(using=using):
+            # Read the subtree before the gap is opened, this also makes copying a node into itself possible.
+            originals = list(
+                self.tree_model._default_manager.db_manager(using)
+                .filter(
+                    **{
+                        opts.tree_id_attr: getattr(node, opts.tree_id_attr),
+                        opts.left_attr + "__gte": getattr(node, opts.left_attr),
+                        opts.left_attr + "__lt": getattr(node, opts.right_attr),
+                    }
+                )
+                .order_by(opts.left_attr)
+            )
+            if not originals or originals[0].pk != node.pk:
+                raise InvalidMove("The node has been moved or deleted in the meantime.")
+
+            new_parent, tree_id, cursor, level = _prepare_insert(tree_manager, target, position, 1)
+            left_shift = (cursor or 1) - getattr(originals[0], opts.left_attr)
+            level_shift = level - getattr(originals[0], opts.level_attr)
+
+            copies = {}
+            for original in originals:
+                parent_id = getattr(original, opts.parent_attr + "_id")
+                copy = _copy_node(original)
+                setattr(copy, opts.parent_attr, new_parent if original is originals[0] else copies[parent_id])
+                setattr(copy, opts.tree_id_attr, tree_id)
+                setattr(copy, opts.left_attr, getattr(original, opts.left_attr) + left_shift)
+                setattr(copy, opts.right_attr, getattr(original, opts.right_attr) + left_shift)
+                setattr(copy, opts.level_attr, getattr(original, opts.level_attr) + level_shift)
+                copies[original.pk] = copy
+
+            root_copy = copies[node.pk]
+            root_copy._validate_new_parent(new_parent.pk if new_parent is not None else None, new_parent)
+
+            if cursor is not None:
+                tree_manager._create_space(2 * len(originals), cursor - 1, tree_id)
+            _bulk_insert_nodes(self.tree_model, list(copies.values()), using=using, batch_size=batch_size)
+
+            if copy_related is not None:
+                copy_related([(original, copies[original.pk]) for original in originals])
+
+        bump_version(self.tree_model)
+        if target is not None:
+            target._mptt_refresh()
+        return root_copy
+
+    clone_subtree.alters_data = True
+
+    @contextmanager
+    def delay_tree_updates(self):
+        """
+        Context manager that defers the tree bookkeeping until the end of a block of mass edits.
+
+        Unlike ``delay_mptt_updates()``, moves and parent changes are still validated against the tree rules,
+        and both the old and new tree of a moved node are recorded. On exit, only the affected trees are rebuilt,
+        so the other trees in the table keep their values. The block runs inside a single transaction::
+
+            with Node.objects.delay_tree_updates():
+                for node in nodes:
+                    node.parent = new_parent
+                    node.save()
+
+        The tree fields of the nodes are not reliable until the end of the block.
+        """
+        tree_model = self.tree_model
+        tree_manager = tree_model._tree_manager
+        deferred = getattr(_deferred_updates, "tree_models", None)
+        if deferred is None:
+            deferred = _deferred_updates.tree_models = set()
+        if tree_model in deferred or tree_model._mptt_is_tracking:
+            # Nested block, the outer block rebuilds the trees.
+            deferred.add(tree_model)
+            yield
+            return
+
+        with transaction.atomic(using=self.db), tree_manager.disable_mptt_updates():
+            tree_model._mptt_start_tracking()
+            deferred.add(tree_model)
+            try:
+                yield
+            finally:
+                deferred.discard(tree_model)
+                tree_ids = tree_model._mptt_stop_tracking()
+
+            for tree_id in sorted(tree_ids):
+                tree_manager.partial_rebuild(tree_id)
+            bump_version(tree_model)
+
     def move_node(self, node, target, position="last-child"):
         """
         Move a node to a new location.
         This also performs checks whether the target allows this node to reside there.
         """
         node.validate_move(target, position=position)
-        return super().move_node(node, target, position=position)
+        if _is_deferring_updates(self.tree_model):
+            return self._move_node_deferred(node, target, position)
+
+        # Tell the cache invalidation in which tree the node was.
+        node._tree_previous_tree_id = getattr(node, self.model._mptt_meta.tree_id_attr)
+        try:
+            # The save() can still reject the move when the new paths are too long.
+            with transaction.atomic(using=node._state.db):
+                return super().move_node(node, target, position=position)
+        finally:
+            del node._tree_previous_tree_id
+
+    def _move_node_deferred(self, node, target, position):
+        # Inside delay_tree_updates(), only the new position of the node is stored,
+        # the old and new tree are rebuilt at the end of the block.
+        opts = self.model._mptt_meta
+        tree_manager = self.tree_model._tree_manager
+        descendant_pks = _get_deferred_descendant_pks(node)
+        if target is not None and (target.pk == node.pk or target.pk in set(descendant_pks)):
+            raise InvalidMove("A node may not be made a sibling or child of itself or one of its descendants.")
+
+        old_tree_id = getattr(node, opts.tree_id_attr)
+        was_root = node.is_root_node()
+        if not was_root:
+            self.tree_model._mptt_track_tree_modified(old_tree_id)
+
+        tree_manager._move_node(node, target, position=position, save=False)
+
+        # The move is already validated and placed, so save() only has to store the fields.
+        node._mptt_cached_fields[opts.parent_attr] = opts.get_raw_field_value(node, opts.parent_attr)
+        node.save()
+        _move_deferred_descendants(node, descendant_pks)
+        if was_root and not node.is_root_node():
+            # The old tree is gone, close the gap in the tree ids like save() does.
+            tree_manager._create_tree_space(old_tree_id, -1)
+            _track_collapsed_tree(self.tree_model, old_tree_id)
+
+        node_moved.send(sender=node.__class__, instance=node, target=target, position=position)
+
+    def move_nodes(self, moves):
+        """
+        Move many nodes at once, with a single update per tree.
+
+        The ``moves`` are ``(node, target, position)`` tuples, which are applied in the given order.
+        A ``target`` of ``None`` moves the node to a new tree.
+        All moves are validated before anything is written. Like ``move_to()``, the ``lft`` and ``rght``
+        ranges of the moved blocks are shifted, so each affected ``tree_id`` is written with one update.
+        The node objects are updated too.
+
+        :returns: The new :class:`~polymorphic_tree.skeleton.NodePosition` of all nodes that changed.
+        """
+        moves = list(moves)
+        if not moves:
+            return []
+
+        opts = self.model._mptt_meta
+        tree_ids = set()
+        for node, target, position in moves:
+            tree_ids.add(getattr(node, opts.tree_id_attr))
+            if target is not None:
+                tree_ids.add(getattr(target, opts.tree_id_attr))
+
+        with transaction.atomic(using=self.db):
+            skeleton = TreeSkeleton.load(self.tree_model, tree_ids, using=self.db)
+            for node, target, position in moves:
+                target_id = target.pk if target is not None else None
+                if node.pk not in skeleton or (target_id is not None and target_id not in skeleton):
+                    raise InvalidMove("The node has been moved or deleted in the meantime.")
+
+                new_parent_id = skeleton.get_new_parent_id(node.pk, target_id, position)
+                _validate_planned_parent(skeleton, node, new_parent_id, target)
+                skeleton.move(node.pk, target_id, position)
+
+            changed = skeleton.save(using=self.db)
+        bump_version(self.tree_model, changes=[TreeChange("move", *position) for position in changed])
+
+        positions = {position.pk: position for position in changed}
+        for node, target, position in moves:
+            for instance in (node, target):
+                if instance is not None and instance.pk in positions:
+                    _set_position(instance, positions[instance.pk])
+            node_moved.send(sender=node.__class__, instance=node, target=target, position=position)
+        return changed
+
+    move_nodes.alters_data = True
+
+    def reorder_children(self, parent, ordered_pks):
+        """
+        Change the order of the children of a node, with a single update.
+
+        The ``ordered_pks`` are the primary keys of all children, in the new order.
+        The ``lft`` and ``rght`` blocks of the child subtrees are swapped around, so only the nodes
+        inside the interval of the parent are updated. The descendants move along with their parent.
+
+        :returns: The new :class:`~polymorphic_tree.skeleton.NodePosition` of the children that changed.
+        """
+        opts = self.model._mptt_meta
+        tree_model = self.tree_model
+        left_attr = opts.left_attr
+        right_attr = opts.right_attr
+        with transaction.atomic(using=self.db):
+            # Read the current interval of the parent, the given object could be outdated.
+            rows = list(
+                tree_model._base_manager.db_manager(self.db)
+                .non_polymorphic()
+                .filter(models.Q(pk=parent.pk) | models.Q(**{opts.parent_attr: parent.pk}))
+                .order_by(left_attr)
+                .values_list("pk", opts.tree_id_attr, left_attr, right_attr, opts.level_attr)
+            )
+            if not rows or rows[0][0] != parent.pk:
+                raise InvalidMove("The node has been moved or deleted in the meantime.")
+            tree_id, parent_left, parent_right = rows[0][1:4]
+            children = {str(row[0]): row for row in rows[1:]}
+
+            ordered_keys = [str(pk) for pk in ordered_pks]
+            if len(ordered_keys) != len(children) or set(ordered_keys) != set(children):
+                raise ValueError("The ordered primary keys should contain all children of the node.")
+
+            # Place the blocks one after another, and find the shift of every block.
+            changed = []
+            left_shifts = []
+            right_shifts = []
+            cursor = parent_left + 1
+            for key in ordered_keys:
+                pk, child_tree_id, left, right, level = children[key]
+                shift = cursor - left
+                if shift:
+                    left_shifts.append(models.When(**{left_attr + "__range": (left, right), "then": shift}))
+                    right_shifts.append(models.When(**{right_attr + "__range": (left, right), "then": shift}))
+                    changed.append(NodePosition(pk, parent.pk, tree_id, left + shift, right + shift, level))
+                cursor += right - left + 1
+
+            if changed:
+                tree_model._base_manager.db_manager(self.db).non_polymorphic().filter(
+                    **{
+                        opts.tree_id_attr: tree_id,
+                        left_attr + "__gt": parent_left,
+                        right_attr + "__lt": parent_right,
+                    }
+                ).update(
+                    **{
+                        left_attr: models.F(left_attr)
+                        + models.Case(*left_shifts, default=0, output_field=models.IntegerField()),
+                        right_attr: models.F(right_attr)
+                        + models.Case(*right_shifts, default=0, output_field=models.IntegerField()),
+                    }
+                )
+
+        if changed:
+            bump_version(tree_model, [tree_id], changes=[TreeChange("move", *position) for position in changed])
+        changed.sort(key=lambda position: position.lft)
+        return changed
+
+    reorder_children.alters_data = True
+
+
+def cache_tree_nodes(nodes):
+    """
+    Cache the children and parent of every node in a list, and return the top-level nodes.
+
+    This is a single pass over the nodes in ``(tree_id, lft)`` order, the list is sorted when needed.
+    Nodes without a parent in the list become a top-level node. When all ancestors of a node are in the list,
+    ``get_ancestors()`` also uses the cached parents.
+    """
+    if not nodes:
+        return []
+
+    opts = nodes[0]._mptt_meta
+    tree_id_attr = opts.tree_id_attr
+    left_attr = opts.left_attr
+    right_attr = opts.right_attr
+    parent_field = nodes[0]._meta.get_field(opts.parent_attr)
+    nodes = sorted(nodes, key=lambda node: (getattr(node, tree_id_attr), getattr(node, left_attr)))
+
+    top_nodes = []
+    stack = []  # The ancestors of the current node
+    for node in nodes:
+        tree_id = getattr(node, tree_id_attr)
+        while stack and (
+            getattr(stack[-1], tree_id_attr) != tree_id or getattr(stack[-1], right_attr) < getattr(node, left_attr)
+        ):
+            stack.pop()
+
+        node._cached_children = []
+        parent = stack[-1] if stack else None
+        if parent is not None and getattr(node, parent_field.attname) == parent.pk:
+            parent._cached_children.append(node)
+            parent_field.set_cached_value(node, parent)
+            if getattr(parent, "_mptt_use_cached_ancestors", False):
+                node._mptt_use_cached_ancestors = True
+        else:
+            top_nodes.append(node)
+            if getattr(node, parent_field.attname) is None:
+                node._mptt_use_cached_ancestors = True
+        stack.append(node)
+
+    return top_nodes
+
+
+def _get_descendant_counts(tree_model, nodes, ctype_ids=None, using=None, batch_size=500):
+    """
+    Count the descendants of the nodes per content type, with a grouped range join.
+    Returns a dictionary of ``{pk: {ctype_id: count}}``.
+    """
+    connection = connections[using or "default"]
+    qn = connection.ops.quote_name
+    opts = tree_model._meta
+    mptt_opts = tree_model._mptt_meta
+    columns = {
+        "table": qn(opts.db_table),
+        "pk": qn(opts.pk.column),
+        "ctype": qn(opts.get_field("polymorphic_ctype").column),
+        "tree_id": qn(opts.get_field(mptt_opts.tree_id_attr).column),
+        "left": qn(opts.get_field(mptt_opts.left_attr).column),
+        "right": qn(opts.get_field(mptt_opts.right_attr).column),
+    }
+
+    # Leaf nodes don't need to be part of the query.
+    right_attr = mptt_opts.right_attr
+    left_attr = mptt_opts.left_attr
+    pks = [node.pk for node in nodes if getattr(node, right_attr) - getattr(node, left_attr) > 1]
+
+    counts = defaultdict(dict)
+    for start in range(0, len(pks), batch_size):
+        batch = pks[start : start + batch_size]
+        params = list(batch)
+        ctype_filter = ""
+        if ctype_ids is not None:
+            ctype_filter = " AND d.{ctype} IN ({placeholders})".format(
+                placeholders=", ".join(["%s"] * len(ctype_ids)), **columns
+            )
+            params.extend(ctype_ids)
+
+        query = """
+        SELECT a.{pk}, d.{ctype}, COUNT(*)
+        FROM {table} a
+        INNER JOIN {table} d ON (d.{tree_id} = a.{tree_id} AND d.{left} > a.{left} AND d.{left} < a.{right})
+        WHERE a.{pk} IN ({placeholders}){ctype_filter}
+        GROUP BY a.{pk}, d.{ctype}""".format(
+            placeholders=", ".join(["%s"] * len(batch)), ctype_filter=ctype_filter, **columns
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            for pk, ctype_id, count in cursor.fetchall():
+                counts[pk][ctype_id] = count
+
+    return counts
+
+
+def _get_required_path_field(model):
+    path_field = get_path_field(model)
+    if path_field is None:
+        raise ImproperlyConfigured("{} has no TreePathField.".format(model.__name__))
+    return path_field
+
+
+def _is_deferring_updates(tree_model):
+    """
+    Tell whether the tree model is inside a :func:`PolymorphicMPTTModelManager.delay_tree_updates` block.
+    """
+    return tree_model in getattr(_deferred_updates, "tree_models", ())
+
+
+def _get_deferred_descendant_pks(node):
+    """
+    Return the primary keys of the descendants of a node inside a ``delay_tree_updates()`` block.
+    The tree fields are not reliable there, so the parent links are followed one level at a time.
+    """
+    opts = node._mptt_meta
+    manager = node._tree_manager.tree_model._base_manager.db_manager(node._state.db).non_polymorphic()
+    pks = []
+    level_pks = [node.pk]
+    while level_pks:
+        level_pks = list(manager.filter(**{opts.parent_attr + "__in": level_pks}).values_list("pk", flat=True))
+        pks.extend(level_pks)
+    return pks
+
+
+def _move_deferred_descendants(node, descendant_pks):
+    """
+    Give the descendants of a node that moved inside a ``delay_tree_updates()`` block the new tree_id of the node,
+    and record the new tree so it's rebuilt at the end of the block.
+    """
+    opts = node._mptt_meta
+    tree_model = node._tree_manager.tree_model
+    tree_id = getattr(node, opts.tree_id_attr)
+    if descendant_pks:
+        tree_model._base_manager.db_manager(node._state.db).non_polymorphic().filter(pk__in=descendant_pks).update(
+            **{opts.tree_id_attr: tree_id}
+        )
+    tree_model._mptt_track_tree_modified(tree_id)
+
+
+def _track_collapsed_tree(tree_model, tree_id):
+    """
+    Update the recorded trees of a ``delay_tree_updates()`` block when the gap of a removed tree is closed,
+    as the trees after it move back one ``tree_id``.
+    """
+    tracked = tree_model._threadlocal.mptt_delayed_tree_changes
+    shifted = {other_id - 1 if other_id > tree_id else other_id for other_id in tracked if other_id != tree_id}
+    tracked.clear()
+    tracked.update(shifted)
+
+
+def _prepare_insert(tree_manager, target, position, num_trees):
+    """
+    Find the location to insert new nodes at, and make room for new trees when these are placed next to a root node.
+    Returns the ``(parent, tree_id, cursor, level)``, a ``cursor`` of ``None`` means every node becomes a new tree.
+    """
+    opts = tree_manager.tree_model._mptt_meta
+    if target is None:
+        return None, tree_manager._get_next_tree_id(), None, 0
+    elif position in ("left", "right"):
+        new_parent = getattr(target, opts.parent_attr)
+        tree_id = getattr(target, opts.tree_id_attr)
+        level = getattr(target, opts.level_attr)
+        if new_parent is None:
+            # Inserting new trees next to a root node.
+            if position == "left":
+                tree_manager._create_tree_space(tree_id - 1, num_trees)
+            else:
+                tree_manager._create_tree_space(tree_id, num_trees)
+                tree_id += 1
+            return None, tree_id, None, level
+        elif position == "left":
+            return new_parent, tree_id, getattr(target, opts.left_attr), level
+        else:
+            return new_parent, tree_id, getattr(target, opts.right_attr) + 1, level
+    elif position in ("first-child", "last-child"):
+        if position == "first-child":
+            cursor = getattr(target, opts.left_attr) + 1
+        else:
+            cursor = getattr(target, opts.right_attr)
+        return target, getattr(target, opts.tree_id_attr), cursor, getattr(target, opts.level_attr) + 1
+    else:
+        raise ValueError("invalid mptt position argument")
+
+
+def _copy_node(node):
+    """
+    Create an unsaved copy of a node, with the same field values except for the primary keys.
+    """
+    fields = [
+        field
+        for field in node._meta.concrete_fields
+        if not field.primary_key and not (field.remote_field and field.remote_field.parent_link)
+    ]
+    return node.__class__(**{field.attname: getattr(node, field.attname) for field in fields})
+
+
+def _build_tree_nodes(default_model, data, parent, tree_id, cursor, level, using):
+    """
+    Create the model instances for nested node data, with the tree fields calculated in memory.
+    When the ``cursor`` is ``None``, every node in the data becomes a new tree.
+    """
+    opts = default_model._mptt_meta
+    nodes = []
+
+    def _add_node(item, parent, tree_id, cursor, level):
+        item = dict(item)
+        children = item.pop("children", None) or ()
+        model = item.pop("model", None) or default_model
+        if isinstance(model, str):
+            model = apps.get_model(model)
+        if not issubclass(model, default_model):
+            raise ValueError("{} is not a subclass of {}".format(model.__name__, default_model.__name__))
+
+        node = model(**item)
+        node.pre_save_polymorphic(using=using)
+        setattr(node, opts.parent_attr, parent)
+        setattr(node, opts.tree_id_attr, tree_id)
+        setattr(node, opts.left_attr, cursor)
+        setattr(node, opts.level_attr, level)
+        nodes.append(node)
+
+        for child in children:
+            cursor = _add_node(child, node, tree_id, cursor + 1, level + 1)
+
+        cursor += 1
+        setattr(node, opts.right_attr, cursor)
+        return cursor
+
+    for index, item in enumerate(data):
+        if cursor is None:
+            _add_node(item, parent, tree_id + index, 1, level)
+        else:
+            cursor = _add_node(item, parent, tree_id, cursor, level) + 1
+    return nodes
+
+
+def _bulk_insert_nodes(tree_model, nodes, using, batch_size):
+    """
+    Insert new nodes of various types in batches per table.
+    The nodes should be in tree order, with their parent assigned as object.
+    """
+    opts = tree_model._mptt_meta
+    parent_attr_id = opts.parent_attr + "_id"
+    base_fields = tree_model._meta.concrete_fields
+    pk_attname = tree_model._meta.pk.attname
+
+    # The base table holds the parent relation, so insert it one level at a time.
+    # That makes the primary keys of the parents known for the next level.
+    nodes_per_level = defaultdict(list)
+    for node in nodes:
+        nodes_per_level[getattr(node, opts.level_attr)].append(node)
+
+    for level in sorted(nodes_per_level):
+        level_nodes = nodes_per_level[level]
+        base_objects = []
+        _set_inserted_paths(tree_model, level_nodes, using)
+        for node in level_nodes:
+            parent = getattr(node, opts.parent_attr)
+            if parent is not None:
+                setattr(node, parent_attr_id, getattr(parent, pk_attname))
+            base_objects.append(tree_model(**{f.attname: getattr(node, f.attname) for f in base_fields}))
+
+        tree_model._base_manager.db_manager(using).bulk_create(base_objects, batch_size=batch_size)
+        if any(obj.pk is None for obj in base_objects):
+            _fetch_inserted_pks(tree_model, base_objects, using)
+
+        for node, base_object in zip(level_nodes, base_objects):
+            setattr(node, pk_attname, base_object.pk)
+
+    # The derived tables, parent tables before child tables.
+    nodes_per_table = defaultdict(list)
+    for node in nodes:
+        concrete_model = node._meta.concrete_model
+        for model in reversed([concrete_model] + concrete_model._meta.get_parent_list()):
+            if model is tree_model or not issubclass(model, tree_model):
+                continue
+            for parent_link in model._meta.parents.values():
+                if parent_link is not None:
+                    setattr(node, parent_link.attname, getattr(node, pk_attname))
+            nodes_per_table[model].append(node)
+
+    for model in sorted(nodes_per_table, key=lambda model: len(model._meta.get_parent_list())):
+        table_nodes = nodes_per_table[model]
+        fields = model._meta.local_concrete_fields
+        ops = connections[using].ops
+        table_batch_size = min(batch_size, max(ops.bulk_batch_size(fields, table_nodes), 1))
+        for start in range(0, len(table_nodes), table_batch_size):
+            model._base_manager._insert(table_nodes[start : start + table_batch_size], fields=fields, using=using)
+
+    for node in nodes:
+        node._state.adding = False
+        node._state.db = using
+        # A later save() compares with these values to detect moves.
+        opts.update_mptt_cached_fields(node)
+
+
+def _fetch_inserted_pks(tree_model, objects, using):
+    """
+    Read back the primary keys, for databases that can't return them from a bulk insert.
+    The ``tree_id`` and ``lft`` combination is unique, so these identify the new rows.
+    """
+    opts = tree_model._mptt_meta
+    objects_per_tree = defaultdict(dict)
+    for obj in objects:
+        objects_per_tree[getattr(obj, opts.tree_id_attr)][getattr(obj, opts.left_attr)] = obj
+
+    for tree_id, objects_by_left in objects_per_tree.items():
+        rows = (
+            tree_model._base_manager.db_manager(using)
+            .non_polymorphic()
+            .filter(**{opts.tree_id_attr: tree_id, opts.left_attr + "__in": list(objects_by_left)})
+            .values_list(opts.left_attr, "pk")
+        )
+        for left, pk in rows:
+            objects_by_left[left].pk = pk
+
+
+def _validate_planned_parent(skeleton, node, new_parent_id, target):
+    """
+    Validate the new parent of a node, using the content types of the planned structure.
+    """
+    if new_parent_id is None:
+        node._validate_new_parent(None)
+    else:
+        parent_type = node_type_registry.get_for_ctype_id(skeleton.ctypes[new_parent_id])
+        node.pre_save_polymorphic()
+        if parent_type.dynamic or not parent_type.is_child_allowed(node.polymorphic_ctype_id):
+            # Let the model report the error, or check the dynamic rules.
+            parent = target if target is not None and target.pk == new_parent_id else None
+            node._validate_new_parent(new_parent_id, parent)
+
+    # Allow custom validation, this only fetches the parent when it's needed.
+    from polymorphic_tree.models import PolymorphicMPTTModel
+
+    if type(node).validate_move_to is not PolymorphicMPTTModel.validate_move_to:
+        if new_parent_id is None:
+            parent = None
+        elif target is not None and target.pk == new_parent_id:
+            parent = target
+        else:
+            parent = skeleton.tree_model._default_manager.get(pk=new_parent_id)
+        node.validate_move_to(parent)
+
+
+def _set_position(node, position):
+    opts = node._mptt_meta
+    setattr(node, opts.parent_attr + "_id", position.parent_id)
+    setattr(node, opts.tree_id_attr, position.tree_id)
+    setattr(node, opts.left_attr, position.lft)
+    setattr(node, opts.right_attr, position.rght)
+    setattr(node, opts.level_attr, position.level)
+
+
+def _get_node_type_rule(ctype_id, name):
+    """
+    Read a rule of the node type, ``None`` when it can only be determined by the instance.
+    """
+    node_type = node_type_registry.get_for_ctype_id(ctype_id)
+    return None if node_type.dynamic else getattr(node_type, name)
+
+
+def _get_ancestors(nodes, model=None, include_self=False, ascending=False, batch_size=250):
+    """
+    Find the ancestors of all nodes, with a single query per ``tree_id``.
+    Yields a tuple of the node and its ancestors.
+
+    The siblings share their ancestors, so the query has a condition per parent.
+    Trees with more than ``batch_size`` parents are split in multiple queries,
+    as databases like SQLite limit the size of the conditions.
+    """
+    if not nodes:
+        return
+
+    opts = nodes[0]._mptt_meta
+    tree_model = nodes[0]._tree_manager.tree_model
+    queryset = tree_model._default_manager.db_manager(nodes[0]._state.db).all()
+    if model is not None:
+        queryset = queryset.instance_of(model)
+
+    nodes_per_tree = defaultdict(list)
+    for node in nodes:
+        nodes_per_tree[getattr(node, opts.tree_id_attr)].append(node)
+
+    left_op, right_op = ("lte", "gte") if include_self else ("lt", "gt")
+    left_lookup = "{}__{}".format(opts.left_attr, left_op)
+    right_lookup = "{}__{}".format(opts.right_attr, right_op)
+    for tree_id, tree_nodes in nodes_per_tree.items():
+        tree_nodes.sort(key=lambda node: getattr(node, opts.left_attr))
+
+        # Only fetch the nodes that enclose one of the given nodes.
+        # Nodes enclose all siblings when they enclose the first and last sibling.
+        ranges = {}
+        for node in tree_nodes:
+            key = node.pk if include_self else getattr(node, opts.parent_attr + "_id")
+            if key is None:
+                continue  # Root nodes have no ancestors.
+            left = getattr(node, opts.left_attr)
+            right = getattr(node, opts.right_attr)
+            if key in ranges:
+                left = min(left, ranges[key][0])
+                right = max(right, ranges[key][1])
+            ranges[key] = (left, right)
+
+        ranges = sorted(set(ranges.values()))
+        candidates = {}
+        for start in range(0, len(ranges), batch_size):
+            condition = models.Q()
+            for left, right in ranges[start : start + batch_size]:
+                condition |= models.Q(**{left_lookup: left, right_lookup: right})
+            for candidate in queryset.filter(condition, **{opts.tree_id_attr: tree_id}):
+                candidates[candidate.pk] = candidate
+        candidates = sorted(candidates.values(), key=lambda candidate: getattr(candidate, opts.left_attr))
+
+        # Sweep through both lists in lft order.
+        # As the intervals are nested, the stack holds the ancestors of the current node
+        # once the nodes that end before the next interval are removed.
+        candidates = iter(candidates)
+        candidate = next(candidates, None)
+        stack = []
+        for node in tree_nodes:
+            left = getattr(node, opts.left_attr)
+            while candidate is not None and (
+                getattr(candidate, opts.left_attr) <= left
+                if include_self
+                else getattr(candidate, opts.left_attr) < left
+            ):
+                candidate_left = getattr(candidate, opts.left_attr)
+                while stack and getattr(stack[-1], opts.right_attr) < candidate_left:
+                    stack.pop()
+                stack.append(candidate)
+                candidate = next(candidates, None)
+            while stack and getattr(stack[-1], opts.right_attr) < left:
+                stack.pop()
+
+            ancestors = stack[:]
+            if ascending:
+                ancestors.reverse()
+            yield node, ancestors
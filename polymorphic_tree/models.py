@@ -3,7 +3,6 @@ Model that inherits from both Polymorphic and MPTT.
 """
 import uuid
 
-from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.utils.encoding import force_str
 from django.utils.translation import gettext
@@ -13,7 +12,16 @@ from mptt.models import MPTTModel, MPTTModelBase, TreeForeignKey, raise_if_unsav
 from polymorphic.base import PolymorphicModelBase
 from polymorphic.models import PolymorphicModel
 
-from polymorphic_tree.managers import PolymorphicMPTTModelManager
+from polymorphic_tree.managers import (
+    PolymorphicMPTTModelManager,
+    _get_deferred_descendant_pks,
+    _get_required_path_field,
+    _is_deferring_updates,
+    _move_deferred_descendants,
+    _track_collapsed_tree,
+)
+from polymorphic_tree.paths import TreePathField, _update_node_path, _update_subtree_paths, get_path_field, get_path_pks
+from polymorphic_tree.registry import node_type_registry
 
 
 def _get_base_polymorphic_model(ChildModel):
@@ -59,17 +67,18 @@ class PolymorphicTreeForeignKey(TreeForeignKey):
             # because clean() is not called for empty values.
             return
         elif isinstance(parent, int) or isinstance(parent, uuid.UUID):
-            # TODO: Improve this code, it's a bit of a hack now because the base model is not known in the NodeTypePool.
-            base_model = _get_base_polymorphic_model(model_instance.__class__)
-            parent = base_model.objects.get(pk=parent)
-        elif not isinstance(parent, PolymorphicMPTTModel):
+            # Only the node type of the parent is needed, avoid fetching the parent object.
+            error = _get_parent_type_error(model_instance, parent)
+        elif isinstance(parent, PolymorphicMPTTModel):
+            error = _get_parent_type_error(model_instance, parent.pk, parent=parent)
+        else:
             raise ValueError("Unknown parent value")
 
-        if not parent.can_have_children:
-            raise ValidationError(self.error_messages["no_children_allowed"])
+        if error:
+            raise ValidationError(self.error_messages[error])
 
-        if not parent.is_child_allowed(model_instance):
-            raise ValidationError(self.error_messages["child_not_allowed"])
+        # Avoid validating the same parent again in PolymorphicMPTTModel.clean()
+        model_instance._tree_validated_parent = parent.pk if isinstance(parent, PolymorphicMPTTModel) else parent
 
 
 class PolymorphicMPTTModel(MPTTModel, PolymorphicModel, metaclass=PolymorphicMPTTModelBase):
@@ -86,9 +95,8 @@ class PolymorphicMPTTModel(MPTTModel, PolymorphicModel, metaclass=PolymorphicMPT
     #: Allowed child types for this page.
     child_types = []
 
-    # Cache child types using a class variable to ensure that get_child_types
-    # is run once per page class, per django initiation.
-    __child_types = {}
+    # The parent that PolymorphicTreeForeignKey.clean() already validated.
+    _tree_validated_parent = None
 
     # Django fields
     objects = PolymorphicMPTTModelManager()
@@ -101,50 +109,25 @@ class PolymorphicMPTTModel(MPTTModel, PolymorphicModel, metaclass=PolymorphicMPT
         )
         base_manager_name = "objects"
 
-    @property
-    def page_key(self):
+    def get_node_type(self):
         """
-        A unique key for this page to ensure get_child_types is run once per
-        page.
+        Return the resolved tree rules of this node type, see :class:`~polymorphic_tree.registry.NodeType`.
         """
-        return repr(self)
+        return node_type_registry.get_for_instance(self)
 
     def get_child_types(self):
         """
         Get the allowed child types and convert them into content type ids.
         This allows for the lookup of allowed children in the admin tree.
         """
-        key = self.page_key
-        child_types = self._PolymorphicMPTTModel__child_types
+        node_type = self.get_node_type()
+        if not node_type.dynamic:
+            return list(node_type.child_types)
+
+        # The rules are defined as properties, so they can only be resolved per instance.
         if not self.can_have_children:
             return []
-
-        if child_types.get(key, None) is None:
-            new_children = []
-            iterator = iter(self.child_types)
-            for child in iterator:
-                if isinstance(child, str):
-                    child = str(child).lower()
-                    # write self to refer to self
-                    if child == "self":
-                        ct_id = self.polymorphic_ctype_id
-                    else:
-                        # either the name of a model in this app
-                        # or the full app.model dot string
-                        # just like a foreign key
-                        try:
-                            app_label, model = child.rsplit(".", 1)
-                        except ValueError:
-                            app_label = self._meta.app_label
-                            model = child
-                        ct_id = ContentType.objects.get_by_natural_key(app_label, model).id
-                else:
-                    # pass in a model class
-                    ct_id = ContentType.objects.get_for_model(child).id
-                new_children.append(ct_id)
-            child_types[key] = new_children
-
-        return child_types[key]
+        return node_type_registry.resolve_child_types(self.__class__, self.child_types)
 
     # Define:
     # parent = PolymorphicTreeForeignKey('self', blank=True, null=True, related_name='children', verbose_name=_('parent'),
@@ -176,15 +159,18 @@ class PolymorphicMPTTModel(MPTTModel, PolymorphicModel, metaclass=PolymorphicMPT
         """
         Tell whether this node allows the given node as child.
         """
-        if not self.can_have_children:
-            return False
-
-        child_types = self.get_child_types()
-
         # this allows tree validation to occur in the event the child model is not
         # yet created in db (ie. when django admin tries to validate)
         child.pre_save_polymorphic()
 
+        node_type = self.get_node_type()
+        if not node_type.dynamic:
+            return node_type.is_child_allowed(child.polymorphic_ctype_id)
+
+        if not self.can_have_children:
+            return False
+
+        child_types = self.get_child_types()
         return not child_types or child.polymorphic_ctype_id in child_types
 
     def validate_move(self, target, position="first-child"):
@@ -196,28 +182,42 @@ class PolymorphicMPTTModel(MPTTModel, PolymorphicModel, metaclass=PolymorphicMPT
         :param position: The relative position to the target. This can be ``'first-child'``,
                          ``'last-child'``, ``'left'`` or ``'right'``.
         """
-        new_parent = _get_new_parent(self, target, position)
+        new_parent_id = _get_new_parent_id(self, target, position)
+        self._validate_new_parent(new_parent_id, target if target is not None and target.pk == new_parent_id else None)
 
-        if new_parent is None:
-            if not self.can_be_root:
+        # Allow custom validation, this only fetches the parent when it's needed.
+        if type(self).validate_move_to is not PolymorphicMPTTModel.validate_move_to:
+            self.validate_move_to(_get_new_parent(self, target, position))
+
+    def _validate_new_parent(self, parent_id, parent=None):
+        """
+        Validate the node type rules for a new parent.
+        When only the ``parent_id`` is given, the parent is only fetched to report errors.
+        """
+        if parent_id is None and parent is None:
+            if not _get_rule(self, "can_be_root"):
                 raise InvalidMove(gettext("This node type should have a parent."))
-        else:
-            if not new_parent.can_have_children:
-                raise InvalidMove(
-                    gettext(
-                        "Cannot place \u2018{0}\u2019 below \u2018{1}\u2019; a {2} does not allow children!"
-                    ).format(self, new_parent, new_parent._meta.verbose_name)
-                )
+            return
 
-            if not new_parent.is_child_allowed(self):
-                raise InvalidMove(
-                    gettext(
-                        "Cannot place \u2018{0}\u2019 below \u2018{1}\u2019; a {2} does not allow {3} as a child!"
-                    ).format(self, target, target._meta.verbose_name, self._meta.verbose_name)
-                )
+        error = _get_parent_type_error(self, parent_id, parent=parent)
+        if error is None:
+            return
+
+        if parent is None:
+            parent = _get_base_polymorphic_model(self.__class__).objects.get(pk=parent_id)
 
-        # Allow custom validation
-        self.validate_move_to(new_parent)
+        if error == "no_children_allowed":
+            raise InvalidMove(
+                gettext("Cannot place \u2018{0}\u2019 below \u2018{1}\u2019; a {2} does not allow children!").format(
+                    self, parent, parent._meta.verbose_name
+                )
+            )
+        else:
+            raise InvalidMove(
+                gettext(
+                    "Cannot place \u2018{0}\u2019 below \u2018{1}\u2019; a {2} does not allow {3} as a child!"
+                ).format(self, parent, parent._meta.verbose_name, self._meta.verbose_name)
+            )
 
     def validate_move_to(self, new_parent):
         """
@@ -231,19 +231,180 @@ class PolymorphicMPTTModel(MPTTModel, PolymorphicModel, metaclass=PolymorphicMPT
         ``InvalidMove`` from ``mptt.exceptions``
         """
 
+    def save(self, *args, **kwargs):
+        moved_descendant_pks = None
+        if _is_deferring_updates(self._tree_manager.tree_model):
+            moved_descendant_pks = _validate_deferred_move(self)
+
+        old_path = _update_node_path(self)
+
+        # Tell the cache invalidation in which tree the node was, unless move_node() already did.
+        track_tree = not self._state.adding and "_tree_previous_tree_id" not in self.__dict__
+        if track_tree:
+            self._tree_previous_tree_id = getattr(self, self._mptt_meta.tree_id_attr)
+        try:
+            super().save(*args, **kwargs)
+        finally:
+            if track_tree:
+                del self._tree_previous_tree_id
+
+        if moved_descendant_pks is not None:
+            _move_deferred_descendants(self, moved_descendant_pks)
+        if old_path is not None:
+            _update_subtree_paths(self, old_path, using=self._state.db)
+
+    save.alters_data = True
+
+    def _get_user_field_names(self):
+        # The tree path is updated like the other tree fields, a save() shouldn't write an outdated value.
+        field_names = super()._get_user_field_names()
+        path_field = get_path_field(self.__class__)
+        if path_field is not None:
+            field_names.remove(path_field.name)
+        return field_names
+
+    def get_ancestor_pks(self):
+        """
+        Return the primary keys of the ancestors, from the root to the parent.
+        This reads the :class:`~polymorphic_tree.paths.TreePathField`, so it doesn't perform a query.
+        """
+        path_field = _get_required_path_field(self.__class__)
+        pk_field = self._tree_manager.tree_model._meta.pk
+        return [pk_field.to_python(pk) for pk in get_path_pks(getattr(self, path_field.attname))]
+
     def clean(self):
         super().clean()
 
         try:
             # Make sure form validation also reports choosing a wrong parent.
-            # This also updates what PolymorphicTreeForeignKey already does.
+            # When PolymorphicTreeForeignKey already validated the parent, this is not repeated.
             parent_id = getattr(self, self._mptt_meta.parent_attr + "_id")
-            parent = getattr(self, self._mptt_meta.parent_attr) if parent_id else None
-            self.validate_move(parent)
+            if parent_id is None or parent_id != self._tree_validated_parent:
+                self._validate_new_parent(parent_id)
+
+            # Only fetch the parent for custom validation.
+            if type(self).validate_move_to is not PolymorphicMPTTModel.validate_move_to:
+                parent = getattr(self, self._mptt_meta.parent_attr) if parent_id else None
+                self.validate_move_to(parent)
         except InvalidMove as e:
             raise ValidationError({self._mptt_meta.parent_attr: force_str(e)})
 
 
+def _get_parent_type_error(node, parent_id, parent=None):
+    """
+    Check whether the parent node type allows the node as child.
+    This only needs the content type of the parent, which is read from the parent object when it's available,
+    or fetched with a single narrow query. Returns the error code, or ``None`` when the parent is allowed.
+    """
+    # this allows tree validation to occur in the event the child model is not
+    # yet created in db (ie. when django admin tries to validate)
+    node.pre_save_polymorphic()
+
+    parent_field = node._meta.get_field(node._mptt_meta.parent_attr)
+    if parent is None and parent_field.is_cached(node):
+        parent = parent_field.get_cached_value(node)
+        if parent is not None and parent.pk != parent_id:
+            parent = None
+
+    if parent is not None:
+        parent_ctype_id = parent.polymorphic_ctype_id
+    else:
+        base_model = _get_base_polymorphic_model(node.__class__)
+        parent_ctype_id = (
+            base_model.objects.non_polymorphic()
+            .filter(pk=parent_id)
+            .values_list("polymorphic_ctype_id", flat=True)
+            .first()
+        )
+        if parent_ctype_id is None:
+            return None  # The foreign key validation reports this.
+
+    parent_type = node_type_registry.get_for_ctype_id(parent_ctype_id)
+    if parent_type.dynamic:
+        # The rules are properties, these need the actual parent object.
+        if parent is None:
+            parent = base_model.objects.get(pk=parent_id)
+        if not parent.can_have_children:
+            return "no_children_allowed"
+        elif not parent.is_child_allowed(node):
+            return "child_not_allowed"
+    elif not parent_type.can_have_children:
+        return "no_children_allowed"
+    elif not parent_type.is_child_allowed(node.polymorphic_ctype_id):
+        return "child_not_allowed"
+    return None
+
+
+def _validate_deferred_move(node):
+    """
+    Validate a new parent inside a ``delay_tree_updates()`` block, as the tree updates of ``save()`` are skipped.
+    The current tree of a moved node is recorded, so it's rebuilt at the end of the block.
+    When a root node gets a parent, its descendants are moved to the tree of the parent,
+    as ``save()`` removes the old tree. For other nodes that move to another tree,
+    the descendants are returned, so they can follow the node after saving.
+    """
+    opts = node._mptt_meta
+    parent_id = opts.get_raw_field_value(node, opts.parent_attr)
+    if not node._state.adding and node._mptt_cached_fields.get(opts.parent_attr) == parent_id:
+        return None
+
+    if parent_id is None or parent_id != node._tree_validated_parent:
+        parent = getattr(node, opts.parent_attr) if parent_id is not None else None
+        node._validate_new_parent(parent_id, parent)
+        node.validate_move_to(parent)
+        node._tree_validated_parent = parent_id
+
+    if node._state.adding:
+        return None
+
+    descendant_pks = _get_deferred_descendant_pks(node)
+    if parent_id is not None and (parent_id == node.pk or parent_id in set(descendant_pks)):
+        raise InvalidMove(gettext("A node may not be made a child of itself or one of its descendants."))
+
+    # The tree_id of the objects could be outdated by earlier moves in the block.
+    tree_model = node._tree_manager.tree_model
+    manager = tree_model._base_manager.db_manager(node._state.db).non_polymorphic()
+    tree_ids = dict(
+        manager.filter(pk__in=[pk for pk in (node.pk, parent_id) if pk is not None]).values_list(
+            "pk", opts.tree_id_attr
+        )
+    )
+    tree_id = tree_ids[node.pk]
+    setattr(node, opts.tree_id_attr, tree_id)
+    if node._mptt_cached_fields.get(opts.parent_attr) is None:
+        parent_tree_id = tree_ids[parent_id]
+        setattr(getattr(node, opts.parent_attr), opts.tree_id_attr, parent_tree_id)
+        manager.filter(**{opts.tree_id_attr: tree_id}).update(**{opts.tree_id_attr: parent_tree_id})
+        _track_collapsed_tree(tree_model, tree_id)
+        tree_model._mptt_track_tree_modified(parent_tree_id - 1 if parent_tree_id > tree_id else parent_tree_id)
+        return None
+
+    tree_model._mptt_track_tree_modified(tree_id)
+    if parent_id is not None and tree_ids[parent_id] == tree_id:
+        return None
+    return descendant_pks
+
+
+def _get_rule(node, name):
+    """
+    Read a tree rule from the registry, or from the instance when the rules are dynamic.
+    """
+    node_type = node.get_node_type()
+    return getattr(node if node_type.dynamic else node_type, name)
+
+
+def _get_new_parent_id(moved, target, position="first-child"):
+    """
+    Find out which parent the node will reside under, without fetching the parent.
+    """
+    if position in ("first-child", "last-child"):
+        return target.pk if target is not None else None
+    elif position in ("left", "right"):
+        return getattr(target, f"{target._mptt_meta.parent_attr}_id")
+    else:
+        raise ValueError("invalid mptt position argument")
+
+
 def _get_new_parent(moved, target, position="first-child"):
     """
     Find out which parent the node will reside under.
@@ -0,0 +1,113 @@
+"""
+Pagination of tree querysets, which never cuts through a tree level when that can be avoided.
+"""
+from django.core.paginator import Paginator
+from django.db.models import Count, Q
+from django.utils.functional import cached_property
+
+__all__ = ("TreePaginator",)
+
+
+class TreePaginator(Paginator):
+    """
+    A paginator that fills every page with complete trees, up to ``per_page`` nodes.
+
+    Trees that are larger than a page are split between the sibling subtrees of the highest possible level,
+    so every page is a forest that can be rendered on its own.
+    The pages are ``(tree_id, lft)`` ranges of the queryset. Finding the page boundaries needs one grouped query,
+    and one narrow query for every tree that doesn't fit on a single page.
+    The ``orphans`` setting is not used.
+    """
+
+    @cached_property
+    def _tree_counts(self):
+        opts = self.object_list.model._mptt_meta
+        return list(
+            self.object_list.order_by(opts.tree_id_attr)
+            .values_list(opts.tree_id_attr)
+            .annotate(node_count=Count("pk"))
+            .values_list(opts.tree_id_attr, "node_count")
+        )
+
+    @cached_property
+    def _page_starts(self):
+        """
+        The ``(tree_id, lft)`` position of the first node on every page, ``lft`` is ``None`` for complete trees.
+        """
+        page_starts = []
+        free = 0
+        for tree_id, node_count in self._tree_counts:
+            if node_count > self.per_page:
+                chunks = self._split_tree(tree_id)
+            else:
+                chunks = [(None, node_count)]
+
+            for lft, chunk_count in chunks:
+                if chunk_count > free:
+                    page_starts.append((tree_id, lft))
+                    free = self.per_page
+                free -= chunk_count
+        return page_starts
+
+    def _split_tree(self, tree_id):
+        """
+        Split a large tree in chunks of at most ``per_page`` nodes, which start at the highest possible level.
+        Returns the ``(lft, node_count)`` of every chunk.
+        """
+        opts = self.object_list.model._mptt_meta
+        rows = list(
+            self.object_list.filter(**{opts.tree_id_attr: tree_id})
+            .order_by(opts.left_attr)
+            .values_list(opts.left_attr, opts.level_attr)
+        )
+
+        chunks = []
+        start = 0
+        while start < len(rows):
+            end = start + self.per_page
+            if end >= len(rows):
+                end = len(rows)
+            else:
+                # Start the next page at the last node with the lowest level,
+                # which keeps the most sibling subtrees together. Pages are filled at least halfway.
+                cut = end
+                for index in range(end - 1, start + max(1, self.per_page // 2) - 1, -1):
+                    if rows[index][1] < rows[cut][1]:
+                        cut = index
+                end = cut
+            chunks.append((rows[start][0] if start else None, end - start))
+            start = end
+        return chunks
+
+    @cached_property
+    def count(self):
+        """Return the total number of nodes, across all pages."""
+        return sum(node_count for tree_id, node_count in self._tree_counts)
+
+    @cached_property
+    def num_pages(self):
+        """Return the total number of pages."""
+        if not self._page_starts:
+            return 1 if self.allow_empty_first_page else 0
+        return len(self._page_starts)
+
+    def page(self, number):
+        """Return the :class:`~django.core.paginator.Page` with the nodes of a range of trees."""
+        number = self.validate_number(number)
+        if not self._page_starts:
+            return self._get_page(self.object_list, number, self)
+
+        opts = self.object_list.model._mptt_meta
+        object_list = self.object_list.filter(self._get_range_filter(opts, self._page_starts[number - 1], False))
+        if number < len(self._page_starts):
+            object_list = object_list.filter(self._get_range_filter(opts, self._page_starts[number], True))
+        return self._get_page(object_list, number, self)
+
+    def _get_range_filter(self, opts, position, before):
+        tree_id, lft = position
+        tree_id_attr = opts.tree_id_attr
+        if lft is None:
+            return Q(**{tree_id_attr + ("__lt" if before else "__gte"): tree_id})
+        return Q(**{tree_id_attr + ("__lt" if before else "__gt"): tree_id}) | Q(
+            **{tree_id_attr: tree_id, opts.left_attr + ("__lt" if before else "__gte"): lft}
+        )
@@ -0,0 +1,200 @@
+"""
+The optional materialized path of the tree nodes.
+
+When a model has a :class:`TreePathField`, every node stores the primary keys of its ancestors, e.g. ``/1/5/``.
+This allows to find the ancestors without a query, and to find all descendants with an indexed prefix lookup.
+"""
+from functools import lru_cache
+
+from django.db import models
+from django.db.models import Max
+from django.db.models.functions import Concat, Length, Substr
+from django.utils.translation import gettext
+from mptt.exceptions import InvalidMove
+
+__all__ = ("PATH_SEPARATOR", "TreePathField", "get_path_field", "get_child_path", "get_path_pks")
+
+PATH_SEPARATOR = "/"
+
+
+class TreePathField(models.CharField):
+    """
+    Stores the primary keys of all ancestors, for example ``/1/5/`` for a node below the nodes ``1`` and ``5``.
+    Root nodes have the path ``/``.
+
+    The path is updated by ``save()``, ``move_to()`` and the bulk operations of the manager.
+    Add the field to the model that defines the ``parent`` field::
+
+        class Node(PolymorphicMPTTModel):
+            parent = PolymorphicTreeForeignKey('self', ...)
+            path = TreePathField()
+
+    Every level takes the length of a primary key plus a separator, so the default ``max_length`` of 255 fits
+    about 35 levels with 6-digit primary keys. Paths that don't fit raise an ``InvalidMove`` error instead of
+    being truncated, use a larger ``max_length`` for deeper trees or longer primary keys.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("max_length", 255)
+        kwargs.setdefault("db_index", True)
+        kwargs.setdefault("editable", False)
+        kwargs.setdefault("default", PATH_SEPARATOR)
+        super().__init__(*args, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def get_path_field(model):
+    """
+    Return the :class:`TreePathField` of a model, or ``None`` when the model doesn't have one.
+    """
+    for field in model._meta.concrete_fields:
+        if isinstance(field, TreePathField):
+            return field
+    return None
+
+
+def get_child_path(parent_path, parent_pk):
+    """
+    Return the path of the children of a node.
+    """
+    return "{}{}{}".format(parent_path, parent_pk, PATH_SEPARATOR)
+
+
+def get_path_pks(path):
+    """
+    Return the primary keys in a path as strings, from the root to the parent.
+    """
+    return [pk for pk in path.split(PATH_SEPARATOR) if pk]
+
+
+def _get_path_parent_pk(path):
+    # The last primary key in the path, or an empty string for root nodes.
+    return path[:-1].rpartition(PATH_SEPARATOR)[2]
+
+
+def _update_node_path(node):
+    """
+    Set the path of a node before it's saved.
+    Returns the old path when the node is moved, as its descendants need to be updated after saving.
+    """
+    path_field = get_path_field(node.__class__)
+    if path_field is None:
+        return None
+
+    opts = node._mptt_meta
+    parent_id = opts.get_raw_field_value(node, opts.parent_attr)
+    path = getattr(node, path_field.attname)
+    if not node._state.adding and path and _get_path_parent_pk(path) == ("" if parent_id is None else str(parent_id)):
+        return None
+
+    # Read the paths from the database, the node objects might not be up to date after other moves.
+    lookup_pks = [pk for pk in (parent_id, None if node._state.adding else node.pk) if pk is not None]
+    paths = {}
+    if lookup_pks:
+        paths = dict(
+            node._tree_manager.tree_model._base_manager.db_manager(node._state.db)
+            .non_polymorphic()
+            .filter(pk__in=lookup_pks)
+            .values_list("pk", path_field.attname)
+        )
+
+    new_path = PATH_SEPARATOR if parent_id is None else get_child_path(paths.get(parent_id, PATH_SEPARATOR), parent_id)
+    _check_path_length(path_field, len(new_path))
+    setattr(node, path_field.attname, new_path)
+
+    old_path = paths.get(node.pk) if not node._state.adding else None
+    if old_path is None or old_path == new_path:
+        return None
+    _check_subtree_path_length(node._tree_manager.tree_model, node.pk, old_path, new_path, using=node._state.db)
+    return old_path
+
+
+def _check_path_length(path_field, length):
+    """
+    Raise an error when a path doesn't fit in the field, as databases either truncate it or fail when saving.
+    """
+    if path_field.max_length is not None and length > path_field.max_length:
+        raise InvalidMove(
+            gettext("The tree is too deep for the {0} field, a path needs {1} characters but it allows {2}.").format(
+                path_field.name, length, path_field.max_length
+            )
+        )
+
+
+def _check_subtree_path_length(tree_model, pk, old_path, new_path, using=None):
+    """
+    Check whether the paths of the descendants still fit in the field when a node moves to a longer path.
+    """
+    if len(new_path) <= len(old_path):
+        return
+    path_field = get_path_field(tree_model)
+    longest = (
+        tree_model._base_manager.db_manager(using)
+        .non_polymorphic()
+        .filter(**{path_field.attname + "__startswith": get_child_path(old_path, pk)})
+        .aggregate(longest=Max(Length(path_field.attname)))["longest"]
+    )
+    if longest is not None:
+        _check_path_length(path_field, longest - len(old_path) + len(new_path))
+
+
+def _update_subtree_paths(node, old_path, using=None):
+    """
+    Replace the path of a moved node, and the start of the path of all its descendants, with a single update.
+    The node itself is only updated when ``save()`` didn't write its new path already,
+    otherwise a new path that starts with the old one (e.g. when moving below a sibling) would be extended twice.
+    """
+    path_field = get_path_field(node.__class__)
+    tree_model = node._tree_manager.tree_model
+    _replace_subtree_paths(tree_model, node.pk, old_path, getattr(node, path_field.attname), using=using)
+
+
+def _replace_subtree_paths(tree_model, pk, old_path, new_path, using=None):
+    # The update of _update_subtree_paths(), for callers that don't have the node object.
+    attname = get_path_field(tree_model).attname
+    (
+        tree_model._base_manager.db_manager(using)
+        .non_polymorphic()
+        .filter(**{attname + "__startswith": old_path})
+        .filter(
+            models.Q(pk=pk, **{attname: old_path})
+            | models.Q(**{attname + "__startswith": get_child_path(old_path, pk)})
+        )
+        .update(**{attname: Concat(models.Value(new_path), Substr(attname, len(old_path) + 1))})
+    )
+
+
+def _set_inserted_paths(tree_model, nodes, using):
+    """
+    Set the path of new nodes, which are inserted one level at a time.
+    The parents of the given nodes should already have a primary key.
+    """
+    path_field = get_path_field(tree_model)
+    if path_field is None:
+        return
+
+    attname = path_field.attname
+    opts = tree_model._mptt_meta
+    pk_attname = tree_model._meta.pk.attname
+    parents = [getattr(node, opts.parent_attr) for node in nodes]
+    stored_parents = {
+        getattr(parent, pk_attname) for parent in parents if parent is not None and not parent._state.adding
+    }
+    stored_paths = {}
+    if stored_parents:
+        stored_paths = dict(
+            tree_model._base_manager.db_manager(using)
+            .non_polymorphic()
+            .filter(pk__in=stored_parents)
+            .values_list("pk", attname)
+        )
+
+    for node, parent in zip(nodes, parents):
+        if parent is None:
+            path = PATH_SEPARATOR
+        else:
+            parent_pk = getattr(parent, pk_attname)
+            parent_path = stored_paths[parent_pk] if parent_pk in stored_paths else getattr(parent, attname)
+            path = get_child_path(parent_path, parent_pk)
+        _check_path_length(path_field, len(path))
+        setattr(node, attname, path)
@@ -0,0 +1,221 @@
+"""
+The registry of node types.
+
+All tree rules (``child_types``, ``can_have_children`` and ``can_be_root``) are class attributes,
+so they can be resolved once per node type instead of once per node.
+The registry is populated when the apps are ready, and resolves the content type ids on first use.
+"""
+import inspect
+from collections import namedtuple
+from threading import Lock
+from types import MappingProxyType
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+
+__all__ = ("NodeType", "NodeTypeRegistry", "node_type_registry")
+
+_RULE_ATTRIBUTES = ("can_have_children", "can_be_root", "child_types")
+_RULE_METHODS = ("get_child_types", "is_child_allowed")
+
+
+class NodeType(
+    namedtuple("NodeType", ("ctype_id", "model", "can_have_children", "can_be_root", "child_types", "dynamic"))
+):
+    """
+    The resolved tree rules of a single node type.
+
+    The ``child_types`` is a tuple of content type ids, an empty tuple means all types are allowed.
+    When ``dynamic`` is set, the model defines the rules as properties or overwritten methods,
+    so they can only be answered by the instance.
+    """
+
+    __slots__ = ()
+
+    def is_child_allowed(self, child_ctype_id):
+        """
+        Tell whether a node of the given content type can be placed below this node type.
+        """
+        if not self.can_have_children:
+            return False
+        return not self.child_types or child_ctype_id in self.child_types
+
+
+class NodeTypeRegistry:
+    """
+    Resolves the tree rules of all :class:`~polymorphic_tree.models.PolymorphicMPTTModel` subclasses.
+
+    The model references in ``child_types`` are resolved when the apps are ready,
+    the content type ids are resolved with a single query once they are needed.
+    After that, all lookups are dictionary lookups.
+    """
+
+    def __init__(self):
+        self._models = {}  # model -> tuple of child models, or None for dynamic rules
+        self._types = None
+        self._by_model = None
+        self._lock = Lock()
+
+    def populate(self):
+        """
+        Find all node types in the installed apps.
+        This is called from the ``AppConfig.ready()`` method.
+        """
+        from polymorphic_tree.models import PolymorphicMPTTModel
+
+        for model in apps.get_models():
+            if issubclass(model, PolymorphicMPTTModel):
+                self.register(model)
+
+    def register(self, model):
+        """
+        Register a node type, and resolve the model references in its ``child_types``.
+        """
+        with self._lock:
+            if model not in self._models:
+                self._models[model] = _get_child_models(model)
+                self._types = None
+                self._by_model = None
+
+    def reset(self):
+        """
+        Forget the resolved content type ids, e.g. after the content types were recreated.
+        """
+        with self._lock:
+            self._types = None
+            self._by_model = None
+
+    def get_for_model(self, model):
+        """
+        Return the :class:`NodeType` for a model class.
+        """
+        if model not in self._models:
+            self.register(model)
+        return self._get_maps()[1][model]
+
+    def get_for_ctype_id(self, ctype_id):
+        """
+        Return the :class:`NodeType` for a content type id.
+        """
+        try:
+            return self._get_maps()[0][ctype_id]
+        except KeyError:
+            model = ContentType.objects.get_for_id(ctype_id).model_class()
+            if model is None:
+                raise
+            return self.get_for_model(model)
+
+    def get_for_instance(self, node):
+        """
+        Return the :class:`NodeType` of a node, also when it's not downcasted to the real model yet.
+        """
+        if node.polymorphic_ctype_id:
+            return self.get_for_ctype_id(node.polymorphic_ctype_id)
+        return self.get_for_model(node.__class__)
+
+    def get_node_types(self):
+        """
+        Return a read-only mapping of all node types, keyed by content type id.
+        """
+        return self._get_maps()[0]
+
+    def is_child_allowed(self, parent_ctype_id, child_ctype_id):
+        """
+        Tell whether the parent type allows the child type, using the resolved rules only.
+        """
+        return self.get_for_ctype_id(parent_ctype_id).is_child_allowed(child_ctype_id)
+
+    def resolve_child_types(self, model, child_types):
+        """
+        Convert a ``child_types`` list to content type ids.
+        This is used for models that define their rules dynamically.
+        """
+        child_models = _resolve_child_models(model, child_types)
+        ctypes = ContentType.objects.get_for_models(*child_models, for_concrete_models=False)
+        return [ctypes[child_model].id for child_model in child_models]
+
+    def _get_maps(self):
+        maps = self._types
+        if maps is None:
+            with self._lock:
+                if self._types is None:
+                    self._types = self._build()
+                maps = self._types
+        return maps
+
+    def _build(self):
+        # Resolve all content types at once, this is a single query on the first request.
+        all_models = set(self._models)
+        for child_models in self._models.values():
+            all_models.update(child_models or ())
+        ctypes = ContentType.objects.get_for_models(*all_models, for_concrete_models=False)
+
+        by_ctype = {}
+        by_model = {}
+        for model, child_models in self._models.items():
+            dynamic = child_models is None
+            can_have_children = getattr(model, "can_have_children", True)
+            can_be_root = getattr(model, "can_be_root", True)
+            node_type = NodeType(
+                ctype_id=ctypes[model].id,
+                model=model,
+                can_have_children=can_have_children if not dynamic else None,
+                can_be_root=can_be_root if not dynamic else None,
+                child_types=tuple(ctypes[child].id for child in child_models) if not dynamic else (),
+                dynamic=dynamic,
+            )
+            by_ctype[node_type.ctype_id] = node_type
+            by_model[model] = node_type
+
+        return MappingProxyType(by_ctype), MappingProxyType(by_model)
+
+
+def _get_child_models(model):
+    """
+    Resolve the ``child_types`` of a model to model classes.
+    Returns ``None`` when the rules are defined dynamically.
+    """
+    from polymorphic_tree.models import PolymorphicMPTTModel
+
+    for name in _RULE_ATTRIBUTES:
+        if inspect.isdatadescriptor(inspect.getattr_static(model, name, None)):
+            return None
+    for name in _RULE_METHODS:
+        if getattr(model, name) is not getattr(PolymorphicMPTTModel, name):
+            return None
+
+    if not model.can_have_children:
+        return ()
+    return tuple(_resolve_child_models(model, model.child_types))
+
+
+def _resolve_child_models(model, child_types):
+    child_models = []
+    for child in child_types:
+        if isinstance(child, str):
+            child = child.lower()
+            if child == "self":
+                # write self to refer to self
+                child = model
+            else:
+                # either the name of a model in this app
+                # or the full app.model dot string
+                # just like a foreign key
+                try:
+                    app_label, model_name = child.rsplit(".", 1)
+                except ValueError:
+                    app_label = model._meta.app_label
+                    model_name = child
+                try:
+                    child = apps.get_model(app_label, model_name)
+                except LookupError:
+                    raise ImproperlyConfigured(
+                        "{}.child_types refers to '{}', which is not an installed model.".format(model.__name__, child)
+                    )
+        child_models.append(child)
+    return child_models
+
+
+#: The global registry of all node types.
+node_type_registry = NodeTypeRegistry()
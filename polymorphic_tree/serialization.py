@@ -0,0 +1,254 @@
+"""
+Streaming export and import of polymorphic trees.
+
+The nodes are written in ``(tree_id, lft)`` order, one node at a time, so the complete tree never has to be in memory.
+Every node is a record with the model label, the original primary key and parent,
+the tree fields and the field values of its real model::
+
+    {"model": "pages.textpage", "pk": 12, "parent": 10, "lft": 3, "rght": 4, "level": 1, "fields": {...}}
+
+The JSON Lines format has one record per line, and can be imported again with :func:`load_tree`.
+The nested JSON format places the children of each node in a ``"children"`` list,
+which is easier to read by other systems.
+"""
+import json
+
+from django.apps import apps
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import router, transaction
+
+from polymorphic_tree.cache import bump_version
+from polymorphic_tree.managers import _bulk_insert_nodes, _prepare_insert
+from polymorphic_tree.paths import TreePathField
+
+__all__ = ("iter_tree_records", "iter_json_lines", "iter_nested_json", "dump_tree", "load_tree", "load_tree_records")
+
+FORMATS = ("jsonl", "json")
+
+
+def iter_tree_records(queryset, chunk_size=2000):
+    """
+    Yield the export record of every node in the queryset, in ``(tree_id, lft)`` order.
+
+    The base table is streamed in chunks, and each chunk is converted to the real models with a single query per type.
+    The queryset should contain complete subtrees, e.g. ``Node.objects.filter(tree_id=...)``
+    or ``node.get_descendants(include_self=True)``.
+    Many-to-many fields and other related objects are not exported.
+    """
+    opts = queryset.model._mptt_meta
+    queryset = queryset.order_by(opts.tree_id_attr, opts.left_attr)
+    data_fields = {}
+
+    chunk = []
+    for node in queryset.non_polymorphic().iterator(chunk_size=chunk_size):
+        chunk.append(node)
+        if len(chunk) >= chunk_size:
+            yield from _get_records(queryset, chunk, data_fields)
+            chunk = []
+    if chunk:
+        yield from _get_records(queryset, chunk, data_fields)
+
+
+def _get_records(queryset, chunk, data_fields):
+    opts = queryset.model._mptt_meta
+    for node in queryset.get_real_instances(chunk):
+        model = node.__class__
+        if model not in data_fields:
+            data_fields[model] = _get_data_fields(model)
+
+        yield {
+            "model": model._meta.label_lower,
+            "pk": node.pk,
+            "parent": getattr(node, opts.parent_attr + "_id"),
+            "lft": getattr(node, opts.left_attr),
+            "rght": getattr(node, opts.right_attr),
+            "level": getattr(node, opts.level_attr),
+            "fields": {field.name: field.value_from_object(node) for field in data_fields[model]},
+        }
+
+
+def _get_data_fields(model):
+    """
+    The fields to export, leaving out the primary keys, the node type and the tree fields.
+    The materialized path is recalculated on import.
+    """
+    opts = model._mptt_meta
+    tree_fields = {opts.parent_attr, opts.tree_id_attr, opts.left_attr, opts.right_attr, opts.level_attr}
+    return [
+        field
+        for field in model._meta.concrete_fields
+        if not field.primary_key
+        and not (field.remote_field and field.remote_field.parent_link)
+        and field.name not in tree_fields
+        and field.name != "polymorphic_ctype"
+        and not isinstance(field, TreePathField)
+    ]
+
+
+def iter_json_lines(records):
+    """
+    Write the records as JSON Lines, one record per line.
+    """
+    encoder = DjangoJSONEncoder()
+    for record in records:
+        yield encoder.encode(record) + "\n"
+
+
+def iter_nested_json(records):
+    """
+    Write the records as nested JSON, with the children of every node in a ``"children"`` list.
+    Only the ancestors of the current node are tracked, so this works incrementally too.
+    """
+    encoder = DjangoJSONEncoder()
+    stack = []  # The primary keys of the open nodes
+    first = True  # Whether the next node is the first item of the current list
+    yield "["
+    for record in records:
+        while stack and stack[-1] != record["parent"]:
+            stack.pop()
+            yield "]}"
+            first = False
+
+        text = encoder.encode(record)
+        yield '{}{}, "children": ['.format("\n" if first else ",\n", text[:-1])
+        stack.append(record["pk"])
+        first = True
+
+    yield "]}" * len(stack)
+    yield "\n]\n"
+
+
+def dump_tree(queryset, stream, format="jsonl", chunk_size=2000):
+    """
+    Export the nodes of the queryset to a text stream, in the ``"jsonl"`` or nested ``"json"`` format.
+    """
+    records = iter_tree_records(queryset, chunk_size=chunk_size)
+    if format == "jsonl":
+        chunks = iter_json_lines(records)
+    elif format == "json":
+        chunks = iter_nested_json(records)
+    else:
+        raise ValueError("Unknown format {!r}, choose from: {}".format(format, ", ".join(FORMATS)))
+
+    for chunk in chunks:
+        stream.write(chunk)
+
+
+def load_tree(stream, model, target=None, position="last-child", format="jsonl", batch_size=1000):
+    """
+    Import the nodes of a text stream, which was written by :func:`dump_tree`.
+
+    The JSON Lines format is read line by line. The nested JSON format is parsed at once,
+    so prefer JSON Lines for large trees.
+    See :func:`load_tree_records` for the other arguments.
+    """
+    if format == "jsonl":
+        records = (json.loads(line) for line in stream if line.strip())
+    elif format == "json":
+        records = _flatten_nested(json.load(stream))
+    else:
+        raise ValueError("Unknown format {!r}, choose from: {}".format(format, ", ".join(FORMATS)))
+
+    return load_tree_records(records, model, target=target, position=position, batch_size=batch_size)
+
+
+def _flatten_nested(nodes):
+    stack = [iter(nodes)]
+    while stack:
+        record = next(stack[-1], None)
+        if record is None:
+            stack.pop()
+        else:
+            stack.append(iter(record.pop("children", None) or ()))
+            yield record
+
+
+def load_tree_records(records, model, target=None, position="last-child", batch_size=1000):
+    """
+    Create the nodes of exported records, with batched inserts per table.
+
+    The records are consumed one by one. Only the current batch and the ancestors of the current node
+    are kept in memory, and all new primary keys are assigned by the database.
+    Every exported tree is checked against the child type rules, and placed at the ``target``,
+    or as a new tree when no ``target`` is given. All nodes are inserted inside a single transaction.
+    Like ``bulk_create()``, this doesn't call ``save()`` or send the ``pre_save`` / ``post_save`` signals.
+
+    :param model: The model of the tree, the records can contain any subclass of it.
+    :param target: The node to insert the trees at, or ``None`` to create new trees.
+    :param position: The position relative to the ``target``. This can be ``'first-child'``,
+                     ``'last-child'``, ``'left'`` or ``'right'``.
+    :returns: The number of created nodes.
+    """
+    opts = model._mptt_meta
+    tree_model = model._tree_manager.tree_model
+    tree_manager = tree_model._tree_manager
+    using = router.db_for_write(tree_model)
+    count = 0
+
+    with transaction.atomic(using=using):
+        stack = []  # The (original pk, node) of the ancestors of the current node
+        batch = []
+        placement = None  # The (parent, tree_id, cursor, level) for the next exported tree
+        for record in records:
+            while stack and stack[-1][0] != record["parent"]:
+                stack.pop()
+
+            node_model = apps.get_model(record["model"])
+            if not issubclass(node_model, model):
+                raise ValueError("{} is not a subclass of {}".format(node_model.__name__, model.__name__))
+
+            node = _build_node(node_model, record["fields"])
+            node.pre_save_polymorphic(using=using)
+
+            if stack:
+                parent = stack[-1][1]
+            else:
+                # The root of an exported tree, make room for it.
+                if placement is None:
+                    placement = _prepare_insert(tree_manager, target, position, 1)
+                elif placement[2] is None and target is not None:
+                    # Another new tree next to the root node.
+                    tree_manager._create_tree_space(placement[1] - 1, 1)
+                parent, tree_id, cursor, level = placement
+                node._validate_new_parent(parent.pk if parent is not None else None, parent)
+
+                size = record["rght"] - record["lft"] + 1
+                if cursor is not None:
+                    tree_manager._create_space(size, cursor - 1, tree_id)
+                    left_shift = cursor - record["lft"]
+                    placement = (parent, tree_id, cursor + size, level)
+                else:
+                    left_shift = 1 - record["lft"]
+                    placement = (parent, tree_id + 1, None, level)
+                level_shift = level - record["level"]
+
+            if stack:
+                node._validate_new_parent(parent.pk, parent)
+            setattr(node, opts.parent_attr, parent)
+            setattr(node, opts.tree_id_attr, tree_id)
+            setattr(node, opts.left_attr, record["lft"] + left_shift)
+            setattr(node, opts.right_attr, record["rght"] + left_shift)
+            setattr(node, opts.level_attr, record["level"] + level_shift)
+
+            stack.append((record["pk"], node))
+            batch.append(node)
+            count += 1
+            if len(batch) >= batch_size:
+                _bulk_insert_nodes(tree_model, batch, using=using, batch_size=batch_size)
+                batch = []
+
+        if batch:
+            _bulk_insert_nodes(tree_model, batch, using=using, batch_size=batch_size)
+
+    bump_version(tree_model)
+    if target is not None:
+        target._mptt_refresh()
+    return count
+
+
+def _build_node(model, values):
+    kwargs = {}
+    for name, value in values.items():
+        field = model._meta.get_field(name)
+        kwargs[field.attname] = field.to_python(value)
+    return model(**kwargs)
@@ -0,0 +1,425 @@
+"""
+An in-memory copy of the tree structure.
+
+This allows to plan many changes on the tree at once, and write only the changed positions afterwards.
+"""
+from collections import defaultdict, namedtuple
+
+from django.db import models
+from django.db.models import F
+from mptt.exceptions import InvalidMove
+
+from polymorphic_tree.paths import (
+    PATH_SEPARATOR,
+    _check_path_length,
+    _check_subtree_path_length,
+    _replace_subtree_paths,
+    get_child_path,
+    get_path_field,
+)
+
+__all__ = ("NodePosition", "TreeSkeleton")
+
+#: The position of a node in the tree.
+NodePosition = namedtuple("NodePosition", ("pk", "parent_id", "tree_id", "lft", "rght", "level"))
+
+
+class TreeSkeleton:
+    """
+    The structure of one or more complete trees, without loading the node objects.
+
+    The nodes are stored by primary key, with their content type and the ordered children of every node.
+    After changing the structure with :meth:`move`, the :meth:`save` method writes the new positions.
+    """
+
+    def __init__(self, tree_model, rows):
+        """
+        :param rows: The ``(pk, parent_id, ctype_id, tree_id, lft, rght, level)`` values, in ``(tree_id, lft)`` order.
+        """
+        self.tree_model = tree_model
+        self.original = {}
+        self.ctypes = {}
+        self.parents = {}
+        self.children = defaultdict(list)
+        self.roots = []  # The root nodes, in tree order
+
+        for pk, parent_id, ctype_id, tree_id, lft, rght, level in rows:
+            self.original[pk] = NodePosition(pk, parent_id, tree_id, lft, rght, level)
+            self.ctypes[pk] = ctype_id
+            self.parents[pk] = parent_id
+            if parent_id is None:
+                self.roots.append(pk)
+            else:
+                self.children[parent_id].append(pk)
+
+        # Root nodes that are placed at another position need a new tree_id.
+        # The anchors tell next to which root they are placed, as the trees in between are not loaded.
+        self._placed_roots = set()
+        self._root_anchors = {}
+        self._appended_roots = []
+
+    @classmethod
+    def load(cls, tree_model, tree_ids, using=None):
+        """
+        Load the structure of the given trees, with a single query.
+        """
+        opts = tree_model._mptt_meta
+        rows = (
+            tree_model._base_manager.db_manager(using)
+            .non_polymorphic()
+            .filter(**{opts.tree_id_attr + "__in": sorted(set(tree_ids))})
+            .order_by(opts.tree_id_attr, opts.left_attr)
+            .values_list(
+                "pk",
+                opts.parent_attr + "_id",
+                "polymorphic_ctype_id",
+                opts.tree_id_attr,
+                opts.left_attr,
+                opts.right_attr,
+                opts.level_attr,
+            )
+        )
+        return cls(tree_model, rows)
+
+    def __contains__(self, pk):
+        return pk in self.original
+
+    def get_new_parent_id(self, pk, target_id, position):
+        """
+        Tell which parent the node will have after the move, according to the current plan.
+        """
+        if target_id is None:
+            return None
+        elif position in ("first-child", "last-child"):
+            return target_id
+        elif position in ("left", "right"):
+            return self.parents[target_id]
+        else:
+            raise ValueError("invalid mptt position argument")
+
+    def is_descendant(self, pk, ancestor_id):
+        """
+        Tell whether the node is a descendant of the ancestor, according to the current plan.
+        """
+        parent_id = self.parents[pk]
+        while parent_id is not None:
+            if parent_id == ancestor_id:
+                return True
+            parent_id = self.parents[parent_id]
+        return False
+
+    def move(self, pk, target_id, position="last-child"):
+        """
+        Move the node in the planned structure. Use ``target_id=None`` to make the node a new tree.
+        Like ``move_to()``, a root node stays in place when the ``target_id`` is ``None``.
+        """
+        if target_id is None and self.parents[pk] is None:
+            return
+        if target_id is not None and (target_id == pk or self.is_descendant(target_id, pk)):
+            raise InvalidMove("A node may not be made a sibling or child of itself or one of its descendants.")
+
+        new_parent_id = self.get_new_parent_id(pk, target_id, position)
+        self._siblings(pk).remove(pk)
+        self.parents[pk] = new_parent_id
+        if new_parent_id is None:
+            self._placed_roots.add(pk)
+            if target_id is not None:
+                self._root_anchors[pk] = (target_id, position)
+
+        if target_id is None:
+            self._appended_roots.append(pk)
+        elif position == "first-child":
+            self.children[target_id].insert(0, pk)
+        elif position == "last-child":
+            self.children[target_id].append(pk)
+        else:
+            siblings = self._siblings(target_id)
+            index = siblings.index(target_id)
+            siblings.insert(index if position == "left" else index + 1, pk)
+
+    def _siblings(self, pk):
+        parent_id = self.parents[pk]
+        if parent_id is None:
+            return self._appended_roots if pk in self._appended_roots else self.roots
+        return self.children[parent_id]
+
+    def _get_gap_tree_id(self, pk):
+        # The tree_id after which a placed root is inserted, found by following the roots it's placed next to.
+        # Returns None when the root it's placed next to isn't an existing tree anymore.
+        seen = set()
+        while pk not in seen:
+            seen.add(pk)
+            if pk not in self._root_anchors:
+                return None
+            target_id, position = self._root_anchors[pk]
+            if self.parents[target_id] is not None or target_id in self._appended_roots:
+                return None
+            if target_id not in self._placed_roots:
+                tree_id = self.original[target_id].tree_id
+                return tree_id if position == "right" else tree_id - 1
+            pk = target_id
+        return None
+
+    def _get_root_gaps(self):
+        # Root nodes which are not moved keep their tree_id.
+        # Nodes that became a root in between need new tree ids, which shifts the trees after them.
+        # Returns the kept roots, the ``(tree_id, roots)`` gaps and the roots that can only be appended.
+        root_tree_ids = []
+        gaps = []
+        cursor = None  # The last tree_id that was placed
+        pending = []
+        for pk in self.roots:
+            if pk in self._placed_roots:
+                gap_tree_id = self._get_gap_tree_id(pk)
+                if gap_tree_id is None:
+                    gap_tree_id = cursor
+                if gap_tree_id is None:
+                    pending.append(pk)
+                    continue
+            else:
+                gap_tree_id = self.original[pk].tree_id - 1
+                root_tree_ids.append((pk, gap_tree_id + 1))
+
+            if pending:
+                gaps.append((gap_tree_id, pending))
+                pending = []
+            if pk in self._placed_roots:
+                if gaps and gaps[-1][0] == gap_tree_id:
+                    gaps[-1][1].append(pk)
+                else:
+                    gaps.append((gap_tree_id, [pk]))
+            cursor = gap_tree_id if pk in self._placed_roots else gap_tree_id + 1
+
+        return root_tree_ids, gaps, pending
+
+    def get_positions(self, next_tree_id=None):
+        """
+        Calculate the new positions of all nodes.
+        Returns a dictionary with the new :class:`NodePosition` of each node,
+        and a list of ``(tree_id, count)`` gaps that need to be opened for new trees.
+        """
+        root_tree_ids, gaps, pending = self._get_root_gaps()
+
+        # When all roots are moved, they are placed as new trees.
+        appended_roots = pending + self._appended_roots
+
+        tree_ids = {}
+        shift = 0
+        for gap_tree_id, roots in gaps:
+            # The new trees are placed after the gap, which is shifted by the previous gaps.
+            for index, pk in enumerate(roots):
+                tree_ids[pk] = gap_tree_id + shift + index + 1
+            shift += len(roots)
+
+        for pk, tree_id in root_tree_ids:
+            tree_ids[pk] = tree_id + sum(len(roots) for gap_tree_id, roots in gaps if gap_tree_id < tree_id)
+
+        for index, pk in enumerate(appended_roots):
+            if next_tree_id is None:
+                raise ValueError("next_tree_id is required for new trees")
+            tree_ids[pk] = next_tree_id + shift + index
+
+        positions = {}
+        for root_id, tree_id in tree_ids.items():
+            self._number_tree(root_id, tree_id, 1, 0, positions)
+
+        return positions, [(gap_tree_id, len(roots)) for gap_tree_id, roots in gaps]
+
+    def _number_tree(self, root_id, tree_id, left, level, positions):
+        # Iterative, so deep trees don't hit the recursion limit.
+        stack = [(root_id, level, iter(self.children[root_id]))]
+        lefts = {root_id: left}
+        cursor = left
+        while stack:
+            pk, level, children = stack[-1]
+            child_id = next(children, None)
+            if child_id is not None:
+                cursor += 1
+                lefts[child_id] = cursor
+                stack.append((child_id, level + 1, iter(self.children[child_id])))
+            else:
+                stack.pop()
+                cursor += 1
+                positions[pk] = NodePosition(pk, self.parents[pk], tree_id, lefts[pk], cursor, level)
+        return cursor
+
+    def _get_moved_subtrees(self):
+        # The nodes that have a new parent, and all their descendants.
+        stack = [pk for pk, parent_id in self.parents.items() if parent_id != self.original[pk].parent_id]
+        pks = set()
+        while stack:
+            pk = stack.pop()
+            if pk not in pks:
+                pks.add(pk)
+                stack.extend(self.children[pk])
+        return pks
+
+    def get_paths(self, pks):
+        """
+        Calculate the materialized path of the given nodes, according to the current plan.
+        """
+        paths = {}
+        for pk in pks:
+            ancestors = []
+            parent_id = self.parents[pk]
+            while parent_id is not None:
+                ancestors.append(parent_id)
+                parent_id = self.parents[parent_id]
+
+            path = PATH_SEPARATOR
+            for ancestor_id in reversed(ancestors):
+                path = get_child_path(path, ancestor_id)
+            paths[pk] = path
+        return paths
+
+    def _get_original_path(self, pk):
+        # The materialized path before the planned moves.
+        ancestors = []
+        parent_id = self.original[pk].parent_id
+        while parent_id is not None:
+            ancestors.append(parent_id)
+            parent_id = self.original[parent_id].parent_id
+
+        path = PATH_SEPARATOR
+        for ancestor_id in reversed(ancestors):
+            path = get_child_path(path, ancestor_id)
+        return path
+
+    def save(self, using=None):
+        """
+        Write the changed positions to the database.
+        Returns the list of :class:`NodePosition` objects that changed.
+
+        Like ``move_to()``, the positions are not written one by one. Every tree that changed gets a single update,
+        which shifts the ``lft`` and ``rght`` ranges of the moved blocks. Only the moved nodes get a new parent.
+        """
+        opts = self.tree_model._mptt_meta
+        manager = self.tree_model._base_manager.db_manager(using).non_polymorphic()
+        next_tree_id = None
+        if self._appended_roots or self._get_root_gaps()[2]:
+            next_tree_id = self.tree_model._tree_manager.db_manager(using)._get_next_tree_id()
+
+        positions, gaps = self.get_positions(next_tree_id=next_tree_id)
+
+        # Open the gaps for new trees, from the last to the first so the shifts add up.
+        for gap_tree_id, count in sorted(gaps, reverse=True):
+            manager.filter(**{opts.tree_id_attr + "__gt": gap_tree_id}).update(
+                **{opts.tree_id_attr: F(opts.tree_id_attr) + count}
+            )
+
+        # Only the moved nodes get a new parent.
+        moved_pks = [pk for pk, parent_id in self.parents.items() if parent_id != self.original[pk].parent_id]
+        moved_per_tree = defaultdict(lambda: defaultdict(list))
+        for pk in moved_pks:
+            moved_per_tree[self.original[pk].tree_id][self.parents[pk]].append(pk)
+
+        changed = []
+        nodes_per_tree = defaultdict(list)
+        for pk, position in positions.items():
+            original = self.original[pk]
+            if position != original:
+                changed.append(position)
+            nodes_per_tree[original.tree_id].append((original, position))
+
+        # Nodes that move to another tree are parked at a temporary tree_id above all existing trees,
+        # so the update of the tree they move to doesn't shift them again.
+        temporary_offset = None
+        for tree_id, nodes in sorted(nodes_per_tree.items()):
+            # The gaps already updated the tree_id.
+            shifted_tree_id = tree_id + sum(count for gap_tree_id, count in gaps if gap_tree_id < tree_id)
+            if all(position == original._replace(tree_id=shifted_tree_id) for original, position in nodes):
+                continue
+            if temporary_offset is None and any(position.tree_id != shifted_tree_id for original, position in nodes):
+                temporary_offset = self.tree_model._tree_manager.db_manager(using)._get_next_tree_id()
+
+            # The conditions only read the lft and rght values before they are updated,
+            # as MySQL evaluates the assignments from left to right.
+            by_left = sorted(nodes, key=lambda node: node[0].lft)
+            by_right = sorted(nodes, key=lambda node: node[0].rght)
+            tree_id_cases = [
+                models.When(
+                    **{opts.left_attr + "__range": (first, last)}, then=models.Value(new_tree_id + temporary_offset)
+                )
+                for first, last, new_tree_id in _get_ranges(
+                    (original.lft, position.tree_id) for original, position in by_left
+                )
+                if new_tree_id != shifted_tree_id
+            ]
+            values = {
+                opts.level_attr: _shift_ranges(
+                    opts.level_attr,
+                    opts.left_attr,
+                    ((original.lft, position.level - original.level) for original, position in by_left),
+                ),
+                opts.right_attr: _shift_ranges(
+                    opts.right_attr,
+                    opts.right_attr,
+                    ((original.rght, position.rght - original.rght) for original, position in by_right),
+                ),
+                opts.left_attr: _shift_ranges(
+                    opts.left_attr,
+                    opts.left_attr,
+                    ((original.lft, position.lft - original.lft) for original, position in by_left),
+                ),
+            }
+            if tree_id_cases:
+                values = {
+                    opts.tree_id_attr: models.Case(
+                        *tree_id_cases, default=F(opts.tree_id_attr), output_field=models.IntegerField()
+                    ),
+                    **values,
+                }
+            if tree_id in moved_per_tree:
+                parent_attname = opts.parent_attr + "_id"
+                values[parent_attname] = models.Case(
+                    *(
+                        models.When(pk__in=pks, then=models.Value(parent_id))
+                        for parent_id, pks in moved_per_tree[tree_id].items()
+                    ),
+                    default=F(parent_attname),
+                    output_field=self.tree_model._meta.get_field(opts.parent_attr).target_field,
+                )
+            manager.filter(**{opts.tree_id_attr: shifted_tree_id}).update(**values)
+
+        if temporary_offset is not None:
+            manager.filter(**{opts.tree_id_attr + "__gte": temporary_offset}).update(
+                **{opts.tree_id_attr: F(opts.tree_id_attr) - temporary_offset}
+            )
+
+        # The moved nodes and their descendants get a new materialized path.
+        # The deepest nodes go first, so the path prefix of the moved ancestors still matches afterwards.
+        path_field = get_path_field(self.tree_model)
+        if path_field is not None:
+            moved_pks.sort(key=lambda pk: -self.original[pk].level)
+            new_paths = self.get_paths(moved_pks)
+            for pk in moved_pks:
+                old_path = self._get_original_path(pk)
+                _check_path_length(path_field, len(new_paths[pk]))
+                _check_subtree_path_length(self.tree_model, pk, old_path, new_paths[pk], using=using)
+                _replace_subtree_paths(self.tree_model, pk, old_path, new_paths[pk], using=using)
+
+        changed.sort(key=lambda position: (position.tree_id, position.lft))
+        return changed
+
+
+def _get_ranges(values):
+    # Combine the sorted (value, key) pairs into (first, last, key) ranges of consecutive values with the same key.
+    ranges = []
+    for value, key in values:
+        if ranges and ranges[-1][2] == key:
+            ranges[-1][1] = value
+        else:
+            ranges.append([value, value, key])
+    return ranges
+
+
+def _shift_ranges(attr, range_attr, values):
+    # Add the given difference to the attribute, for each range of ``range_attr`` values that shift the same.
+    cases = [
+        models.When(**{range_attr + "__range": (first, last)}, then=models.Value(difference))
+        for first, last, difference in _get_ranges(values)
+        if difference
+    ]
+    if not cases:
+        return F(attr)
+    return F(attr) + models.Case(*cases, default=models.Value(0), output_field=models.IntegerField())
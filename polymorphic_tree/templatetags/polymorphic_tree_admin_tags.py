@@ -1,10 +1,12 @@
+from django.contrib.admin.utils import quote
 from django.contrib.admin.views.main import ChangeList
-from django.contrib.contenttypes.models import ContentType
 from django.template import Library, Node, TemplateSyntaxError, Variable
+from django.template.loader import get_template
+from django.urls import reverse
 from django.utils.safestring import mark_safe
-from mptt.templatetags.mptt_tags import cache_tree_children
 
-from polymorphic_tree.templatetags.stylable_admin_list import stylable_column_repr
+from polymorphic_tree.managers import cache_tree_nodes
+from polymorphic_tree.templatetags.stylable_admin_list import get_column_repr
 
 register = Library()
 
@@ -13,7 +15,15 @@ register = Library()
 def real_model_name(node):
     # Allow upcasted model to work.
     # node.get_real_instance_class().__name__ would also work
-    return ContentType.objects.get_for_id(node.polymorphic_ctype_id).model
+    return node.get_node_type().model._meta.model_name
+
+
+@register.filter
+def tree_children_url(node):
+    """
+    Return the changelist URL of the children of a node, when these are not listed.
+    """
+    return getattr(node, "_children_url", None)
 
 
 @register.filter
@@ -28,6 +38,11 @@ def mptt_breadcrumb(node):
 
 
 class AdminListRecurseTreeNode(Node):
+    """
+    Render the template contents for every node, with the rendered children in the ``children`` variable.
+    This is much slower than :func:`get_jqtree_data`, and only needed for templates that render custom node data.
+    """
+
     def __init__(self, template_nodes, cl_var):
         self.template_nodes = template_nodes
         self.cl_var = cl_var
@@ -44,24 +59,11 @@ class AdminListRecurseTreeNode(Node):
         parser.delete_first_token()
         return cls(template_nodes, cl_var)
 
-    def _render_node(self, context, cl, node):
-        bits = []
+    def _render_node(self, context, cl, node, children, rendered_children):
         context.push()
-
-        # Render children to add to parent later
-        for child in node.get_children():
-            bits.append(self._render_node(context, cl, child))
-
-        columns = self._get_column_repr(cl, node)  # list(tuple(name, html), ..)
-        first_real_column = next(col for col in columns if col[0] != "action_checkbox")
-
-        context["columns"] = columns
-        context["other_columns"] = [col for col in columns if col[0] not in ("action_checkbox", first_real_column[0])]
-        context["first_column"] = first_real_column[1]
-        context["named_columns"] = dict(columns)
-        context["node"] = node
-        context["change_url"] = cl.url_for_result(node)
-        context["children"] = mark_safe("".join(bits))
+        context.update(_get_node_context(cl, node))
+        context["children"] = mark_safe("".join(rendered_children))
+        context["load_on_demand"] = _is_loaded_on_demand(cl, node, children)
 
         # Render
         rendered = self.template_nodes.render(context)
@@ -71,16 +73,163 @@ class AdminListRecurseTreeNode(Node):
     def render(self, context):
         cl = self.cl_var.resolve(context)
         assert isinstance(cl, ChangeList), "cl variable should be an admin ChangeList"  # Also assists PyCharm
-        roots = cache_tree_children(cl.result_list)
-        bits = [self._render_node(context, cl, node) for node in roots]
-        return "".join(bits)
+        roots = cache_tree_nodes(list(cl.result_list))
+
+        # The nodes are rendered in reversed tree order, so the children are always rendered before their parent.
+        # This avoids recursion, which fails for deep trees.
+        rendered = {}
+        for node in reversed(_get_tree_order(roots)):
+            children = node.get_children()
+            rendered[node.pk] = self._render_node(
+                context, cl, node, children, [rendered.pop(child.pk) for child in children]
+            )
+        return "".join(rendered.pop(node.pk) for node in roots)
 
     def _get_column_repr(self, cl, node):
-        columns = []
-        for field_name in cl.list_display:
-            html, row_class_ = stylable_column_repr(cl, node, field_name)
-            columns.append((field_name, html))
-        return columns
+        return _get_column_repr(cl, node)
+
+
+def _get_tree_order(roots):
+    # The nodes of the cached trees, in tree order.
+    nodes = []
+    stack = list(reversed(roots))
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(reversed(node._cached_children))
+    return nodes
+
+
+def _get_column_repr(cl, node):
+    columns = []
+    for field_name in cl.list_display:
+        html, row_class_ = get_column_repr(cl, node, field_name)
+        columns.append((field_name, html))
+    return columns
+
+
+def _get_node_context(cl, node):
+    """
+    The template variables of a single node.
+    """
+    columns = _get_column_repr(cl, node)  # list(tuple(name, html), ..)
+    first_real_column = next(col for col in columns if col[0] != "action_checkbox")
+    return {
+        "columns": columns,
+        "other_columns": [col for col in columns if col[0] not in ("action_checkbox", first_real_column[0])],
+        "first_column": first_real_column[1],
+        "named_columns": dict(columns),
+        "node": node,
+        "change_url": cl.url_for_result(node),
+        "cl": cl,
+    }
+
+
+def _is_loaded_on_demand(cl, node, children):
+    # The children of the node are fetched by jqTree when it's opened.
+    return getattr(cl, "load_on_demand", False) and not children and not node.is_leaf_node()
+
+
+def get_jqtree_data(cl, nodes=None, label_template=None):
+    """
+    Return the nodes of the changelist as compact jqTree data, which the admin turns into markup on the client.
+    By default, the nodes of the current page are returned. The result has these keys:
+
+    * ``types``: the ``classes``, ``can_have_children`` and ``child_types`` of each node type, by content type id.
+    * ``columns``: the names of the columns, the first column links to the change page.
+    * ``change_url``: the URL of the change page, split at the place of the object id.
+    * ``popup``: whether the changelist is opened as popup.
+    * ``nodes``: the nested nodes, with the ``id``, the content type ``t``, the column values ``c``,
+      and the ``children`` or the ``load_on_demand`` flag.
+      Node types with dynamic rules have their own ``type``, and other object ids are given in ``u``.
+
+    The nodes are walked in ``(tree_id, lft)`` order without recursion. When a ``label_template`` is given,
+    every node has a rendered ``html`` label instead of the column values. The template receives
+    the same variables as the ``adminlist_recursetree`` tag.
+    """
+    opts = cl.model._mptt_meta
+    tree_id_attr = opts.tree_id_attr
+    left_attr = opts.left_attr
+    right_attr = opts.right_attr
+    parent_attname = opts.parent_attr + "_id"
+    nodes = sorted(
+        cl.result_list if nodes is None else nodes,
+        key=lambda node: (getattr(node, tree_id_attr), getattr(node, left_attr)),
+    )
+    load_on_demand = getattr(cl, "load_on_demand", False)
+    template = get_template(label_template) if label_template else None
+    field_names = [field_name for field_name in cl.list_display if field_name != "action_checkbox"]
+
+    types = {}
+    roots = []
+    stack = []  # The (node, data) of the ancestors of the current node
+    for node in nodes:
+        tree_id = getattr(node, tree_id_attr)
+        while stack and (
+            getattr(stack[-1][0], tree_id_attr) != tree_id
+            or getattr(stack[-1][0], right_attr) < getattr(node, left_attr)
+        ):
+            _close_jqtree_node(stack.pop()[1], load_on_demand)
+
+        is_leaf = getattr(node, right_attr) - getattr(node, left_attr) == 1
+        ctype_id = node.polymorphic_ctype_id
+        data = {"id": node.pk, "t": ctype_id}
+        if node.get_node_type().dynamic:
+            data["type"] = _get_jqtree_type(node)
+        elif ctype_id not in types:
+            types[ctype_id] = _get_jqtree_type(node)
+
+        object_id = quote(node.pk)
+        if object_id != str(node.pk):
+            data["u"] = object_id
+
+        if template is not None:
+            context = _get_node_context(cl, node)
+            context["is_leaf"] = is_leaf
+            data["html"] = template.render(context)
+        else:
+            data["c"] = [get_column_repr(cl, node, field_name)[0] for field_name in field_names]
+
+        if not is_leaf:
+            data["children"] = []
+
+        if stack and getattr(node, parent_attname) == stack[-1][0].pk:
+            stack[-1][1]["children"].append(data)
+        else:
+            roots.append(data)
+        stack.append((node, data))
+
+    while stack:
+        _close_jqtree_node(stack.pop()[1], load_on_demand)
+
+    change_url = reverse(
+        "admin:{}_{}_change".format(cl.opts.app_label, cl.opts.model_name),
+        args=("0",),
+        current_app=cl.model_admin.admin_site.name,
+    )
+    return {
+        "types": types,
+        "columns": [getattr(field_name, "__name__", field_name) for field_name in field_names],
+        "change_url": change_url.rsplit("0", 1),
+        "popup": cl.is_popup,
+        "nodes": roots,
+    }
+
+
+def _get_jqtree_type(node):
+    # The metadata of a node type, which is sent once per type.
+    return {
+        "classes": "nodetype-{}".format(real_model_name(node).lower()),
+        "can_have_children": node.can_have_children,
+        "child_types": node.get_child_types(),
+    }
+
+
+def _close_jqtree_node(data, load_on_demand):
+    # Nodes without listed children are fetched by jqTree when it's opened.
+    if load_on_demand and data.get("children") == []:
+        del data["children"]
+        data["load_on_demand"] = True
 
 
 @register.tag
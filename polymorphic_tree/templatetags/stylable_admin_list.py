@@ -121,52 +121,37 @@ def stylable_items_for_result(cl, result, form):
     """
     Return an iterator which returns all columns to display in the list.
     This method is based on items_for_result(), yet completely refactored.
+    The columns are resolved once per ChangeList, see :func:`get_column_plan`.
     """
-    first = True
-    pk = cl.lookup_opts.pk.attname
-
-    # Read any custom properties
-    list_column_classes = getattr(cl.model_admin, "list_column_classes", {})
-
-    # figure out which field to indent
-    mptt_indent_field = _get_mptt_indent_field(cl, result)
+    plan = get_column_plan(cl)
 
     # Parse all fields to display
-    for field_name in cl.list_display:
+    for column in plan.columns:
         row_attr = ""
 
         # This is all standard stuff, refactored to separate methods.
-        result_repr, row_classes = stylable_column_repr(cl, result, field_name)
+        result_repr = get_column_repr(cl, result, column.name)[0]
         if force_str(result_repr) == "":
             result_repr = mark_safe("&nbsp;")
 
         # Custom stuff, select row classes
-        if field_name == mptt_indent_field:
-            level = getattr(result, result._mptt_meta.level_attr)
+        if column.is_indented:
+            level = getattr(result, plan.level_attr)
             row_attr += ' style="padding-left:%spx"' % (5 + MPTT_ADMIN_LEVEL_INDENT * level)
 
-        column_class = list_column_classes.get(field_name)
-        if column_class:
-            row_classes.append(column_class)
-
-        if row_classes:
-            row_attr += ' class="%s"' % " ".join(row_classes)
+        if column.css_classes:
+            row_attr += ' class="%s"' % column.css_classes
 
         # Add the link tag to the first field, or use list_display_links if it's defined.
-        if (first and not cl.list_display_links) or field_name in cl.list_display_links:
-            table_tag = "th" if first else "td"
-            first = False
+        if column.link_tag:
+            table_tag = column.link_tag
             url = cl.url_for_result(result)
 
             link_attr = ""
             if cl.is_popup:
                 # Convert the pk to something that can be used in Javascript.
                 # Problem cases are long ints (23L) and non-ASCII strings.
-                if cl.to_field:
-                    attr = str(cl.to_field)
-                else:
-                    attr = pk
-                value = result.serializable_value(attr)
+                value = result.serializable_value(plan.popup_attr)
                 result_id = repr(force_str(value))[1:]
                 link_attr += ' onclick="opener.dismissRelatedLookupPopup(window, %s); return false;"' % result_id
 
@@ -178,8 +163,8 @@ def stylable_items_for_result(cl, result, form):
             # By default the fields come from ModelAdmin.list_editable,
             # but if we pull the fields out of the form instead,
             # custom ModelAdmin instances can provide fields on a per request basis
-            if form and field_name in form.fields:
-                bf = form[field_name]
+            if form and column.name in form.fields:
+                bf = form[column.name]
                 result_repr = mark_safe(force_str(bf.errors) + force_str(bf))
             else:
                 result_repr = conditional_escape(result_repr)
@@ -190,6 +175,103 @@ def stylable_items_for_result(cl, result, form):
         yield mark_safe("<td>%s</td>" % force_str(form[cl.model._meta.pk.name]))
 
 
+class StylableColumn:
+    """
+    A column of the admin list, of which the field, callable or model attribute is resolved once.
+    """
+
+    def __init__(self, cl, field_name):
+        self.name = field_name
+        self.field = None
+        self.attr = None  # A callable that receives the object
+        self.allow_tags = False
+        self.boolean = False
+        self.empty_value_display = cl.model_admin.get_empty_value_display()
+        row_classes = []
+
+        try:
+            self.field = cl.lookup_opts.get_field(field_name)
+        except FieldDoesNotExist:
+            # For non-field list_display values, the value is either:
+            # - a method
+            # - a attribute of the ModelAdmin
+            # - a property or method of the model, which is read per object.
+            if callable(field_name):
+                self.attr = field_name
+            elif hasattr(cl.model_admin, field_name) and field_name not in ("__str__", "__unicode__"):
+                self.attr = getattr(cl.model_admin, field_name)
+
+            if self.attr is not None:
+                self.allow_tags = getattr(self.attr, "allow_tags", False)
+                self.boolean = getattr(self.attr, "boolean", False)
+        else:
+            if isinstance(self.field, models.DateField) or isinstance(self.field, models.TimeField):
+                row_classes.append("nowrap")
+
+        self.row_classes = list(row_classes) or None
+        column_class = getattr(cl.model_admin, "list_column_classes", {}).get(field_name)
+        if column_class:
+            row_classes.append(column_class)
+        self.css_classes = " ".join(row_classes)
+        self.is_indented = False
+        self.link_tag = None
+
+    def get_repr(self, result):
+        """
+        Get the string representation of the column for an object.
+        """
+        if self.field is not None:
+            return display_for_field(getattr(result, self.field.attname), self.field, self.empty_value_display)
+
+        try:
+            if self.attr is not None:
+                return _format_non_field_value(self.attr(result), self.allow_tags, self.boolean)
+
+            attr = getattr(result, self.name)
+            value = attr() if callable(attr) else attr
+            return _format_non_field_value(value, getattr(attr, "allow_tags", False), getattr(attr, "boolean", False))
+        except (AttributeError, ObjectDoesNotExist):
+            return self.empty_value_display
+
+
+class ColumnPlan:
+    """
+    The resolved columns of a ChangeList, so the rows only call the prepared accessors.
+    """
+
+    def __init__(self, cl):
+        self.columns = [StylableColumn(cl, field_name) for field_name in cl.list_display]
+        self.by_name = {column.name: column for column in self.columns}
+        self.popup_attr = str(cl.to_field) if cl.to_field else cl.lookup_opts.pk.attname
+
+        # Add the link tag to the first field, or use list_display_links if it's defined.
+        first = True
+        links = cl.list_display_links or ()
+        for column in self.columns:
+            if (first and not links) or column.name in links:
+                column.link_tag = "th" if first else "td"
+                first = False
+
+        # figure out which field to indent
+        self.level_attr = None
+        if hasattr(cl.model, "_mptt_meta"):
+            self.level_attr = cl.model._mptt_meta.level_attr
+            indent_field = _get_mptt_indent_field(cl, cl.model)
+            if indent_field is not None:
+                self.by_name[indent_field].is_indented = True
+
+
+def get_column_plan(cl):
+    """
+    Return the :class:`ColumnPlan` of a ChangeList, which is created once.
+    """
+    try:
+        return cl._column_plan
+    except AttributeError:
+        cl._column_plan = ColumnPlan(cl)
+        return cl._column_plan
+
+
 def _get_mptt_indent_field(cl, result):
     """
     Find the first field of the list, it will be indented visually.
@@ -216,6 +298,29 @@ def _get_mptt_indent_field(cl, result):
     return mptt_indent_field
 
 
+def get_column_repr(cl, result, field_name):
+    """
+    Get the string representation and row classes of a column, like :func:`stylable_column_repr`.
+    The result is cached in the ChangeList, so the table and the jqTree data evaluate every column only once.
+    """
+    try:
+        column_reprs = cl._column_reprs
+    except AttributeError:
+        column_reprs = cl._column_reprs = {}
+
+    key = (result.pk, field_name)
+    try:
+        return column_reprs[key]
+    except KeyError:
+        column = get_column_plan(cl).by_name.get(field_name)
+        if column is None:
+            value = stylable_column_repr(cl, result, field_name)
+        else:
+            value = (column.get_repr(result), column.row_classes)
+        column_reprs[key] = value
+        return value
+
+
 def stylable_column_repr(cl, result, field_name):
     """
     Get the string representation for a column item.
@@ -257,32 +362,30 @@ def _get_non_field_repr(cl, result, field_name):
                 value = attr()
             else:
                 value = attr
-
-        # Parse special attributes of the item
-        allow_tags = getattr(attr, "allow_tags", False)
-        boolean = getattr(attr, "boolean", False)
-        if boolean:
-            allow_tags = True
-            result_repr = _boolean_icon(value)
-        elif isinstance(value, SafeData):
-            allow_tags = True
-            result_repr = value
-        else:
-            result_repr = smart_str(value)
-
     except (AttributeError, ObjectDoesNotExist):
         result_repr = cl.model_admin.get_empty_value_display()
     else:
-        # Strip HTML tags in the resulting text, except if the
-        # function has an "allow_tags" attribute set to True.
-        if not allow_tags:
-            result_repr = escape(result_repr)
-        else:
-            result_repr = mark_safe(result_repr)
+        result_repr = _format_non_field_value(
+            value, getattr(attr, "allow_tags", False), getattr(attr, "boolean", False)
+        )
 
     return result_repr, None
 
 
+def _format_non_field_value(value, allow_tags, boolean):
+    # Parse special attributes of the item
+    if boolean:
+        return _boolean_icon(value)
+    elif isinstance(value, SafeData):
+        return value
+    elif allow_tags:
+        return mark_safe(smart_str(value))
+    else:
+        # Strip HTML tags in the resulting text, except if the
+        # function has an "allow_tags" attribute set to True.
+        return escape(smart_str(value))
+
+
 # from Django 1.4:
 def display_for_field(value, field, empty_value_display):
     from django.contrib.admin.templatetags.admin_list import _boolean_icon
@@ -3,7 +3,7 @@ from django.db import models
 from mptt.exceptions import InvalidMove
 from polymorphic.showfields import ShowFieldContent
 
-from polymorphic_tree.models import PolymorphicMPTTModel, PolymorphicTreeForeignKey
+from polymorphic_tree.models import PolymorphicMPTTModel, PolymorphicTreeForeignKey, TreePathField
 
 
 class PlainA(models.Model):
@@ -150,3 +150,23 @@ class ModelRestrictedChildren(Base):
     child_types = [
         ModelX,
     ]
+
+
+class ModelRestrictedByName(Base):
+    child_types = ["self", "ModelY", "tests.ModelX"]
+
+
+class ModelWithoutChildren(Base):
+    can_have_children = False
+
+
+class PathNode(PolymorphicMPTTModel):
+    parent = PolymorphicTreeForeignKey(
+        "self", blank=True, null=True, related_name="children", verbose_name="parent", on_delete=models.CASCADE
+    )
+    path = TreePathField()
+    title = models.CharField(max_length=10)
+
+
+class PathNodeChild(PathNode):
+    extra = models.CharField(max_length=10, blank=True)
@@ -1,13 +1,28 @@
+import json
 import sys
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
 from unittest import TestCase
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 from django.contrib.admin import AdminSite
+from django.contrib.auth import get_user_model
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.http import Http404
+from django.template import Context, Template
+from django.test import RequestFactory, TransactionTestCase, override_settings
+from django.urls import reverse
 
 import polymorphic_tree.templatetags.stylable_admin_list  # noqa (only for import testing)
 from polymorphic_tree.admin.parentadmin import get_permission_codename
+from polymorphic_tree.registry import node_type_registry
+from polymorphic_tree.serialization import load_tree_records
+from polymorphic_tree.skeleton import TreeSkeleton
+from polymorphic_tree.templatetags.polymorphic_tree_admin_tags import get_jqtree_data
+from polymorphic_tree.templatetags.stylable_admin_list import get_column_plan, stylable_results
 from polymorphic_tree.tests.admin import TreeNodeParentAdmin
 from polymorphic_tree.tests.models import Model2A, ModelWithCustomParentName, ModelWithInvalidMove, ModelWithValidation
+from polymorphic_tree.tests.urls import site
 
 
 class PolymorphicAdminTests(TestCase):
@@ -85,3 +100,445 @@ class PolymorphicAdminTests(TestCase):
     def test_get_permission_codename(self):
         # This is to test whether our function works in older Django versions.
         self.assertEqual(get_permission_codename("change", Model2A._meta), "change_model2a")
+
+
+@contextmanager
+def shared_cache():
+    # The admin only relies on the tree versions when the cache is shared by all processes.
+    with TemporaryDirectory() as location, override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": location}}
+    ):
+        yield
+
+
+@override_settings(ROOT_URLCONF="polymorphic_tree.tests.urls")
+class TreeChangeListTests(TransactionTestCase):
+    """Tests for the changelist that loads subtrees on demand.
+    The tree versions are updated when the transaction is committed."""
+
+    def setUp(self):
+        self.root = ModelWithCustomParentName.objects.create(field5="root")
+        self.a = ModelWithCustomParentName.objects.create(field5="a", chief=self.root)
+        self.b = ModelWithCustomParentName.objects.create(field5="b", chief=self.a)
+        self.c = ModelWithCustomParentName.objects.create(field5="c", chief=self.b)
+        self.d = ModelWithCustomParentName.objects.create(field5="d", chief=self.root)
+        self.parent_admin = site._registry[ModelWithCustomParentName]
+        self.user = get_user_model().objects.create_superuser("admin", "admin@example.com", "admin")
+
+    def get_request(self, url_name, data=None, cookies=None):
+        request = RequestFactory().get(reverse(url_name), data)
+        request.user = self.user
+        request.COOKIES.update(cookies or {})
+        return request
+
+    def get_listed(self, data=None, cookies=None):
+        request = self.get_request("admin:tests_modelwithcustomparentname_changelist", data, cookies)
+        response = self.parent_admin.changelist_view(request)
+        response.render()
+        return [node.field5 for node in response.context_data["cl"].result_list], response
+
+    def test_initial_levels(self):
+        listed, response = self.get_listed()
+        self.assertEqual(listed, ["root", "a", "d"])
+
+        # The table links to the children that are not listed, so it works without JavaScript.
+        self.assertContains(response, 'href="?node={}"'.format(self.a.pk))
+        self.assertNotContains(response, 'href="?node={}"'.format(self.root.pk))
+        listed, response = self.get_listed({"node": self.a.pk})
+        self.assertEqual(listed, ["b"])
+        self.assertContains(response, 'href="?node={}"'.format(self.b.pk))
+
+        # Filters show all matches.
+        listed, response = self.get_listed({"field5": "c"})
+        self.assertEqual(listed, ["c"])
+        self.assertNotContains(response, 'class="load-on-demand"')
+
+    def test_open_nodes(self):
+        cookie = "polymorphic_tree_open_tests_modelwithcustomparentname"
+        listed, response = self.get_listed(cookies={cookie: "{},{}".format(self.a.pk, self.b.pk)})
+        self.assertEqual(listed, ["root", "a", "b", "c", "d"])
+
+        # The children of closed nodes are not listed.
+        listed, response = self.get_listed(cookies={cookie: str(self.b.pk)})
+        self.assertEqual(listed, ["root", "a", "d"])
+
+    def get_tree_data(self, data=None, **headers):
+        request = self.get_request("admin:tests_modelwithcustomparentname_tree_data", data)
+        request.META.update(headers)
+        return self.parent_admin.api_tree_data_view(request)
+
+    def test_tree_data_view(self):
+        payload = json.loads(self.get_tree_data().content.decode())
+        ctype_id = str(self.root.polymorphic_ctype_id)
+        self.assertEqual(
+            payload["types"],
+            {ctype_id: {"classes": "nodetype-modelwithcustomparentname", "can_have_children": True, "child_types": []}},
+        )
+        self.assertEqual(payload["columns"], ["field5", "actions_column"])
+        self.assertEqual(
+            "{}".join(payload["change_url"]).format(self.b.pk),
+            reverse("admin:tests_modelwithcustomparentname_change", args=(self.b.pk,)),
+        )
+
+        data = payload["nodes"]
+        self.assertEqual([node["id"] for node in data], [self.root.pk])
+        self.assertEqual([node["id"] for node in data[0]["children"]], [self.a.pk, self.d.pk])
+        self.assertTrue(data[0]["children"][0]["load_on_demand"])
+        self.assertNotIn("load_on_demand", data[0]["children"][1])
+
+        # The children of a collapsed node
+        data = json.loads(self.get_tree_data({"node": self.a.pk}).content.decode())["nodes"]
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["id"], self.b.pk)
+        self.assertEqual(data[0]["t"], self.b.polymorphic_ctype_id)
+        self.assertTrue(data[0]["load_on_demand"])
+        self.assertNotIn("children", data[0])
+        self.assertEqual(data[0]["c"][0], "b")
+        self.assertIn("move_up", data[0]["c"][1])
+
+    def test_tree_data_etag(self):
+        # The versions in a local-memory cache are not seen by other processes.
+        self.assertFalse(self.get_tree_data().has_header("ETag"))
+        with patch.object(self.parent_admin, "tree_data_caching", True):
+            self.assertFalse(self.get_tree_data().has_header("ETag"))
+
+        with shared_cache(), patch.object(self.parent_admin, "tree_data_caching", True):
+            self.check_tree_data_etag()
+
+    def check_tree_data_etag(self):
+        response = self.get_tree_data()
+        etag = response["ETag"]
+        self.assertIn("no-cache", response["Cache-Control"])
+
+        # Unchanged trees are not modified, and are cached on the server.
+        self.assertEqual(self.get_tree_data(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_tree_data().content, response.content)
+
+        # Other filters and changes of the tree are a different version.
+        self.assertNotEqual(self.get_tree_data({"node": self.a.pk})["ETag"], etag)
+        self.d.field5 = "changed"
+        self.d.save()
+        response = self.get_tree_data(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertIn(b"changed", response.content)
+
+    def move(self, moved, target, position="inside", previous_parent=None):
+        request = RequestFactory().post(
+            reverse("admin:tests_modelwithcustomparentname_moved"),
+            {
+                "moved_id": moved.pk,
+                "target_id": target.pk,
+                "previous_parent_id": previous_parent.pk if previous_parent is not None else "",
+                "position": position,
+            },
+        )
+        request.user = self.user
+        response = self.parent_admin.api_node_moved_view(request)
+        return response, json.loads(response.content.decode())
+
+    def test_move(self):
+        # A single move shifts the ranges like move_to(), without loading the whole tree.
+        with patch.object(ModelWithCustomParentName, "save", side_effect=AssertionError), patch.object(
+            TreeSkeleton, "load", side_effect=AssertionError
+        ):
+            response, data = self.move(self.d, self.a, previous_parent=self.root)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["action"], "success")
+        self.assertIn("move_up", data["action_column"])
+
+        self.d.refresh_from_db()
+        self.assertEqual(self.d.chief_id, self.a.pk)
+        positions = {position[0]: position for position in data["positions"]}
+        self.assertEqual(positions[self.d.pk], [self.d.pk, self.a.pk, self.d.lft, self.d.rght, self.d.level])
+        self.assertEqual(set(positions), {self.a.pk, self.b.pk, self.c.pk, self.d.pk})
+
+        # The client didn't see that the node was moved.
+        response, data = self.move(self.d, self.root, previous_parent=self.root)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(data["action"], "reload")
+        self.assertEqual(data["positions"], [[self.d.pk, self.a.pk, self.d.lft, self.d.rght, self.d.level]])
+
+        # Moving a node below itself is rejected.
+        response, data = self.move(self.a, self.c, previous_parent=self.root)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(data["action"], "reject")
+
+    def test_move_next_to_root(self):
+        # Only the trees of the moved nodes are loaded, the trees in between should keep their place.
+        other = ModelWithCustomParentName.objects.create(field5="other")
+        last = ModelWithCustomParentName.objects.create(field5="last")
+        response, data = self.move(self.d, last, position="before", previous_parent=self.root)
+        self.assertEqual(data["action"], "success")
+
+        moves = [
+            {"moved_id": self.b.pk, "target_id": self.root.pk, "position": "after", "previous_parent_id": self.a.pk}
+        ]
+        request = RequestFactory().post(
+            reverse("admin:tests_modelwithcustomparentname_nodes_moved"), {"moves": json.dumps(moves)}
+        )
+        request.user = self.user
+        data = json.loads(self.parent_admin.api_nodes_moved_view(request).content.decode())
+        self.assertEqual(data["action"], "success")
+
+        roots = ModelWithCustomParentName.objects.filter(chief=None).order_by("tree_id")
+        self.assertEqual([node.field5 for node in roots], ["root", "b", "other", "d", "last"])
+        self.assertEqual([node.tree_id for node in roots], [1, 2, 3, 4, 5])
+
+    def test_move_save(self):
+        self.parent_admin.save_moved_nodes = True
+        self.addCleanup(delattr, self.parent_admin, "save_moved_nodes")
+        with patch.object(ModelWithCustomParentName, "save", autospec=True) as save:
+            response, data = self.move(self.d, self.a, position="after", previous_parent=self.root)
+        self.assertEqual(data["action"], "success")
+        self.assertEqual(save.call_args[0][0].pk, self.d.pk)
+
+    def test_move_many(self):
+        moves = [
+            {"moved_id": self.d.pk, "target_id": self.b.pk, "position": "inside"},
+            {"moved_id": self.c.pk, "target_id": self.a.pk, "position": "before", "previous_parent_id": self.b.pk},
+        ]
+        request = RequestFactory().post(
+            reverse("admin:tests_modelwithcustomparentname_nodes_moved"), {"moves": json.dumps(moves)}
+        )
+        request.user = self.user
+        node_type_registry.get_node_types()  # The content types are read once
+        with patch.object(self.parent_admin, "sequential_moves_limit", 1), self.assertNumQueries(9):
+            # The nodes, the tree structure, the update and the transaction
+            response = self.parent_admin.api_nodes_moved_view(request)
+        data = json.loads(response.content.decode())
+        self.assertEqual(data["action"], "success")
+        self.assertEqual(data["moved_ids"], [self.d.pk, self.c.pk])
+
+        nodes = ModelWithCustomParentName.objects.filter(tree_id=self.root.tree_id)
+        self.assertEqual(
+            [(node.field5, node.chief_id) for node in nodes],
+            [
+                ("root", None),
+                ("c", self.root.pk),
+                ("a", self.root.pk),
+                ("b", self.a.pk),
+                ("d", self.b.pk),
+            ],
+        )
+        self.assertEqual({position[0] for position in data["positions"]}, {node.pk for node in nodes[1:]})
+
+        # All moves are rejected when one of them is invalid.
+        moves = [
+            {"moved_id": self.d.pk, "target_id": self.root.pk, "position": "inside"},
+            {"moved_id": self.a.pk, "target_id": self.b.pk, "position": "inside"},
+        ]
+        request = RequestFactory().post(
+            reverse("admin:tests_modelwithcustomparentname_nodes_moved"), {"moves": json.dumps(moves)}
+        )
+        request.user = self.user
+        response = self.parent_admin.api_nodes_moved_view(request)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.content.decode())["action"], "reject")
+        self.d.refresh_from_db()
+        self.assertEqual(self.d.chief_id, self.b.pk)
+        self.d.refresh_from_db()
+        self.assertEqual(self.d.chief_id, self.b.pk)
+
+    def test_move_selected_nodes(self):
+        queryset = ModelWithCustomParentName.objects.filter(pk__in=[self.b.pk, self.c.pk, self.d.pk])
+        request = RequestFactory().post(
+            reverse("admin:tests_modelwithcustomparentname_changelist"), {"action": "move_selected_nodes"}
+        )
+        request.user = self.user
+        response = self.parent_admin.move_selected_nodes(request, queryset)
+        response.render()
+        self.assertIn(b'name="target"', response.content)
+        self.assertIn(b"vForeignKeyRawIdAdminField", response.content)
+        self.assertNotIn(b"<option", response.content)
+
+        request = RequestFactory().post(
+            reverse("admin:tests_modelwithcustomparentname_changelist"),
+            {"action": "move_selected_nodes", "apply": "yes", "target": ""},
+        )
+        request.user = self.user
+        request._messages = CookieStorage(request)
+        with patch.object(TreeSkeleton, "load", side_effect=AssertionError):
+            # A few nodes are moved one by one, without loading the whole tree.
+            self.assertIsNone(self.parent_admin.move_selected_nodes(request, queryset))
+
+        # The descendants of the selected nodes move along, new trees are placed after the existing trees.
+        roots = ModelWithCustomParentName.objects.filter(chief=None).order_by("tree_id")
+        self.assertEqual([node.field5 for node in roots], ["root", "b", "d"])
+        self.c.refresh_from_db()
+        self.assertEqual(self.c.chief_id, self.b.pk)
+
+        request = RequestFactory().post(
+            reverse("admin:tests_modelwithcustomparentname_changelist"),
+            {"action": "move_selected_nodes", "apply": "yes", "target": self.a.pk},
+        )
+        request.user = self.user
+        request._messages = CookieStorage(request)
+        self.assertIsNone(self.parent_admin.move_selected_nodes(request, queryset))
+        self.d.refresh_from_db()
+        self.assertEqual(self.d.chief_id, self.a.pk)
+
+    def test_reorder_children(self):
+        request = RequestFactory().post(
+            reverse("admin:tests_modelwithcustomparentname_children_reordered"),
+            {"parent_id": self.root.pk, "ordered_ids": json.dumps([self.d.pk, self.a.pk])},
+        )
+        request.user = self.user
+        data = json.loads(self.parent_admin.api_children_reordered_view(request).content.decode())
+        self.assertEqual(data["action"], "success")
+        self.assertEqual([position[0] for position in data["positions"]], [self.d.pk, self.a.pk])
+        self.assertEqual(
+            [node.field5 for node in ModelWithCustomParentName.objects.filter(tree_id=self.root.tree_id)],
+            ["root", "d", "a", "b", "c"],
+        )
+
+        # A child was added in the meantime.
+        ModelWithCustomParentName.objects.create(field5="e", chief=self.root)
+        response = self.parent_admin.api_children_reordered_view(request)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.content.decode())["action"], "reload")
+
+    def test_tree_changes_disabled(self):
+        # The change stream keeps a server thread busy, so it's disabled by default.
+        self.assertIsNone(self.parent_admin.api_tree_changes_view_url)
+        request = self.get_request("admin:tests_modelwithcustomparentname_tree_changes", {"since": 1})
+        with self.assertRaises(Http404):
+            self.parent_admin.api_tree_changes_view(request)
+
+        # The versions in a local-memory cache are not seen by other processes.
+        with patch.object(self.parent_admin, "tree_changes_timeout", 0):
+            self.assertIsNone(self.parent_admin.api_tree_changes_view_url)
+
+    def test_tree_changes(self):
+        with shared_cache(), patch.object(self.parent_admin, "tree_changes_timeout", 0):
+            self.assertIsNotNone(self.parent_admin.api_tree_changes_view_url)
+            self.check_tree_changes()
+
+    def check_tree_changes(self):
+        version = json.loads(self.get_tree_data().content.decode())["version"]
+        request = self.get_request("admin:tests_modelwithcustomparentname_tree_changes", {"since": version})
+        data = json.loads(self.parent_admin.api_tree_changes_view(request).content.decode())
+        self.assertEqual(data, {"version": version, "changes": []})
+
+        self.move(self.d, self.a, previous_parent=self.root)
+        data = json.loads(self.parent_admin.api_tree_changes_view(request).content.decode())
+        self.assertGreater(data["version"], version)
+        self.d.refresh_from_db()
+        self.assertIn(
+            {
+                "action": "move",
+                "pk": self.d.pk,
+                "parent_id": self.a.pk,
+                "tree_id": self.d.tree_id,
+                "lft": self.d.lft,
+                "rght": self.d.rght,
+                "level": self.d.level,
+            },
+            data["changes"],
+        )
+
+    def get_changelist(self, data=None):
+        request = self.get_request("admin:tests_modelwithcustomparentname_changelist", data)
+        return self.parent_admin.get_changelist_instance(request)
+
+    def test_deep_tree(self):
+        # A tree that is deeper than the recursion limit.
+        depth = sys.getrecursionlimit() + 10
+        records = [
+            {
+                "model": "tests.modelwithcustomparentname",
+                "pk": level + 1,
+                "parent": level or None,
+                "lft": level + 1,
+                "rght": 2 * depth - level,
+                "level": level,
+                "fields": {"field5": "deep"},
+            }
+            for level in range(depth)
+        ]
+        load_tree_records(records, ModelWithCustomParentName)
+        cl = self.get_changelist({"field5": "deep"})
+
+        data = get_jqtree_data(cl)["nodes"]
+        levels = 0
+        while data:
+            levels += 1
+            data = data[0].get("children")
+        self.assertEqual(levels, depth)
+
+        template = Template(
+            "{% load polymorphic_tree_admin_tags %}"
+            "{% adminlist_recursetree cl %}[{{ first_column }}{{ children }}]{% endadminlist_recursetree %}"
+        )
+        rendered = template.render(Context({"cl": cl}))
+        self.assertEqual(rendered, "[deep" * depth + "]" * depth)
+
+    def test_label_template(self):
+        cl = self.get_changelist({"node": self.a.pk})
+        data = get_jqtree_data(cl, label_template="tests/node_label.html")["nodes"]
+        self.assertEqual(data[0]["html"], '<a href="{}">b</a>\n'.format(cl.url_for_result(self.b)))
+
+    def test_single_column_evaluation(self):
+        calls = []
+
+        def column(node):
+            calls.append(node.pk)
+            return "column-" + node.field5
+
+        cl = self.get_changelist()
+        cl.list_display = ["field5", column]
+        cl.formset = None
+        rows = list(stylable_results(cl))
+        data = get_jqtree_data(cl)
+
+        self.assertEqual(sorted(calls), sorted([self.root.pk, self.a.pk, self.d.pk]))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(data["nodes"][0]["c"], ["root", "column-root"])
+
+    def test_preview_urls(self):
+        calls = []
+
+        def get_absolute_urls(nodes):
+            calls.append([node.pk for node in nodes])
+            return {node.pk: "/{}/".format(node.field5) for node in nodes}
+
+        with patch.object(ModelWithCustomParentName, "get_absolute_url", lambda node: "/slow/", create=True):
+            with patch.object(ModelWithCustomParentName, "get_absolute_urls", get_absolute_urls, create=True):
+                cl = self.get_changelist()
+                data = get_jqtree_data(cl)
+                self.assertEqual(calls, [[self.root.pk, self.a.pk, self.d.pk]])
+                self.assertIn('href="/root/"', data["nodes"][0]["c"][1])
+
+                # The children that are loaded on demand.
+                data = json.loads(self.get_tree_data({"node": self.a.pk}).content.decode())
+                self.assertEqual(calls[1], [self.b.pk])
+                self.assertIn('href="/b/"', data["nodes"][0]["c"][1])
+
+            # Without the batch hook, every node is resolved by itself.
+            self.assertIn('href="/slow/"', self.parent_admin.actions_column(self.c))
+
+        self.assertNotIn("/slow/", self.parent_admin.actions_column(self.c))
+
+    def test_column_plan(self):
+        cl = self.get_changelist()
+        cl.formset = None
+        plan = get_column_plan(cl)
+        self.assertEqual([column.name for column in plan.columns], ["action_checkbox", "field5", "actions_column"])
+
+        field5 = plan.by_name["field5"]
+        self.assertTrue(field5.is_indented)
+        self.assertEqual(field5.link_tag, "th")
+        actions = plan.by_name["actions_column"]
+        self.assertEqual(actions.attr, self.parent_admin.actions_column)
+        self.assertFalse(actions.is_indented)
+        self.assertIsNone(actions.link_tag)
+
+        # The rows only use the resolved columns.
+        cl.result_list = list(cl.result_list)
+        with patch.object(cl.lookup_opts, "get_field", side_effect=AssertionError):
+            rows = list(stylable_results(cl))
+        self.assertEqual(len(rows), 3)
+        self.assertIn(
+            '<th style="padding-left:15px"><a href="{}">a</a></th>'.format(cl.url_for_result(self.a)), rows[1]
+        )
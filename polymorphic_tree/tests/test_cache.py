@@ -0,0 +1,145 @@
+from django.contrib.admin.models import LogEntry
+from django.core.cache import cache
+from django.db.models.deletion import Collector
+from django.db.models.signals import post_delete
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from polymorphic_tree.cache import TreeCache, TreeChange, bump_version, get_changes, get_tree_version, get_version
+from polymorphic_tree.tests.models import Base, ModelX, ModelY
+
+
+class TreeCacheTests(TransactionTestCase):
+    """
+    Tests for the cached tree structure.
+    The versions are updated when the transaction is committed.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.root = Base.objects.create(field_b="root")
+        self.a = ModelX.objects.create(field_b="a", field_x="X", parent=self.root)
+        self.b = ModelY.objects.create(field_b="b", field_y="Y", parent=self.a)
+        self.c = ModelX.objects.create(field_b="c", field_x="X", parent=self.root)
+        self.other = Base.objects.create(field_b="other")
+        self.tree_cache = TreeCache(Base, fields=("field_b",))
+
+    def titles(self, nodes):
+        return [node.fields["field_b"] for node in nodes]
+
+    def test_lookups(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.titles(self.tree_cache.children(self.root)), ["a", "c"])
+            self.assertEqual(self.titles(self.tree_cache.ancestors(self.b)), ["root", "a"])
+            self.assertEqual(
+                self.titles(self.tree_cache.ancestors(self.b, include_self=True, ascending=True)), ["b", "a", "root"]
+            )
+            self.assertEqual(self.titles(self.tree_cache.descendants(self.root)), ["a", "b", "c"])
+            self.assertEqual(self.titles(self.tree_cache.descendants(self.a, include_self=True)), ["a", "b"])
+
+        # Another process reads the shared cache.
+        with self.assertNumQueries(0):
+            tree = TreeCache(Base, fields=("field_b",)).get_tree(self.root.tree_id)
+        self.assertEqual(tree.get(self.b.pk).parent_id, self.a.pk)
+
+    def test_invalidation(self):
+        root_version = get_tree_version(Base, self.root.tree_id)
+        other_version = get_tree_version(Base, self.other.tree_id)
+        version = get_version(Base)
+
+        self.b.field_b = "changed"
+        self.b.save()
+        self.assertNotEqual(get_tree_version(Base, self.root.tree_id), root_version)
+        self.assertEqual(get_tree_version(Base, self.other.tree_id), other_version)
+        self.assertGreater(get_version(Base), version)
+        self.assertEqual(self.titles(self.tree_cache.children(self.a)), ["changed"])
+
+        # Moves within the tree only mark that tree as outdated.
+        root_version = get_tree_version(Base, self.root.tree_id)
+        self.b.move_to(self.c, "last-child")
+        self.assertNotEqual(get_tree_version(Base, self.root.tree_id), root_version)
+        self.assertEqual(get_tree_version(Base, self.other.tree_id), other_version)
+        self.assertEqual(self.titles(self.tree_cache.children(self.c)), ["changed"])
+
+        # Moving to another tree marks all trees as outdated.
+        self.c.refresh_from_db()
+        self.c.move_to(self.other, "last-child")
+        self.assertNotEqual(get_tree_version(Base, self.other.tree_id), other_version)
+
+        self.other.refresh_from_db()
+        self.assertEqual(self.titles(self.tree_cache.descendants(self.other)), ["c", "changed"])
+
+        self.a.delete()
+        self.assertEqual(self.titles(self.tree_cache.descendants(self.root)), [])
+
+    def test_bump_version(self):
+        self.tree_cache.get_tree(self.root.tree_id)
+        Base.objects.filter(pk=self.a.pk).update(field_b="updated")
+        bump_version(Base, [self.root.tree_id])
+        self.assertEqual(self.titles(self.tree_cache.children(self.root)), ["updated", "c"])
+
+    def test_stampede_lock(self):
+        tree_cache = TreeCache(Base)
+        tree_cache.lock_timeout = 0.1
+        tree_id = self.root.tree_id
+        key = "{}:{}:{}".format(tree_cache._key_prefix, tree_id, get_tree_version(Base, tree_id))
+
+        # Another process is building the tree, but doesn't finish in time.
+        cache.add(key + ":lock", 1)
+        tree = tree_cache.get_tree(tree_id)
+        self.assertEqual(len(tree), 4)
+        self.assertIsNone(cache.get(key))
+
+    def test_changes(self):
+        version = get_version(Base)
+        self.assertEqual(get_changes(Base, version), (version, []))
+
+        d = ModelX.objects.create(field_b="d", field_x="X", parent=self.c)
+        self.b.move_to(self.c, "first-child")
+        a_pk = self.a.pk
+        self.a.delete()
+        version, changes = get_changes(Base, version)
+        self.assertEqual(version, get_version(Base))
+        self.assertEqual(changes[0], TreeChange("add", d.pk, self.c.pk, self.root.tree_id, 7, 8, 2))
+        self.assertIn(("move", self.b.pk, self.c.pk), [change[:3] for change in changes])
+        self.assertEqual(changes[-1][:2], ("delete", a_pk))
+
+        # Bulk changes are not listed, the readers should load the trees again.
+        bump_version(Base)
+        self.assertIsNone(get_changes(Base, version)[1])
+
+    def test_delete_subtree(self):
+        version = get_version(Base)
+        deleted_pks = {self.a.pk, self.b.pk}
+        self.a.delete()
+
+        # The deleted nodes are a single version.
+        self.assertEqual(get_version(Base), version + 1)
+        changes = get_changes(Base, version)[1]
+        self.assertEqual({change.action for change in changes}, {"delete"})
+        self.assertEqual({change.pk for change in changes}, deleted_pks)
+
+    def test_signal_senders(self):
+        # Other models can still be deleted without loading them.
+        self.assertTrue(post_delete.has_listeners(ModelX))
+        self.assertFalse(post_delete.has_listeners(LogEntry))
+        self.assertTrue(Collector(using="default").can_fast_delete(LogEntry.objects.all()))
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}})
+    def test_dummy_cache(self):
+        root = Base.objects.create(field_b="root")
+        ModelX.objects.create(field_b="a", field_x="X", parent=root)
+        self.assertIsNone(get_version(Base))
+        self.assertEqual(get_changes(Base, 0), (None, None))
+        self.assertEqual(len(TreeCache(Base).get_tree(root.tree_id)), 2)
+
+
+class TreeCacheTransactionTests(TestCase):
+    """
+    Tests for the version updates inside a transaction.
+    """
+
+    def test_version_after_commit(self):
+        version = get_version(Base)
+        Base.objects.create(field_b="root")
+        # The test transaction is never committed, so readers still see the old version.
+        self.assertEqual(get_version(Base), version)
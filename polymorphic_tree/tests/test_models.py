@@ -1,7 +1,13 @@
+from io import StringIO
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import CommandError, call_command
 from django.db.models import Q
 from django.test import TestCase
 
 from polymorphic_tree.managers import PolymorphicMPTTModelManager
+from polymorphic_tree.registry import node_type_registry
+from polymorphic_tree.skeleton import NodePosition
 
 from .models import *
 
@@ -253,6 +259,117 @@ class MPTTTests(TestCase):
         self.assertEqual(list(child.get_ancestors(ascending=True)), [root_node])
         self.assertEqual(list(grandchild.get_ancestors(ascending=True)), [child, root_node])
 
+    def test_ancestors_map(self):
+        root_node = Base.objects.create(field_b="root")
+        child = ModelX.objects.create(field_b="child", field_x="ModelX", parent=root_node)
+        grandchild = ModelY.objects.create(field_b="grandchild", field_y="ModelY", parent=child)
+        sibling = ModelY.objects.create(field_b="sibling", field_y="ModelY", parent=root_node)
+        other_root = Base.objects.create(field_b="other")
+
+        ancestors = Base.objects.all().ancestors_map()
+        self.assertEqual(ancestors[root_node.pk], [])
+        self.assertEqual(ancestors[child.pk], [root_node])
+        self.assertEqual(ancestors[grandchild.pk], [root_node, child])
+        self.assertEqual(ancestors[sibling.pk], [root_node])
+        self.assertEqual(ancestors[other_root.pk], [])
+
+        ancestors = Base.objects.filter(pk=grandchild.pk).ancestors_map(include_self=True, ascending=True)
+        self.assertEqual(ancestors, {grandchild.pk: [grandchild, child, root_node]})
+
+    def test_ancestors_map_branches(self):
+        # The ancestors of the first node should not be reported for a node in a later branch.
+        a = Base.objects.create(field_b="A")
+        b = Base.objects.create(field_b="B", parent=a)
+        node1 = Base.objects.create(field_b="N1", parent=b)
+        d = Base.objects.create(field_b="D", parent=Base.objects.get(pk=a.pk))
+        Base.objects.create(field_b="X", parent=d)
+        node2 = Base.objects.create(field_b="N2", parent=Base.objects.get(pk=d.pk))
+
+        ancestors = Base.objects.filter(pk__in=[node1.pk, node2.pk]).ancestors_map()
+        self.assertEqual(ancestors, {node1.pk: [a, b], node2.pk: [a, d]})
+
+    def test_ancestors_map_large_tree(self):
+        # SQLite rejects a condition per node for thousands of nodes.
+        root_node = Base.objects.create(field_b="root")
+        Base.objects.bulk_load([{"field_b": str(i)} for i in range(3000)], target=root_node)
+
+        with self.assertNumQueries(2):  # The nodes, and the ancestors of the siblings
+            ancestors = Base.objects.non_polymorphic().ancestors_map()
+        self.assertEqual(len(ancestors), 3001)
+        self.assertEqual({len(value) for value in ancestors.values()}, {0, 1})
+
+        # Every node has its own condition, these are split over multiple queries.
+        ancestors = Base.objects.non_polymorphic().ancestors_map(include_self=True)
+        self.assertEqual(ancestors[root_node.pk], [root_node])
+        self.assertEqual({len(value) for value in ancestors.values()}, {1, 2})
+
+    def test_with_closest_ancestor_of_type(self):
+        root_node = Base.objects.create(field_b="root")
+        child = ModelX.objects.create(field_b="child", field_x="ModelX", parent=root_node)
+        grandchild = ModelY.objects.create(field_b="grandchild", field_y="ModelY", parent=child)
+        sibling = ModelY.objects.create(field_b="sibling", field_y="ModelY", parent=root_node)
+
+        # 1 query for the nodes, 1 query for the ancestors in the tree, and the polymorphic queries per type.
+        with self.assertNumQueries(4):
+            nodes = list(Base.objects.instance_of(ModelY).with_closest_ancestor_of_type(ModelX))
+            self.assertEqual([node.closest_modelx for node in nodes], [grandchild.parent, None])
+
+        for node in nodes:
+            self.assertEqual(node.closest_modelx, node.get_closest_ancestor_of_type(ModelX))
+
+        nodes = Base.objects.with_closest_ancestor_of_type(ModelX, include_self=True, to_attr="section")
+        self.assertEqual(
+            {node.pk: node.section for node in nodes},
+            {root_node.pk: None, child.pk: child, grandchild.pk: child, sibling.pk: None},
+        )
+
+    def test_with_descendant_counts(self):
+        root_node = Base.objects.create(field_b="root")
+        child = ModelX.objects.create(field_b="child", field_x="ModelX", parent=root_node)
+        ModelY.objects.create(field_b="grandchild", field_y="ModelY", parent=child)
+        ModelY.objects.create(field_b="sibling", field_y="ModelY", parent=root_node)
+        ctypes = ContentType.objects.get_for_models(ModelX, ModelY, for_concrete_models=False)
+        x_id, y_id = ctypes[ModelX].id, ctypes[ModelY].id
+
+        # The nodes, the polymorphic queries per type and the counts.
+        with self.assertNumQueries(4):
+            counts = {node.field_b: node.descendant_counts for node in Base.objects.with_descendant_counts()}
+
+        self.assertEqual(counts, {"root": {x_id: 1, y_id: 2}, "child": {y_id: 1}, "grandchild": {}, "sibling": {}})
+
+        nodes = Base.objects.filter(level=0).with_descendant_counts(ModelX, to_attr="sections")
+        self.assertEqual([node.sections for node in nodes], [{x_id: 1}])
+
+    def test_get_cached_polymorphic_trees(self):
+        root_node = Base.objects.create(field_b="root")
+        child = ModelX.objects.create(field_b="child", field_x="ModelX", parent=root_node)
+        grandchild = ModelY.objects.create(field_b="grandchild", field_y="ModelY", parent=child)
+        sibling = ModelY.objects.create(field_b="sibling", field_y="ModelY", parent=root_node)
+        other_root = ModelX.objects.create(field_b="other", field_x="ModelX")
+
+        def walk(nodes):
+            return [(node, node.parent, walk(node.get_children())) for node in nodes]
+
+        # The base table, and one query for each subclass.
+        with self.assertNumQueries(3):
+            roots = Base.objects.get_cached_polymorphic_trees()
+            tree = walk(roots)
+            self.assertEqual(list(roots[0].get_children()[0].get_children()[0].get_ancestors()), [root_node, child])
+
+        self.assertEqual(
+            tree,
+            [
+                (root_node, None, [(child, root_node, [(grandchild, child, [])]), (sibling, root_node, [])]),
+                (other_root, None, []),
+            ],
+        )
+        self.assertIsInstance(tree[0][2][0][2][0][0], ModelY)
+
+        # Nodes without a parent in the selection become top-level nodes.
+        roots = Base.objects.filter(level__gt=0).get_cached_polymorphic_trees()
+        self.assertEqual(roots, [child, sibling])
+        self.assertEqual(list(roots[0].get_children()), [grandchild])
+
     def test_is_ancestor_of(self):
         root_node = Base.objects.create(field_b="root")
         child = ModelX.objects.create(field_b="child", field_x="ModelX", parent=root_node)
@@ -295,6 +412,32 @@ class MPTTTests(TestCase):
         msg = context.exception.args[0]["parent"]
         self.assertIn("a model restricted children does not allow model y as a child!", msg)
 
+    def test_child_type_validation_queries(self):
+        root_node = ModelRestrictedChildren.objects.create(field_b="root")
+
+        # Only the foreign key check and the parent content type are queried, the parent is not fetched.
+        valid_child = ModelX(field_b="child", field_x="ModelX", parent_id=root_node.pk)
+        with self.assertNumQueries(2):
+            valid_child.full_clean()
+
+        # With a cached parent object, the content type is known already.
+        valid_child = ModelX(field_b="child", field_x="ModelX", parent=root_node)
+        with self.assertNumQueries(1):
+            valid_child.full_clean()
+
+        invalid_child = ModelY(field_b="child", field_y="ModelY", parent_id=root_node.pk)
+        with self.assertRaises(ValidationError) as context:
+            invalid_child.full_clean()
+        self.assertIn(
+            "The selected parent cannot have this node type as a child!", context.exception.message_dict["parent"]
+        )
+
+    def test_no_children_validation(self):
+        leaf = ModelWithoutChildren.objects.create(field_b="leaf")
+        node = ModelX(field_b="child", field_x="ModelX", parent=leaf)
+        self.assertRaisesMessage(ValidationError, "does not allow children!", node.clean)
+        self.assertRaises(InvalidMove, node.validate_move, leaf)
+
     def test_tree_manager(self):
         # Having the tree manager correct is absolutely essential,
         # so our move validation is also triggered.
@@ -312,3 +455,607 @@ class MPTTTests(TestCase):
         node.parent = parent
         node.clean()
         node.save()
+
+
+class NodeTypeRegistryTests(TestCase):
+    """
+    Tests for the resolved tree rules.
+    """
+
+    def test_resolved_rules(self):
+        ct_x = ContentType.objects.get_for_model(ModelX).id
+        ct_y = ContentType.objects.get_for_model(ModelY).id
+        ct_restricted = ContentType.objects.get_for_model(ModelRestrictedByName).id
+
+        node_type = node_type_registry.get_for_model(ModelRestrictedByName)
+        self.assertEqual(node_type.ctype_id, ct_restricted)
+        self.assertEqual(node_type.child_types, (ct_restricted, ct_y, ct_x))
+        self.assertTrue(node_type_registry.is_child_allowed(ct_restricted, ct_x))
+        self.assertFalse(
+            node_type_registry.is_child_allowed(
+                node_type_registry.get_for_model(ModelRestrictedChildren).ctype_id, ct_y
+            )
+        )
+
+        no_children = node_type_registry.get_for_model(ModelWithoutChildren)
+        self.assertFalse(no_children.can_have_children)
+        self.assertFalse(no_children.is_child_allowed(ct_x))
+        self.assertFalse(node_type_registry.get_for_model(ModelMustBeChild).can_be_root)
+
+    def test_get_child_types_cached(self):
+        root_node = ModelRestrictedChildren.objects.create(field_b="root")
+        root_node.get_child_types()
+
+        # No queries or per-instance caches, the types are resolved per class.
+        with self.assertNumQueries(0):
+            self.assertEqual(root_node.get_child_types(), [ContentType.objects.get_for_model(ModelX).id])
+            self.assertTrue(root_node.is_child_allowed(ModelX(field_b="child")))
+            self.assertFalse(root_node.is_child_allowed(ModelY(field_b="child")))
+
+        # Also works for nodes that are not downcasted.
+        upcasted = Base.objects.non_polymorphic().get(pk=root_node.pk)
+        self.assertEqual(upcasted.get_child_types(), root_node.get_child_types())
+
+
+class TreeRuleCheckTests(TestCase):
+    """
+    Tests for checking the tree rules of existing nodes.
+    """
+
+    def test_check_tree_rules(self):
+        root_node = ModelRestrictedChildren.objects.create(field_b="root")
+        child = ModelX.objects.create(field_b="child", field_x="ModelX", parent=root_node)
+        grandchild = ModelX.objects.create(field_b="grandchild", field_x="ModelX", parent=child)
+        leaf = ModelWithoutChildren.objects.create(field_b="leaf", parent=child)
+        self.assertEqual(list(Base.objects.check_tree_rules()), [])
+
+        # Simulate changes that bypassed the validation.
+        ct_y = ContentType.objects.get_for_model(ModelY).id
+        Base.objects.filter(pk=child.pk).update(polymorphic_ctype_id=ct_y)
+        Base.objects.filter(pk=grandchild.pk).update(parent=leaf, lft=leaf.lft + 1, rght=leaf.lft + 2, level=2)
+
+        with self.assertNumQueries(1):
+            violations = list(Base.objects.check_tree_rules(chunk_size=2))
+
+        self.assertEqual(
+            [(v.pk, v.code) for v in violations],
+            [(child.pk, "child_not_allowed"), (grandchild.pk, "no_children_allowed")],
+        )
+
+    def test_check_tree_rules_root(self):
+        node = ModelMustBeChildRoot.objects.create(field8="root")
+        ModelMustBeChild.objects.create(field8="child", parent=node)
+        self.assertEqual(list(ModelMustBeChildRoot.objects.check_tree_rules()), [])
+
+        ModelMustBeChildRoot.objects.filter(pk=node.pk).update(
+            polymorphic_ctype=ContentType.objects.get_for_model(ModelMustBeChild)
+        )
+        violations = list(ModelMustBeChildRoot.objects.check_tree_rules())
+        self.assertEqual([(v.pk, v.code) for v in violations], [(node.pk, "required")])
+
+    def test_check_command(self):
+        root_node = ModelRestrictedChildren.objects.create(field_b="root")
+        child = ModelX.objects.create(field_b="child", field_x="ModelX", parent=root_node)
+
+        stdout = StringIO()
+        call_command("check_polymorphic_tree", "tests.Base", "tests.ModelX", stdout=stdout, stderr=StringIO())
+        self.assertEqual(stdout.getvalue(), "")
+
+        Base.objects.filter(pk=child.pk).update(polymorphic_ctype=ContentType.objects.get_for_model(ModelY))
+        with self.assertRaises(CommandError):
+            call_command("check_polymorphic_tree", "tests.Base", stdout=stdout, stderr=StringIO())
+        self.assertIn("tests.Base #{}: ".format(child.pk), stdout.getvalue())
+
+
+class BulkLoadTests(TestCase):
+    """
+    Tests for loading a complete tree at once.
+    """
+
+    def test_bulk_load(self):
+        nodes = Model2A.objects.bulk_load(
+            [
+                {
+                    "model": Model2D,
+                    "field1": "D1",
+                    "field2": "D2",
+                    "field3": "D3",
+                    "field4": "D4",
+                    "children": [
+                        {"field1": "A1"},
+                        {"model": "tests.Model2B", "field1": "B1", "field2": "B2", "children": [{"field1": "A2"}]},
+                    ],
+                },
+                {"model": Model2C, "field1": "C1", "field2": "C2", "field3": "C3"},
+            ]
+        )
+        self.assertEqual(len(nodes), 5)
+
+        root = Model2A.objects.get(field1="D1")
+        self.assertIsInstance(root, Model2D)
+        self.assertEqual((root.field4, root.lft, root.rght, root.level), ("D4", 1, 8, 0))
+        self.assertEqual([node.field1 for node in root.get_descendants()], ["A1", "B1", "A2"])
+        self.assertEqual(Model2A.objects.get(field1="A2").parent, Model2A.objects.get(field1="B1"))
+        self.assertEqual(Model2B.objects.get(field1="B1").field2, "B2")
+        self.assertEqual(Model2A.objects.get(field1="C1").tree_id, root.tree_id + 1)
+
+        # The calculated tree must match what mptt would produce.
+        before = list(Model2A.objects.values_list("pk", "parent", "tree_id", "lft", "rght", "level"))
+        Model2A.objects.rebuild()
+        self.assertEqual(list(Model2A.objects.values_list("pk", "parent", "tree_id", "lft", "rght", "level")), before)
+
+    def test_bulk_load_at_target(self):
+        root = Base.objects.create(field_b="root")
+        first = ModelX.objects.create(field_b="first", field_x="X", parent=root)
+        last = ModelY.objects.create(field_b="last", field_y="Y", parent=root)
+
+        Base.objects.bulk_load(
+            {"model": ModelY, "field_b": "new", "field_y": "Y", "children": [{"field_b": "sub"}]},
+            target=first,
+            position="right",
+        )
+        root.refresh_from_db()
+        self.assertEqual(
+            [node.field_b for node in root.get_descendants()],
+            ["first", "new", "sub", "last"],
+        )
+        self.assertEqual(root.rght, 10)
+        self.assertEqual(list(Base.objects.check_tree_rules()), [])
+
+    def test_save_loaded_nodes(self):
+        root, first, last = Base.objects.bulk_load(
+            {"field_b": "root", "children": [{"field_b": "first"}, {"field_b": "last"}]}
+        )
+        first.field_b = "changed"
+        first.save()
+        root.save()
+        root.refresh_from_db()
+        self.assertEqual([node.field_b for node in root.get_descendants()], ["changed", "last"])
+
+    def test_bulk_load_validation(self):
+        root = ModelRestrictedChildren.objects.create(field_b="root")
+        with self.assertRaises(InvalidMove):
+            Base.objects.bulk_load(
+                {
+                    "model": ModelX,
+                    "field_b": "x",
+                    "children": [{"model": ModelWithoutChildren, "field_b": "leaf", "children": [{"field_b": "sub"}]}],
+                },
+                target=root,
+            )
+        with self.assertRaises(InvalidMove):
+            Base.objects.bulk_load({"model": ModelY, "field_b": "y"}, target=root)
+
+        self.assertEqual(Base.objects.count(), 1)
+
+
+class MoveNodesTests(TestCase):
+    """
+    Tests for moving many nodes at once.
+    """
+
+    def setUp(self):
+        self.root = Base.objects.create(field_b="root")
+        self.a = ModelX.objects.create(field_b="a", field_x="X", parent=self.root)
+        self.b = ModelY.objects.create(field_b="b", field_y="Y", parent=self.root)
+        self.c = ModelX.objects.create(field_b="c", field_x="X", parent=self.root)
+        self.other = Base.objects.create(field_b="other")
+        self.d = ModelY.objects.create(field_b="d", field_y="Y", parent=self.other)
+        self.last = Base.objects.create(field_b="last")
+
+    def assertTreeValid(self):
+        # A rebuild doesn't preserve gaps in the tree_id, but should give the same structure.
+        values = list(Base.objects.values_list("pk", "parent", "lft", "rght", "level"))
+        Base.objects.rebuild()
+        self.assertEqual(list(Base.objects.values_list("pk", "parent", "lft", "rght", "level")), values)
+
+    def get_tree(self, root):
+        root.refresh_from_db()
+        return [(node.field_b, node.level) for node in root.get_descendants(include_self=True)]
+
+    def test_move_within_tree(self):
+        with self.assertNumQueries(4):  # savepoint, skeleton, update, release
+            changed = Base.objects.move_nodes(
+                [
+                    (self.c, self.root, "first-child"),
+                    (self.a, self.b, "last-child"),
+                ]
+            )
+
+        self.assertEqual(self.get_tree(self.root), [("root", 0), ("c", 1), ("b", 1), ("a", 2)])
+        self.assertEqual(self.a.parent_id, self.b.pk)
+        self.assertEqual({position.pk for position in changed}, {self.a.pk, self.b.pk, self.c.pk})
+        self.assertTreeValid()
+
+    def test_move_between_trees(self):
+        Base.objects.move_nodes(
+            [
+                (self.b, self.d, "left"),
+                (self.other, self.root, "last-child"),
+            ]
+        )
+        self.assertEqual(
+            self.get_tree(self.root),
+            [("root", 0), ("a", 1), ("c", 1), ("other", 1), ("b", 2), ("d", 2)],
+        )
+        self.assertTreeValid()
+
+    def test_swap_subtrees_between_trees(self):
+        ModelX.objects.create(field_b="a1", field_x="X", parent=self.a)
+        self.d.refresh_from_db()
+        ModelX.objects.create(field_b="d1", field_x="X", parent=self.d)
+        self.a.refresh_from_db()
+        self.d.refresh_from_db()
+
+        Base.objects.move_nodes([(self.a, self.other, "first-child"), (self.d, self.root, "last-child")])
+        self.assertEqual(
+            self.get_tree(self.root),
+            [("root", 0), ("b", 1), ("c", 1), ("d", 1), ("d1", 2)],
+        )
+        self.assertEqual(self.get_tree(self.other), [("other", 0), ("a", 1), ("a1", 2)])
+        self.assertTreeValid()
+
+    def test_move_in_large_tree(self):
+        # The moved blocks are shifted, so the number of queries doesn't depend on the size of the tree.
+        Base.objects.bulk_load([{"field_b": str(i)} for i in range(500)], target=self.c)
+        self.a.refresh_from_db()
+        self.c.refresh_from_db()
+
+        with self.assertNumQueries(4):  # savepoint, skeleton, update, release
+            Base.objects.move_nodes([(self.a, self.c, "last-child")])
+        self.assertEqual(self.get_tree(self.c)[-1], ("a", 2))
+        self.assertTreeValid()
+
+    def test_move_to_root(self):
+        Base.objects.move_nodes(
+            [
+                (self.b, self.other, "left"),
+                (self.c, None, "last-child"),
+                (self.a, self.last, "right"),
+            ]
+        )
+        roots = [(node.field_b, node.tree_id) for node in Base.objects.filter(parent=None)]
+        self.assertEqual(roots, [("root", 1), ("b", 2), ("other", 3), ("last", 4), ("a", 5), ("c", 6)])
+        self.assertTreeValid()
+
+    def test_move_next_to_other_tree(self):
+        # The tree of "other" is not loaded, but should stay in between.
+        Base.objects.move_nodes([(self.a, self.last, "left"), (self.b, self.root, "right"), (self.c, self.a, "right")])
+        roots = [(node.field_b, node.tree_id) for node in Base.objects.filter(parent=None)]
+        self.assertEqual(roots, [("root", 1), ("b", 2), ("other", 3), ("a", 4), ("c", 5), ("last", 6)])
+        self.assertTreeValid()
+
+    def test_move_root_to_root(self):
+        # Like move_to(), a root node stays in place.
+        self.assertEqual(Base.objects.move_nodes([(self.other, None, "last-child")]), [])
+        roots = [(node.field_b, node.tree_id) for node in Base.objects.filter(parent=None)]
+        self.assertEqual(roots, [("root", 1), ("other", 2), ("last", 3)])
+
+    def test_move_validation(self):
+        restricted = ModelRestrictedChildren.objects.create(field_b="restricted")
+        before = list(Base.objects.values_list("pk", "parent", "tree_id", "lft", "rght", "level"))
+
+        with self.assertRaises(InvalidMove):
+            Base.objects.move_nodes([(self.a, restricted, "last-child"), (self.b, restricted, "last-child")])
+        with self.assertRaises(InvalidMove):
+            Base.objects.move_nodes([(self.root, self.a, "last-child")])
+
+        self.assertEqual(list(Base.objects.values_list("pk", "parent", "tree_id", "lft", "rght", "level")), before)
+
+    def test_reorder_children(self):
+        ModelY.objects.create(field_b="a1", field_y="Y", parent=self.a)
+        ModelY.objects.create(field_b="c1", field_y="Y", parent=self.c)
+        with self.assertNumQueries(4):  # savepoint, children, update, release
+            changed = Base.objects.reorder_children(self.root, [self.c.pk, self.a.pk, self.b.pk])
+
+        self.assertEqual(self.get_tree(self.root), [("root", 0), ("c", 1), ("c1", 2), ("a", 1), ("a1", 2), ("b", 1)])
+        self.assertEqual([position.pk for position in changed], [self.c.pk, self.a.pk, self.b.pk])
+        self.assertEqual(changed[0], NodePosition(self.c.pk, self.root.pk, self.root.tree_id, 2, 5, 1))
+        self.assertTreeValid()
+
+        # Only the changed blocks are listed.
+        self.assertEqual(Base.objects.reorder_children(self.root, [self.c.pk, self.a.pk, self.b.pk]), [])
+        with self.assertRaises(ValueError):
+            Base.objects.reorder_children(self.root, [self.c.pk, self.a.pk])
+        with self.assertRaises(ValueError):
+            Base.objects.reorder_children(self.root, [self.c.pk, self.a.pk, self.d.pk])
+
+
+class DelayTreeUpdatesTests(TestCase):
+    """
+    Tests for deferring the tree updates during mass edits.
+    """
+
+    def setUp(self):
+        self.root = Base.objects.create(field_b="root")
+        self.a = ModelX.objects.create(field_b="a", field_x="X", parent=self.root)
+        self.b = ModelY.objects.create(field_b="b", field_y="Y", parent=self.root)
+        self.other = Base.objects.create(field_b="other")
+        self.c = ModelX.objects.create(field_b="c", field_x="X", parent=self.other)
+        self.last = Base.objects.create(field_b="last")
+        self.d = ModelY.objects.create(field_b="d", field_y="Y", parent=self.last)
+
+    def get_tree(self, root):
+        root.refresh_from_db()
+        return [(node.field_b, node.level) for node in root.get_descendants(include_self=True)]
+
+    def test_rebuild_affected_trees(self):
+        # Corrupt the last tree, which should not be touched by the rebuild.
+        Base.objects.filter(pk=self.d.pk).update(lft=10, rght=11)
+
+        with Base.objects.delay_tree_updates():
+            self.a.parent = self.other
+            self.a.save()
+            self.root.move_to(self.c, "last-child")
+            ModelX.objects.create(field_b="e", field_x="X", parent=self.b)
+
+        self.assertEqual(
+            self.get_tree(self.other),
+            [("other", 0), ("c", 1), ("root", 2), ("b", 3), ("e", 4), ("a", 1)],
+        )
+        self.assertEqual(Base.objects.filter(parent=None).count(), 2)
+        self.assertEqual(Base.objects.values_list("lft", "rght").get(pk=self.d.pk), (10, 11))
+
+    def test_move_to_root(self):
+        with Base.objects.delay_tree_updates():
+            self.a.parent = None
+            self.a.save()
+
+        roots = list(Base.objects.filter(parent=None).values_list("field_b", flat=True))
+        self.assertEqual(roots, ["root", "other", "last", "a"])
+        self.assertEqual(self.get_tree(self.root), [("root", 0), ("b", 1)])
+        self.assertEqual(self.get_tree(self.a), [("a", 0)])
+
+    def test_move_root_below_other_tree(self):
+        with Base.objects.delay_tree_updates():
+            self.other.parent = self.root
+            self.other.save()
+            # The tree of this node moved back, the object still has the old tree_id.
+            self.d.parent = self.root
+            self.d.save()
+
+        # The order of the children is not defined by save().
+        self.assertEqual(
+            sorted(self.get_tree(self.root)),
+            [("a", 1), ("b", 1), ("c", 2), ("d", 1), ("other", 1), ("root", 0)],
+        )
+        self.c.refresh_from_db()
+        self.assertEqual(self.c.parent_id, self.other.pk)
+        self.assertEqual(self.get_tree(self.last), [("last", 0)])
+        self.assertEqual(list(Base.objects.filter(parent=None).values_list("tree_id", flat=True)), [1, 2])
+
+    def test_move_subtree_to_other_tree(self):
+        ModelX.objects.create(field_b="e", field_x="X", parent=self.a)
+        ModelX.objects.create(field_b="f", field_x="X", parent=self.c)
+        with Base.objects.delay_tree_updates():
+            self.a.parent = self.other
+            self.a.save()
+            self.c.move_to(self.last, "last-child")
+
+        self.assertEqual(self.get_tree(self.root), [("root", 0), ("b", 1)])
+        self.assertEqual(self.get_tree(self.other), [("other", 0), ("a", 1), ("e", 2)])
+        self.assertEqual(self.get_tree(self.last), [("last", 0), ("d", 1), ("c", 1), ("f", 2)])
+
+    def test_move_below_descendant(self):
+        e = ModelX.objects.create(field_b="e", field_x="X", parent=self.a)
+        self.root.refresh_from_db()
+        before = list(Base.objects.values_list("pk", "parent", "tree_id", "lft", "rght", "level"))
+
+        with self.assertRaises(InvalidMove):
+            with Base.objects.delay_tree_updates():
+                self.root.parent = e
+                self.root.save()
+        with self.assertRaises(InvalidMove):
+            with Base.objects.delay_tree_updates():
+                self.a.move_to(e, "last-child")
+
+        self.assertEqual(list(Base.objects.values_list("pk", "parent", "tree_id", "lft", "rght", "level")), before)
+
+    def test_validation(self):
+        restricted = ModelRestrictedChildren.objects.create(field_b="restricted")
+        before = list(Base.objects.values_list("pk", "parent", "tree_id", "lft", "rght", "level"))
+
+        with self.assertRaises(InvalidMove):
+            with Base.objects.delay_tree_updates():
+                self.a.parent = restricted
+                self.a.save()
+                self.b.parent = restricted
+                self.b.save()
+
+        with self.assertRaises(InvalidMove):
+            with Base.objects.delay_tree_updates():
+                self.b.move_to(restricted, "last-child")
+
+        self.assertEqual(list(Base.objects.values_list("pk", "parent", "tree_id", "lft", "rght", "level")), before)
+
+
+class CloneSubtreeTests(TestCase):
+    """
+    Tests for copying a subtree.
+    """
+
+    def setUp(self):
+        self.root = Base.objects.create(field_b="root")
+        self.a = ModelX.objects.create(field_b="a", field_x="X", parent=self.root)
+        self.b = ModelY.objects.create(field_b="b", field_y="Y", parent=self.a)
+        self.c = ModelX.objects.create(field_b="c", field_x="X2", parent=self.a)
+        self.other = Base.objects.create(field_b="other")
+        self.d = Base.objects.create(field_b="d", parent=self.other)
+
+    def get_tree(self, root):
+        root.refresh_from_db()
+        return [(node.__class__, node.field_b, node.level) for node in root.get_descendants(include_self=True)]
+
+    def test_clone_to_other_tree(self):
+        # savepoint, subtree, 2 types, space, 2 levels of the base table, 2 derived tables, release, refresh target
+        with self.assertNumQueries(11):
+            clone = Base.objects.clone_subtree(self.a, self.other, "first-child")
+
+        self.assertEqual(
+            self.get_tree(self.other),
+            [(Base, "other", 0), (ModelX, "a", 1), (ModelY, "b", 2), (ModelX, "c", 2), (Base, "d", 1)],
+        )
+        self.assertNotEqual(clone.pk, self.a.pk)
+        self.assertEqual(ModelX.objects.get(pk=clone.get_children()[1].pk).field_x, "X2")
+        self.assertEqual(
+            self.get_tree(self.root), [(Base, "root", 0), (ModelX, "a", 1), (ModelY, "b", 2), (ModelX, "c", 2)]
+        )
+
+        values = list(Base.objects.values_list("pk", "parent", "tree_id", "lft", "rght", "level"))
+        Base.objects.rebuild()
+        self.assertEqual(list(Base.objects.values_list("pk", "parent", "tree_id", "lft", "rght", "level")), values)
+
+    def test_clone_into_itself(self):
+        Base.objects.clone_subtree(self.a, self.c, "last-child")
+        self.assertEqual(
+            self.get_tree(self.a),
+            [
+                (ModelX, "a", 1),
+                (ModelY, "b", 2),
+                (ModelX, "c", 2),
+                (ModelX, "a", 3),
+                (ModelY, "b", 4),
+                (ModelX, "c", 4),
+            ],
+        )
+
+    def test_clone_to_root(self):
+        clone = Base.objects.clone_subtree(self.a, self.root, "right")
+        roots = [(node.field_b, node.tree_id) for node in Base.objects.filter(parent=None)]
+        self.assertEqual(roots, [("root", 1), ("a", 2), ("other", 3)])
+        self.assertEqual(self.get_tree(clone), [(ModelX, "a", 0), (ModelY, "b", 1), (ModelX, "c", 1)])
+
+    def test_copy_related(self):
+        pairs = []
+        Base.objects.clone_subtree(self.a, None, copy_related=pairs.extend)
+        self.assertEqual([original.pk for original, copy in pairs], [self.a.pk, self.b.pk, self.c.pk])
+        self.assertTrue(all(copy.pk and copy.pk != original.pk for original, copy in pairs))
+
+    def test_save_copies(self):
+        pairs = []
+        clone = Base.objects.clone_subtree(self.a, self.other, "first-child", copy_related=pairs.extend)
+        first_copy = pairs[1][1]
+        first_copy.field_b = "changed"
+        first_copy.save()
+        clone.save()
+        self.assertEqual(
+            self.get_tree(self.other),
+            [(Base, "other", 0), (ModelX, "a", 1), (ModelY, "changed", 2), (ModelX, "c", 2), (Base, "d", 1)],
+        )
+
+    def test_clone_validation(self):
+        restricted = ModelRestrictedChildren.objects.create(field_b="restricted")
+        count = Base.objects.count()
+        with self.assertRaises(InvalidMove):
+            Base.objects.clone_subtree(self.b, restricted)
+        self.assertEqual(Base.objects.count(), count)
+
+
+class TreePathTests(TestCase):
+    """
+    Tests for the materialized path.
+    """
+
+    def setUp(self):
+        self.root = PathNode.objects.create(title="root")
+        self.a = PathNodeChild.objects.create(title="a", parent=self.root)
+        self.b = PathNode.objects.create(title="b", parent=self.a)
+        self.c = PathNodeChild.objects.create(title="c", parent=self.b)
+        self.other = PathNode.objects.create(title="other")
+
+    def assertPathsValid(self):
+        for node in PathNode.objects.all():
+            expected = [ancestor.pk for ancestor in node.get_ancestors()]
+            self.assertEqual(node.get_ancestor_pks(), expected, node.title)
+
+    def test_insert(self):
+        self.assertEqual(self.root.path, "/")
+        self.assertEqual(self.c.path, "/{}/{}/{}/".format(self.root.pk, self.a.pk, self.b.pk))
+        self.assertEqual(self.c.get_ancestor_pks(), [self.root.pk, self.a.pk, self.b.pk])
+        self.assertPathsValid()
+
+    def test_move(self):
+        self.b.move_to(self.other, "last-child")
+        self.assertPathsValid()
+
+        self.a.parent = None
+        self.a.save()
+        self.assertPathsValid()
+
+        # Saving an outdated object should not overwrite the path.
+        self.c.title = "changed"
+        self.c.save()
+        self.assertPathsValid()
+
+    def test_save_parent(self):
+        # The new paths start with the old paths, which should not be extended twice.
+        sibling = PathNode.objects.create(title="sibling", parent=self.root)
+        self.a.parent = sibling
+        self.a.save()
+        self.c.refresh_from_db()
+        self.assertEqual(self.c.path, "/{}/{}/{}/{}/".format(self.root.pk, sibling.pk, self.a.pk, self.b.pk))
+        self.assertPathsValid()
+
+        self.root.refresh_from_db()
+        self.other.parent = self.root
+        self.other.save()
+        self.assertPathsValid()
+
+        with PathNode.objects.delay_tree_updates():
+            self.b.parent = self.other
+            self.b.save()
+        self.assertPathsValid()
+
+    def test_queries(self):
+        self.assertEqual(list(PathNode.objects.ancestors_by_path(self.c)), [self.root, self.a, self.b])
+        self.assertEqual(list(PathNode.objects.descendants_by_path(self.a)), [self.b, self.c])
+        self.assertEqual(
+            list(PathNode.objects.descendants_by_path(self.a, include_self=True, max_depth=1)), [self.a, self.b]
+        )
+        self.assertEqual(list(PathNode.objects.descendants_by_path(self.other)), [])
+
+    def test_bulk_operations(self):
+        PathNode.objects.move_nodes([(self.b, self.other, "last-child"), (self.a, self.other, "first-child")])
+        self.assertPathsValid()
+
+        self.other.refresh_from_db()
+        PathNode.objects.bulk_load(
+            {"title": "new", "children": [{"model": PathNodeChild, "title": "new2"}]}, self.other
+        )
+        self.root.refresh_from_db()
+        PathNode.objects.clone_subtree(self.other, self.root)
+        self.assertPathsValid()
+
+    def test_rebuild_paths(self):
+        PathNode.objects.update(path="/")
+        self.assertEqual(PathNode.objects.rebuild_paths(), 3)
+        self.assertEqual(PathNode.objects.rebuild_paths(), 0)
+        self.assertPathsValid()
+
+    def test_path_too_long(self):
+        # The path of "c" just fits, so nothing can be placed deeper.
+        path_field = PathNode._meta.get_field("path")
+        self.addCleanup(setattr, path_field, "max_length", path_field.max_length)
+        path_field.max_length = len(self.c.path)
+        before = list(PathNode.objects.values_list("pk", "parent", "tree_id", "lft", "rght", "level", "path"))
+
+        with self.assertRaises(InvalidMove):
+            PathNode.objects.create(title="d", parent=self.c)
+        with self.assertRaises(InvalidMove):
+            PathNode.objects.bulk_load({"title": "d"}, self.c)
+
+        # The descendants of a moved node need to fit too.
+        sibling = PathNode.objects.create(title="sibling", parent=self.root)
+        self.a.refresh_from_db()
+        with self.assertRaises(InvalidMove):
+            self.a.move_to(sibling, "last-child")
+        with self.assertRaises(InvalidMove):
+            PathNode.objects.move_nodes([(self.a, sibling, "last-child")])
+        sibling.delete()
+        self.assertEqual(
+            list(PathNode.objects.values_list("pk", "parent", "tree_id", "lft", "rght", "level", "path")), before
+        )
+
+        path_field.max_length = len(self.b.path)
+        with self.assertRaises(InvalidMove):
+            PathNode.objects.rebuild_paths()
@@ -0,0 +1,45 @@
+from django.test import TestCase
+
+from polymorphic_tree.paginator import TreePaginator
+from polymorphic_tree.tests.models import Base, ModelX
+
+
+class TreePaginatorTests(TestCase):
+    """
+    Tests for the pagination of complete trees and subtrees.
+    """
+
+    def setUp(self):
+        r1 = Base.objects.create(field_b="r1")
+        Base.objects.create(field_b="r1a", parent=r1)
+        Base.objects.create(field_b="r1b", parent=r1)
+
+        r2 = Base.objects.create(field_b="r2")
+        x1 = ModelX.objects.create(field_b="x1", field_x="X", parent=r2)
+        ModelX.objects.create(field_b="x1a", field_x="X", parent=x1)
+        ModelX.objects.create(field_b="x1b", field_x="X", parent=x1)
+        x2 = ModelX.objects.create(field_b="x2", field_x="X", parent=r2)
+        ModelX.objects.create(field_b="x2a", field_x="X", parent=x2)
+        ModelX.objects.create(field_b="x3", field_x="X", parent=r2)
+
+        Base.objects.create(field_b="r3")
+
+    def test_pages(self):
+        paginator = TreePaginator(Base.objects.order_by("tree_id", "lft"), per_page=4)
+
+        # The grouped count, and the large tree.
+        with self.assertNumQueries(2):
+            self.assertEqual(paginator.count, 11)
+            self.assertEqual(paginator.num_pages, 3)
+
+        pages = [[node.field_b for node in paginator.page(number).object_list] for number in paginator.page_range]
+        self.assertEqual(pages, [["r1", "r1a", "r1b"], ["r2", "x1", "x1a", "x1b"], ["x2", "x2a", "x3", "r3"]])
+
+    def test_single_page(self):
+        paginator = TreePaginator(Base.objects.order_by("tree_id", "lft"), per_page=20)
+        self.assertEqual(paginator.num_pages, 1)
+        self.assertEqual(len(paginator.page(1).object_list), 11)
+
+        paginator = TreePaginator(Base.objects.none().order_by("tree_id", "lft"), per_page=20)
+        self.assertEqual(paginator.num_pages, 1)
+        self.assertEqual(list(paginator.page(1).object_list), [])
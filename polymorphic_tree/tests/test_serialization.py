@@ -0,0 +1,93 @@
+import json
+from io import StringIO
+
+from django.test import TestCase
+from mptt.exceptions import InvalidMove
+
+from polymorphic_tree.serialization import dump_tree, iter_tree_records, load_tree
+from polymorphic_tree.tests.models import Base, ModelRestrictedChildren, ModelX, ModelY
+
+
+class SerializationTests(TestCase):
+    """
+    Tests for the streaming export and import.
+    """
+
+    def setUp(self):
+        self.root = Base.objects.create(field_b="root")
+        self.a = ModelX.objects.create(field_b="a", field_x="X", parent=self.root)
+        self.b = ModelY.objects.create(field_b="b", field_y="Y", parent=self.a)
+        self.c = ModelX.objects.create(field_b="c", field_x="X2", parent=self.root)
+        self.other = Base.objects.create(field_b="other")
+
+    def get_tree(self, root):
+        root.refresh_from_db()
+        return [
+            (node.__class__, node.field_b, node.level, node.lft, node.rght)
+            for node in root.get_descendants(include_self=True)
+        ]
+
+    def test_records(self):
+        # The streamed base rows, and one query per type for each chunk of 2 rows.
+        with self.assertNumQueries(4):
+            records = list(iter_tree_records(Base.objects.filter(tree_id=self.root.tree_id), chunk_size=2))
+
+        self.assertEqual(
+            [record["model"] for record in records], ["tests.base", "tests.modelx", "tests.modely", "tests.modelx"]
+        )
+        self.assertEqual(records[1]["parent"], self.root.pk)
+        self.assertEqual(records[1]["fields"], {"field_b": "a", "field_x": "X"})
+        self.assertEqual(records[2]["fields"], {"field_b": "b", "field_y": "Y"})
+
+    def test_nested_json(self):
+        stream = StringIO()
+        dump_tree(Base.objects.filter(tree_id=self.root.tree_id), stream, format="json")
+        data = json.loads(stream.getvalue())
+
+        self.assertEqual(len(data), 1)
+        self.assertEqual([child["fields"]["field_b"] for child in data[0]["children"]], ["a", "c"])
+        self.assertEqual(data[0]["children"][0]["children"][0]["model"], "tests.modely")
+        self.assertEqual(data[0]["children"][1]["children"], [])
+
+    def test_round_trip(self):
+        for format in ("jsonl", "json"):
+            stream = StringIO()
+            dump_tree(self.a.get_descendants(include_self=True), stream, format=format)
+            stream.seek(0)
+            count = load_tree(stream, Base, target=self.other, format=format, batch_size=1)
+            self.assertEqual(count, 2)
+
+        self.assertEqual(
+            self.get_tree(self.other),
+            [
+                (Base, "other", 0, 1, 10),
+                (ModelX, "a", 1, 2, 5),
+                (ModelY, "b", 2, 3, 4),
+                (ModelX, "a", 1, 6, 9),
+                (ModelY, "b", 2, 7, 8),
+            ],
+        )
+
+    def test_import_new_trees(self):
+        stream = StringIO()
+        dump_tree(Base.objects.all(), stream)
+        stream.seek(0)
+        load_tree(stream, Base)
+
+        roots = [(node.field_b, node.tree_id) for node in Base.objects.filter(parent=None)]
+        self.assertEqual(roots, [("root", 1), ("other", 2), ("root", 3), ("other", 4)])
+        self.assertEqual(
+            self.get_tree(Base.objects.get(tree_id=3, parent=None)),
+            [(Base, "root", 0, 1, 8), (ModelX, "a", 1, 2, 5), (ModelY, "b", 2, 3, 4), (ModelX, "c", 1, 6, 7)],
+        )
+
+    def test_import_validation(self):
+        restricted = ModelRestrictedChildren.objects.create(field_b="restricted")
+        stream = StringIO()
+        dump_tree(self.b.get_descendants(include_self=True), stream)
+        stream.seek(0)
+
+        count = Base.objects.count()
+        with self.assertRaises(InvalidMove):
+            load_tree(stream, Base, target=restricted)
+        self.assertEqual(Base.objects.count(), count)
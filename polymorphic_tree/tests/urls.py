@@ -0,0 +1,20 @@
+from django.contrib.admin import AdminSite
+from django.urls import path
+
+from polymorphic_tree.tests.admin import TreeNodeParentAdmin
+from polymorphic_tree.tests.models import ModelWithCustomParentName
+
+
+class ChangeListParentAdmin(TreeNodeParentAdmin):
+    """Parent admin without child admins, which only offers the changelist"""
+
+    child_models = (ModelWithCustomParentName,)
+    list_filter = ()
+
+
+site = AdminSite(name="tests")
+site.register(ModelWithCustomParentName, ChangeListParentAdmin)
+
+urlpatterns = [
+    path("admin/", site.urls),
+]
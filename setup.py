@@ -44,7 +44,7 @@ setup(
         "django-tag-parser>=2.1",
     ],
     requires=[
-        "Django (>=2.1)",
+        "Django (>=2.2)",
     ],
     description="A polymorphic mptt structure to display content in a tree.",
     long_description=read("README.rst"),